@@ -0,0 +1,15 @@
+"""Settings for `manage.py benchmark`, which uses them by default.
+
+One SQLite database without shards or replicas, like a default deployment,
+so that the query counts in benchmarks/baseline.json can be reproduced on
+any machine. Record the baseline with these settings only.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3'}}
+DATABASE_SHARDS = ['default']
+DATABASE_REPLICAS = []
+
+# The benchmark measures the routes, not password hashing.
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
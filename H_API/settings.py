@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -38,9 +39,12 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'baseapp.apps.BaseappConfig',
     'rest_framework',
+    'rest_framework.authtoken',
 ]
 
 MIDDLEWARE = [
+    'baseapp.middleware.MetricsMiddleware',
+    'baseapp.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,6 +89,77 @@ DATABASES = {
     }
 }
 
+# Persistent connections, checked before reuse at the start of a request.
+# Not a pool: each worker thread keeps and reuses its own connection, so
+# put a pooler such as PgBouncer in front of Postgres to cap the total.
+DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# Read replicas (comma-separated hosts, same credentials as the primary).
+# Views marked with baseapp.routers.read_replica read from them; see
+# baseapp.routers.ReplicaRouter.
+DATABASE_REPLICAS = []
+for number, host in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'HOST': host.strip(), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica{number}')
+
+# Shards (comma-separated hosts, same credentials and database name as the
+# primary, which is the first shard). Appointments, medical records and
+# conversations with their messages are spread over them, and each holds a
+# copy of the users, doctors and patients; see baseapp.sharding. After
+# changing the list, run the rebalance_shards command.
+DATABASE_SHARDS = ['default']
+for number, host in enumerate(filter(None, os.environ.get('DATABASE_SHARD_HOSTS', '').split(',')), start=1):
+    DATABASES[f'shard{number}'] = {**DATABASES['default'], 'HOST': host.strip()}
+    DATABASE_SHARDS.append(f'shard{number}')
+DATABASE_ROUTERS = ['baseapp.sharding.ShardRouter', 'baseapp.routers.ReplicaRouter']
+
+
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'baseapp.authentication.JWTAuthentication',
+        'rest_framework.authentication.TokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+}
+
+# Stateless auth: when enabled, login returns short-lived signed access
+# tokens plus a refresh token instead of a DRF token and a session.
+JWT_AUTH = False
+JWT_ACCESS_LIFETIME = 5 * 60
+JWT_REFRESH_LIFETIME = 7 * 24 * 60 * 60
+
+# Caches: the doctor cache, JWT revocations and doctor presence must be
+# shared by every process. Set CACHE_REDIS_URL (e.g. redis://cache:6379/0)
+# in production; without it each process keeps its own cache, which
+# `manage.py check --deploy` reports as an error unless DEBUG is on.
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES['default'] = {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': os.environ['CACHE_REDIS_URL']}
+
+# Doctor presence (baseapp.presence): on-duty doctors send a heartbeat at
+# least every PRESENCE_TTL seconds; the task workers write Doctor.available
+# back every PRESENCE_FLUSH_INTERVAL seconds.
+PRESENCE_TTL = 90
+PRESENCE_FLUSH_INTERVAL = 30
+
+# Doctor day views (baseapp.schedules): reading a day stores its schedule
+# only within this many days of today; writes store any day they touch.
+SCHEDULE_WINDOW_DAYS = 90
+
+# Change feed (/sync/<collection>/): entries are kept this many days by
+# the compact_changes command; older cursors get a snapshot instead.
+CHANGE_FEED_RETENTION_DAYS = 7
+
+# Log repeated SQL statements per request (likely N+1s and duplicates).
+METRICS_LOG_QUERIES = False
+
+# /metrics/ is served to staff users, however they authenticate, and to
+# scrapers sending this token as "Authorization: Bearer <token>". Each
+# worker process reports only its own counters.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 
 # Password validation
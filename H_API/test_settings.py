@@ -0,0 +1,27 @@
+"""Settings for the test suite, which `manage.py test` uses by default.
+
+SQLite stands in for PostgreSQL, with two extra shards and two replicas, so
+that the suite also covers sharding and replica routing (see DATABASE_SHARDS
+and DATABASE_REPLICAS in settings.py).
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3'}}
+
+DATABASE_SHARDS = ['default']
+for number in (1, 2):
+    DATABASES[f'shard{number}'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / f'shard{number}.sqlite3'}
+    DATABASE_SHARDS.append(f'shard{number}')
+
+# Replicas mirror the default database. Only ReplicaRoutingTests routes
+# reads to them: elsewhere a test's writes stay in a transaction that a
+# replica's own connection cannot see.
+DATABASE_REPLICAS = []
+TEST_DATABASE_REPLICAS = []
+for number in (1, 2):
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+    TEST_DATABASE_REPLICAS.append(f'replica{number}')
+
+# Tests measure queries, not password hashing.
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
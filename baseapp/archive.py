@@ -0,0 +1,120 @@
+import datetime
+import gzip
+import heapq
+import itertools
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from . import sharding
+from .booking import release_slots
+from .models import Appointment, ArchivedAppointment, ArchivedMedicalRecord, ArchivedMessage, MedicalRecord, Message
+from .pagination import keyset_chunks
+
+# Hot model -> (archive model, the field that decides a row's age).
+ARCHIVES = {
+    Appointment: (ArchivedAppointment, 'date'),
+    MedicalRecord: (ArchivedMedicalRecord, 'date'),
+    Message: (ArchivedMessage, 'timestamp'),
+}
+
+
+def include_archived(request):
+    return serializers.BooleanField().to_internal_value(request.query_params.get('archived', False))
+
+
+def models_for(model, archived=False):
+    """The models to read for ``model``: the hot one, then its archive."""
+    return [model, ARCHIVES[model][0]] if archived else [model]
+
+
+def sort_key(fields):
+    def key(item):
+        return tuple(item[f] if isinstance(item, dict) else getattr(item, f) for f in fields)
+    return key
+
+
+def merge(querysets, fields, reverse=False):
+    """Merge querysets that are each ordered by ``fields`` into one stream."""
+    if len(querysets) == 1:
+        return iter(querysets[0])
+    return heapq.merge(*querysets, key=sort_key(fields), reverse=reverse)
+
+
+def merge_chunks(querysets, fields, chunk_size=500):
+    """Like ``merge``, reading each queryset with ``keyset_chunks`` and
+    yielding lists of at most ``chunk_size`` rows."""
+    if len(querysets) == 1:
+        yield from keyset_chunks(querysets[0], fields, chunk_size)
+        return
+    streams = [itertools.chain.from_iterable(keyset_chunks(qs, fields, chunk_size)) for qs in querysets]
+    merged = heapq.merge(*streams, key=sort_key(fields))
+    while chunk := list(itertools.islice(merged, chunk_size)):
+        yield chunk
+
+
+def cutoff_for(model, older_than_days):
+    cutoff = timezone.now() - datetime.timedelta(days=older_than_days)
+    field = model._meta.get_field(ARCHIVES[model][1])
+    return cutoff if isinstance(field, models.DateTimeField) else timezone.localdate(cutoff)
+
+
+class Exporter:
+    """Appends archived rows to gzip-compressed JSON lines files, one per
+    model and month of the row's age field."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.encoder = DjangoJSONEncoder()
+
+    def write(self, model, rows):
+        field = ARCHIVES[model][1]
+        months = {}
+        for row in rows:
+            months.setdefault(row[field].strftime('%Y-%m'), []).append(row)
+        for month, month_rows in months.items():
+            path = self.directory / f'{model._meta.model_name}-{month}.jsonl.gz'
+            # Appending adds a gzip member; readers see one continuous stream.
+            with gzip.open(path, 'at', encoding='utf-8') as file:
+                for row in month_rows:
+                    file.write(self.encoder.encode(row) + '\n')
+
+
+def archive_rows(model, cutoff, batch_size=1000, exporter=None, dry_run=False):
+    """Move rows of ``model`` older than ``cutoff`` into its archive table,
+    one transaction per batch, and return how many were moved. Safe to rerun
+    after an interruption: rows already copied are skipped."""
+    archive_model, field = ARCHIVES[model]
+    columns = [f.attname for f in model._meta.concrete_fields]
+    rows = model.objects.filter(**{f'{field}__lt': cutoff}).values(*columns)
+    if dry_run:
+        return sum(shard.count() for shard in sharding.scatter(rows))
+    moved = 0
+    # An archive table is sharded like its hot table, so rows stay on their shard.
+    for shard in sharding.scatter(rows):
+        for chunk in keyset_chunks(shard, ('id',), batch_size):
+            with transaction.atomic(using=shard.db):
+                sharding.using(archive_model.objects.all(), shard.db).bulk_create([archive_model(**row) for row in chunk], ignore_conflicts=True)
+                # Not delete(): its receivers would take each row out of the
+                # inbox and report it deleted to syncing clients, one by one,
+                # though the row still exists in the archive. Nothing has a
+                # foreign key to these models, so there is nothing to cascade.
+                sharding.using(model.objects.filter(pk__in=[row['id'] for row in chunk]), shard.db)._raw_delete(shard.db)
+            if model is Appointment:
+                # Claims live on the default database; a past slot is not
+                # bookable anyway, so one left by a failure here is harmless.
+                release_slots([row['id'] for row in chunk])
+            if exporter is not None:
+                exporter.write(model, chunk)
+            moved += len(chunk)
+    return moved
+
+
+def archive_after_days():
+    return getattr(settings, 'ARCHIVE_AFTER_DAYS', 365)
@@ -0,0 +1,173 @@
+import threading
+import time
+import uuid
+
+import jwt
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+
+def jwt_enabled():
+    return getattr(settings, 'JWT_AUTH', False)
+
+
+def _signing_key():
+    return getattr(settings, 'JWT_SIGNING_KEY', settings.SECRET_KEY)
+
+
+def _algorithm():
+    return getattr(settings, 'JWT_ALGORITHM', 'HS256')
+
+
+def _encode(user, token_type, lifetime):
+    now = int(time.time())
+    claims = {
+        'sub': str(user.pk),
+        'username': user.username,
+        # Rendered wherever the user is a message sender.
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'staff': user.is_staff,
+        'type': token_type,
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + lifetime,
+    }
+    return jwt.encode(claims, _signing_key(), algorithm=_algorithm())
+
+
+def issue_tokens(user):
+    return {
+        'access': _encode(user, 'access', getattr(settings, 'JWT_ACCESS_LIFETIME', 300)),
+        'refresh': _encode(user, 'refresh', getattr(settings, 'JWT_REFRESH_LIFETIME', 7 * 24 * 3600)),
+    }
+
+
+def decode_token(token, token_type):
+    try:
+        claims = jwt.decode(token, _signing_key(), algorithms=[_algorithm()], options={'require': ['exp', 'jti', 'sub']})
+    except jwt.ExpiredSignatureError:
+        raise exceptions.AuthenticationFailed('Token has expired.')
+    except jwt.InvalidTokenError:
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    if claims.get('type') != token_type:
+        raise exceptions.AuthenticationFailed('Invalid token type.')
+    if revocations.is_revoked(claims):
+        raise exceptions.AuthenticationFailed('Token has been revoked.')
+    return claims
+
+
+def authenticate_request(request):
+    """The user of a plain Django request (e.g. an async view outside DRF),
+    by the configured DEFAULT_AUTHENTICATION_CLASSES as DRF views would:
+    AnonymousUser without credentials, AuthenticationFailed for bad ones.
+    Runs queries, so call it through ``sync_to_async`` from async code."""
+    return Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]).user
+
+
+class RevocationList:
+    """Revoked token ids, kept until the token would have expired anyway.
+
+    Checked on every authenticated request, so it lives in the process and
+    in the shared cache rather than in the database.
+    """
+
+    prefix = 'jwt-revoked:'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = {}
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'JWT_REVOCATION_CACHE_ALIAS', 'default')]
+
+    def revoke(self, claims):
+        remaining = max(int(claims['exp'] - time.time()), 1)
+        with self._lock:
+            self._local[claims['jti']] = claims['exp']
+        self.shared.set(self.prefix + claims['jti'], True, remaining)
+
+    def revoke_once(self, claims):
+        """Revoke a single-use token and return whether this call did so;
+        ``add`` is atomic in the shared cache, so of two concurrent calls
+        for the same token only one wins."""
+        remaining = max(int(claims['exp'] - time.time()), 1)
+        if not self.shared.add(self.prefix + claims['jti'], True, remaining):
+            return False
+        with self._lock:
+            self._local[claims['jti']] = claims['exp']
+        return True
+
+    def is_revoked(self, claims):
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, exp in self._local.items() if exp < now]
+            for jti in expired:
+                del self._local[jti]
+            if claims['jti'] in self._local:
+                return True
+        return self.shared.get(self.prefix + claims['jti'], False)
+
+
+revocations = RevocationList()
+
+
+class JWTAuthentication(BaseAuthentication):
+    """``Authorization: Bearer <access token>``, verified without a query.
+
+    ``request.user`` is an unsaved ``User`` built from the token claims; it
+    carries the primary key, username, names and staff flag, which is all
+    the views, serializers and permission classes read. Names changed since
+    the token was issued show from the next refresh. ``request.auth`` holds
+    the claims.
+    """
+
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        # Switching JWT_AUTH off also stops accepting tokens issued before.
+        if not jwt_enabled():
+            return None
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        claims = decode_token(token, 'access')
+        user = User(
+            pk=int(claims['sub']), username=claims['username'], is_staff=claims['staff'], is_active=True,
+            first_name=claims.get('first_name', ''), last_name=claims.get('last_name', ''),
+        )
+        return user, claims
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+class MetricsTokenAuthentication(BaseAuthentication):
+    """``Authorization: Bearer <METRICS_TOKEN>``, for scrapers of /metrics/.
+
+    Tried before the default classes, so a JWT configured for the same
+    scheme does not reject the scraper's token. ``request.auth`` is
+    ``'metrics'``; other bearer tokens are left to the next class.
+    """
+
+    def authenticate(self, request):
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        auth = get_authorization_header(request).split()
+        if not token or len(auth) != 2 or auth[0].lower() != b'bearer':
+            return None
+        if not constant_time_compare(auth[1], token.encode()):
+            return None
+        return AnonymousUser(), 'metrics'
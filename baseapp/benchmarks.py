@@ -0,0 +1,271 @@
+import datetime
+import io
+import itertools
+import math
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from django.urls import reverse
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import factories, images, metrics
+from .authentication import issue_tokens
+from .cache import doctor_cache
+from .models import Appointment
+from .search import search_index
+from .slots import slot_index
+
+
+class ScenarioError(Exception):
+    """A scenario got a response it does not expect, or ran out of data to
+    work on."""
+
+
+class Scenario:
+    """How to exercise one named route. ``build(ctx, i)`` does any untimed
+    setup for iteration ``i`` and returns ``(user, kwargs, payload)``: who to
+    authenticate as (or None), the URL kwargs and the query/body data.
+    ``expect`` is the status of a route that cannot succeed as it stands;
+    otherwise any 2xx."""
+
+    def __init__(self, method, build, expect=None, note=''):
+        self.method = method
+        self.build = build
+        self.expect = expect
+        self.note = note
+
+    def expects(self, status_code):
+        return 200 <= status_code < 300 if self.expect is None else status_code == self.expect
+
+
+class Context:
+    def __init__(self, data):
+        self.data = data
+        self.start_date = min(a.date for a in data['appointments'])
+        self.patient = data['patients'][0]
+        self.patient.user.is_staff = True
+        self.patient.user.save(update_fields=['is_staff'])
+        self.open_appointments = None
+
+    def pick(self, kind, i):
+        items = self.data[kind]
+        return items[i % len(items)]
+
+    def take_appointments(self, count=1):
+        """``count`` active appointments that no other iteration or scenario
+        was given, for scenarios that close them out; reads may ``pick``
+        any."""
+        if self.open_appointments is None:
+            self.open_appointments = iter([a for a in self.data['appointments'] if a.status in Appointment.ACTIVE_STATUSES])
+        appointments = list(itertools.islice(self.open_appointments, count))
+        if len(appointments) < count:
+            raise ScenarioError('Ran out of open appointments; seed a larger --scale or run fewer --iterations.')
+        return appointments
+
+
+def _account(prefix, i):
+    return {'username': f'{prefix}-{i}', 'password': factories.PASSWORD, 'email': f'{prefix}-{i}@example.com', 'first_name': 'Bench', 'last_name': str(i)}
+
+
+def _doctor_payload(ctx, i):
+    return {
+        'user': _account('bench-new-doctor', i),
+        'name': f'Dr. Bench {i}',
+        'email': f'bench{i}@example.com',
+        'office_number': '1',
+        'specialization': 'Cardiology',
+        'years_of_experience': 5,
+    }
+
+
+def _patient_payload(ctx, i):
+    return {
+        'user': _account('bench-new-patient', i),
+        'name': f'Bench {i}',
+        'date_of_birth': '1990-01-01',
+        'gender': 'F',
+        'phone_number': '1234567890',
+        'age': 34,
+        'blood_group': 'O+',
+    }
+
+
+def _logout(ctx, i):
+    user = ctx.pick('patients', i).user
+    Token.objects.get_or_create(user=user)
+    return user, {}, {}
+
+
+def _book(ctx, i):
+    date = ctx.start_date + datetime.timedelta(days=60 + i // 16)
+    time_ = datetime.time(9 + (i % 16) // 2, 30 * (i % 2))
+    return ctx.patient.user, {}, {'doctor': ctx.pick('doctors', i).pk, 'patient': ctx.patient.pk, 'date': date.isoformat(), 'time': time_.isoformat()}
+
+
+def _image_variant(ctx, i):
+    doctor = ctx.pick('doctors', 0)
+    if not doctor.image_hash:
+        output = io.BytesIO()
+        Image.new('RGB', (512, 512), 'teal').save(output, 'PNG')
+        doctor.image.save('bench.png', ContentFile(output.getvalue()))
+    variant = list(images.variant_sizes())[i % len(images.variant_sizes())]
+    return None, {'digest': doctor.image_hash, 'variant': variant}, {}
+
+
+def _schedule(ctx, i):
+    appointment = ctx.pick('appointments', i)
+    return appointment.doctor.user, {'doctor_id': appointment.doctor_id}, {'date': appointment.date.isoformat()}
+
+
+def _conversation(ctx, i):
+    conversation = ctx.data['conversations'][0]
+    return conversation.patient, {'conversation_id': conversation.pk}, {}
+
+
+SCENARIOS = {
+    # The views read the nested account, which the serializers' 'user'
+    # primary key field refuses.
+    'register_doctor': Scenario('post', lambda ctx, i: (ctx.patient.user, {}, _doctor_payload(ctx, i)), expect=400, note='refused in validation'),
+    'register_user': Scenario('post', lambda ctx, i: (None, {}, _patient_payload(ctx, i)), expect=400, note='refused in validation'),
+    'import_profiles': Scenario('post', lambda ctx, i: (ctx.patient.user, {'kind': 'patient'}, {
+        'rows': [{**_patient_payload(ctx, i), 'user': None, 'username': f'bench-import-{i}-{n}'} for n in range(10)],
+    }), note='10 rows without passwords, so no hashing'),
+    'login_doctor': Scenario('post', lambda ctx, i: (None, {}, {'username': ctx.pick('doctors', i).user.username, 'password': factories.PASSWORD})),
+    'login_user': Scenario('post', lambda ctx, i: (None, {}, {'username': ctx.pick('patients', i).user.username, 'password': factories.PASSWORD})),
+    'logout_user': Scenario('post', _logout),
+    'refresh_token': Scenario('post', lambda ctx, i: (None, {}, {'refresh': issue_tokens(ctx.pick('patients', i).user)['refresh']})),
+    'get_all_doctors': Scenario('get', lambda ctx, i: (None, {}, {})),
+    'search_doctors': Scenario('get', lambda ctx, i: (None, {}, {'q': ['card', 'priya', 'nuerology', 'dr sharma md'][i % 4]})),
+    'get_next_available_doctors': Scenario('get', lambda ctx, i: (ctx.patient.user, {}, {'specialization': 'Cardiology'})),
+    'get_doctor_cache_stats': Scenario('get', lambda ctx, i: (ctx.patient.user, {}, {})),
+    'get_doctor_image_variant': Scenario('get', _image_variant, note='rendered during warmup, then served from storage'),
+    'get_doctor_details': Scenario('get', lambda ctx, i: (ctx.patient.user, {'doctor_id': ctx.pick('doctors', i).pk}, {})),
+    'doctor_heartbeat': Scenario('post', lambda ctx, i: (ctx.pick('doctors', i).user, {}, {'available': i % 4 != 3})),
+    'get_doctor_schedule': Scenario('get', lambda ctx, i: _schedule(ctx, i)),
+    'get_all_appointments_ordered': Scenario('get', lambda ctx, i: (ctx.patient.user, {}, {
+        'date_from': ctx.start_date.isoformat(),
+        'date_to': (ctx.start_date + datetime.timedelta(days=6)).isoformat(),
+    })),
+    'book_appointment': Scenario('post', _book),
+    'bulk_transition_appointments': Scenario('post', lambda ctx, i: (ctx.patient.user, {}, {
+        'status': 'completed',
+        'ids': [appointment.pk for appointment in ctx.take_appointments(20)],
+    }), note='closes out 20 appointments per request'),
+    'mark_appointment_completed': Scenario('put', lambda ctx, i: (ctx.patient.user, {'appointment_id': ctx.take_appointments()[0].pk}, {})),
+    'mark_appointment_cancelled': Scenario('put', lambda ctx, i: (ctx.patient.user, {'appointment_id': ctx.take_appointments()[0].pk}, {})),
+    'get_appointment_details': Scenario('get', lambda ctx, i: (ctx.patient.user, {'appointment_id': ctx.pick('appointments', i).pk}, {})),
+    'get_patient_medical_records': Scenario('get', lambda ctx, i: (ctx.patient.user, {'patient_id': ctx.pick('medical_records', i).patient_id}, {'q': ['', 'review', 'follow visit'][i % 3]})),
+    'get_all_messages': Scenario('get', lambda ctx, i: (ctx.patient.user, {}, {})),
+    # MessageSerializer has writable nested fields, so no message is saved.
+    'create_message': Scenario('post', lambda ctx, i: (ctx.data['conversations'][0].patient, {}, {'conversation': ctx.data['conversations'][0].pk, 'content': f'Bench {i}'}), expect=500, note='fails in the view'),
+    'export_metrics': Scenario('get', lambda ctx, i: (ctx.patient.user, {}, {}), note='as staff'),
+    'get_inbox': Scenario('get', lambda ctx, i: (ctx.data['conversations'][0].patient, {}, {})),
+    'mark_conversation_read': Scenario('post', lambda ctx, i: (*_conversation(ctx, i)[:2], {})),
+    'get_conversation_messages': Scenario('get', _conversation),
+    'sync_changes': Scenario('get', lambda ctx, i: (ctx.data['conversations'][0].patient, {
+        'collection': ['doctors', 'appointments', 'messages', 'conversations'][i % 4],
+    }, {'cursor': '0'} if i % 8 >= 4 else {}), note='a first snapshot page, then the feed from the start'),
+    # A plain async view, but authenticate_request honours the forced user.
+    'stream_conversation_events': Scenario('get', _conversation, note='time to response headers; the stream itself is not consumed'),
+}
+
+
+def route_names():
+    from .urls import urlpatterns
+    return [pattern.name for pattern in urlpatterns if pattern.name]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def run(scale=1.0, seed=0, iterations=20, warmup=2, routes=None, stdout=None):
+    """Seed a data set and drive each route; expects an empty database."""
+    ctx = Context(factories.seed(scale=scale, seed=seed))
+    doctor_cache.bump_version()
+    slot_index.clear()
+    search_index.clear()
+    client = APIClient()
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+        return _run(ctx, client, iterations, warmup, routes, stdout)
+
+
+def _run(ctx, client, iterations, warmup, routes, stdout):
+    results = {}
+    counter = 0
+    for name in routes or route_names():
+        scenario = SCENARIOS[name]
+        latencies, queries, statuses = [], [], Counter()
+        peak = 0
+        for n in range(warmup + iterations + 1):
+            user, kwargs, payload = scenario.build(ctx, counter)
+            counter += 1
+            client.force_authenticate(user)
+            # A route expected to fail returns its 500 rather than raising.
+            client.raise_request_exception = not scenario.expects(500)
+            path = reverse(name, kwargs=kwargs)
+            request = getattr(client, scenario.method)
+            profile = n == warmup + iterations
+            if profile:
+                # One extra, untimed iteration under tracemalloc for the peak.
+                tracemalloc.start()
+            with metrics.collect() as stats:
+                start = time.perf_counter()
+                response = request(path, payload, format='json') if scenario.method != 'get' else request(path, payload)
+                elapsed = time.perf_counter() - start
+            if profile:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            elif n >= warmup:
+                latencies.append(elapsed)
+                queries.append(stats.queries)
+                statuses[response.status_code] += 1
+            response.close()
+            # Timing an unexpected response would measure the wrong code path.
+            if not scenario.expects(response.status_code):
+                raise ScenarioError(f'{name}: {scenario.method.upper()} {path} returned {response.status_code}')
+        results[name] = {
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'throughput_rps': round(len(latencies) / sum(latencies), 1),
+            'queries': max(queries),
+            'peak_kib': round(peak / 1024, 1),
+            'status': statuses.most_common(1)[0][0],
+        }
+        if stdout is not None:
+            stdout.write(format_row(name, results[name]))
+    return results
+
+
+def format_row(name, result):
+    return (
+        f"{name:<32} {result['status']:>4} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f}"
+        f" {result['throughput_rps']:>9.1f} {result['queries']:>6} {result['peak_kib']:>10.1f}"
+    )
+
+
+HEADER = f"{'route':<32} {'code':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'sql':>6} {'peak KiB':>10}"
+
+
+def regressions(results, baseline, tolerance=0.25, slack_ms=1.0):
+    """Compare against a saved run. Query counts must not grow at all; p95
+    latency may grow by ``tolerance`` (a fraction) plus ``slack_ms``."""
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            found.append(f"{name}: {result['queries']} queries per request, baseline {base['queries']}")
+        limit = base['p95_ms'] * (1 + tolerance) + slack_ms
+        if result['p95_ms'] > limit:
+            found.append(f"{name}: p95 {result['p95_ms']:.2f} ms, baseline {base['p95_ms']:.2f} ms (limit {limit:.2f} ms)")
+    return found
@@ -0,0 +1,179 @@
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, transaction
+from django.db.models import F, Q
+from django.dispatch import Signal
+from django.utils import timezone
+
+from . import sharding
+from .models import Appointment, PatientSlotClaim
+
+logger = logging.getLogger(__name__)
+
+CONFLICT_MESSAGE = "The appointment date and time conflicts with another appointment for the same doctor or patient."
+
+# Target status -> the statuses an appointment may move to it from.
+TRANSITIONS = {
+    'confirmed': ('pending',),
+    'completed': ('pending', 'confirmed'),
+    'cancelled': ('pending', 'confirmed'),
+}
+
+# Sent with ``appointments``, a list of unsaved Appointment instances holding
+# the new status, version and update time, after queryset updates that
+# bypass save().
+appointments_updated = Signal()
+
+
+def has_conflict(doctor, patient, date, time, exclude_pk=None):
+    # Served by the partial unique index on (doctor, date, time) on the
+    # doctor's shard and the claims' unique index on (patient, date, time),
+    # so the cost grows with neither the table nor the number of shards.
+    doctor_conflicts = sharding.on_shard(Appointment.objects.filter(
+        doctor=doctor,
+        date=date,
+        time=time,
+        status__in=Appointment.ACTIVE_STATUSES,
+    ), doctor=doctor.pk)
+    patient_conflicts = PatientSlotClaim.objects.filter(patient=patient, date=date, time=time)
+    if exclude_pk is not None:
+        doctor_conflicts = doctor_conflicts.exclude(pk=exclude_pk)
+        patient_conflicts = patient_conflicts.exclude(appointment_id=exclude_pk)
+    return doctor_conflicts.exists() or patient_conflicts.exists()
+
+
+def validate_appointment(doctor, patient, date, time, exclude_pk=None):
+    if not doctor.user.is_active or not patient.user.is_active:
+        raise ValidationError("The doctor or patient has been deleted or changed.")
+
+    if date < timezone.now().date():
+        raise ValidationError("The appointment date is in the past.")
+
+    if has_conflict(doctor, patient, date, time, exclude_pk=exclude_pk):
+        raise ValidationError(CONFLICT_MESSAGE)
+
+
+def insert_appointment(doctor, patient, date, time, status='pending'):
+    # validate_appointment is only a fast path; unique constraints decide the
+    # race between two concurrent bookings of the same slot: the doctor's on
+    # the appointment's shard, the patient's on the slot claim that the
+    # post_save signal takes on the default database, whichever shard the
+    # appointment is on. Either failing rolls back both. The shard commits
+    # first, so only a failure of the default database's commit itself can
+    # leave an appointment without its claim.
+    try:
+        with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(using=sharding.shard_for('doctor', doctor.pk)):
+            return Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=time, status=status)
+    except IntegrityError:
+        raise ValidationError(CONFLICT_MESSAGE)
+
+
+def claim_slot(appointment):
+    """Have the patient's slot claimed by ``appointment``, as saved, while it
+    is active and released otherwise. Raises IntegrityError if another
+    active appointment of the patient holds the slot."""
+    if appointment.status not in Appointment.ACTIVE_STATUSES:
+        release_slots([appointment.pk])
+        return
+    PatientSlotClaim.objects.bulk_create(
+        [PatientSlotClaim(appointment_id=appointment.pk, patient_id=appointment.patient_id, date=appointment.date, time=appointment.time)],
+        update_conflicts=True,
+        unique_fields=['appointment_id'],
+        update_fields=['patient', 'date', 'time'],
+    )
+
+
+def release_slots(pks):
+    PatientSlotClaim.objects.filter(appointment_id__in=pks).delete()
+
+
+def transition_appointments(changes):
+    """Apply ``changes``, a list of ``(id, status, version)`` where version
+    may be None, and return ``{id: (result, appointment)}``.
+
+    Results are 'updated', 'not_found', 'invalid_transition' (the current
+    status cannot move to the target), 'conflict' (the version did not
+    match, or another write got there first) or 'failed' (the update raised
+    a database error). Each target status is one
+    ``UPDATE ... WHERE status IN (...)`` per shard, guarded by the versions
+    read here, and each shard commits on its own: if one fails, only its
+    appointments are 'failed', and the others are still updated, signalled
+    and reported as such, so the caller can retry just the failed ones.
+    """
+    current = {}
+    for shard in sharding.scatter(Appointment.objects.only('id', 'doctor_id', 'date', 'time', 'status', 'version')):
+        current.update(shard.in_bulk([pk for pk, _, _ in changes]))
+    results, pending = {}, {}
+    for pk, target, version in changes:
+        appointment = current.get(pk)
+        if appointment is None:
+            results[pk] = ('not_found', None)
+        elif version is not None and version != appointment.version:
+            results[pk] = ('conflict', appointment)
+        elif appointment.status not in TRANSITIONS[target]:
+            results[pk] = ('invalid_transition', appointment)
+        else:
+            pending.setdefault(target, []).append(appointment)
+    updated, now = [], timezone.now()
+    with transaction.atomic():
+        for target, appointments in pending.items():
+            moved, failed = _update_status(target, appointments, now)
+            for appointment in moved:
+                appointment.status = target
+                appointment.version += 1
+                appointment.updated_at = now
+                updated.append(appointment)
+            for appointment in failed:
+                results[appointment.pk] = ('failed', appointment)
+        for appointment in updated:
+            results[appointment.pk] = ('updated', appointment)
+        for appointments in pending.values():
+            for appointment in appointments:
+                results.setdefault(appointment.pk, ('conflict', appointment))
+        if updated:
+            appointments_updated.send(sender=Appointment, appointments=updated)
+    return results
+
+
+class _LostRace(Exception):
+    pass
+
+
+def _update_status(target, appointments, now):
+    """Move ``appointments`` to ``target`` if still at the version read and
+    return ``(moved, failed)``: the ones that moved, and the ones on shards
+    where the update raised."""
+    by_shard = {}
+    for appointment in appointments:
+        by_shard.setdefault(appointment._state.db, []).append(appointment)
+    moved, failed = [], []
+    for db, batch in by_shard.items():
+        try:
+            moved += _update_status_on(db, target, batch, now)
+        except DatabaseError:
+            logger.exception('Moving %d appointments to %s failed on %s', len(batch), target, db)
+            failed += batch
+    return moved, failed
+
+
+def _update_status_on(db, target, appointments, now):
+    def guarded(batch):
+        by_version = {}
+        for appointment in batch:
+            by_version.setdefault(appointment.version, []).append(appointment.pk)
+        guard = Q()
+        for version, pks in by_version.items():
+            guard |= Q(version=version, pk__in=pks)
+        return sharding.using(Appointment.objects.filter(guard, status__in=TRANSITIONS[target]), db).update(
+            status=target, version=F('version') + 1, updated_at=now,
+        )
+
+    try:
+        with transaction.atomic(using=db):
+            if guarded(appointments) != len(appointments):
+                raise _LostRace
+        return appointments
+    except _LostRace:
+        # An UPDATE only reports a count, so find the losers one by one.
+        return [appointment for appointment in appointments if guarded([appointment])]
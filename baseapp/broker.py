@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    def __init__(self, broker, channel, loop, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+    def deliver(self, payload):
+        # Runs on the subscriber's event loop. A subscriber that cannot keep
+        # up is cut off; the client reconnects and replays from its last id.
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    """Fans published payloads out to the subscribers of a channel.
+
+    Subscribers live on event loops (async views); publishers may be on any
+    thread, typically a sync view's ``post_save`` handler. Only subscribers in
+    the same process are reached, so deployments running several ASGI
+    workers point ``MESSAGE_BROKER`` at a broker with the same interface
+    backed by shared infrastructure.
+    """
+
+    def __init__(self, max_pending=None):
+        self.max_pending = max_pending or getattr(settings, 'MESSAGE_BROKER_MAX_PENDING', 1000)
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, asyncio.get_running_loop(), self.max_pending)
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                return len(self._subscribers.get(channel, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+    def publish(self, channel, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, payload)
+            except RuntimeError:
+                # The subscriber's loop has shut down.
+                self.unsubscribe(subscription)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'MESSAGE_BROKER', 'baseapp.broker.InProcessBroker'))()
+    return _broker
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .routers import primary
+
+
+class DoctorCache:
+    """Two-level cache of serialized doctors.
+
+    Entries live in a per-process LRU and in Django's cache framework so
+    workers can share them. Every key carries the catalogue version; bumping
+    the version (see ``baseapp.signals``) makes all older entries unreachable.
+    """
+
+    version_key = 'doctor-catalogue:version'
+
+    def __init__(self, max_entries=None, timeout=None, alias=None, version_check_interval=None):
+        self.max_entries = max_entries or getattr(settings, 'DOCTOR_CACHE_MAX_ENTRIES', 1024)
+        self.timeout = timeout or getattr(settings, 'DOCTOR_CACHE_TIMEOUT', 3600)
+        self.alias = alias or getattr(settings, 'DOCTOR_CACHE_ALIAS', 'default')
+        if version_check_interval is None:
+            version_check_interval = getattr(settings, 'DOCTOR_CACHE_VERSION_CHECK_INTERVAL', 1.0)
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+        self._version = None
+        self._version_checked_at = 0.0
+        self.reset_stats()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def reset_stats(self):
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'version': self._version,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'local_entries': len(self._local),
+        }
+
+    def version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked_at >= self.version_check_interval:
+            version = self.shared.get(self.version_key)
+            if version is None:
+                # A missing key (never set or evicted) must not reuse an old
+                # version number, so seed it from the clock.
+                self.shared.add(self.version_key, time.time_ns(), None)
+                version = self.shared.get(self.version_key)
+            self._set_version(version, now)
+        return self._version
+
+    def _set_version(self, version, checked_at):
+        with self._lock:
+            if version != self._version:
+                self._local.clear()
+            self._version = version
+            self._version_checked_at = checked_at
+
+    def bump_version(self):
+        try:
+            version = self.shared.incr(self.version_key)
+        except ValueError:
+            version = time.time_ns()
+            self.shared.set(self.version_key, version, None)
+        self._set_version(version, time.monotonic())
+
+    def get_or_set(self, key, compute):
+        version = self.version()
+        cache_key = f'doctor:{version}:{key}'
+        with self._lock:
+            if cache_key in self._local:
+                self._local.move_to_end(cache_key)
+                self.local_hits += 1
+                return self._local[cache_key]
+        value = self.shared.get(cache_key)
+        if value is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            # Entries outlive replication lag, so fill them from the primary.
+            with primary():
+                value = compute()
+            self.shared.set(cache_key, value, self.timeout)
+        with self._lock:
+            self._local[cache_key] = value
+            self._local.move_to_end(cache_key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+        return value
+
+
+doctor_cache = DoctorCache()
@@ -0,0 +1,192 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField, Exists, ExpressionWrapper, Max, Min, OuterRef, Q
+from django.utils import timezone
+
+from . import archive, sharding
+from .models import Appointment, Change, Conversation, Doctor, Message
+from .serializers import AppointmentSerializer, DoctorSerializer, InboxSerializer, MessageSerializer
+
+
+class Collection:
+    """A collection clients can sync: its rows, as the matching list endpoint
+    serves them. Changed rows that are no longer in ``queryset`` are
+    reported as deleted; ``visible`` (user -> Q) leaves out rows the user
+    may not see."""
+
+    def __init__(self, model, queryset, serializer_class, visible=None):
+        self.model = model
+        self.queryset = queryset
+        self.serializer_class = serializer_class
+        self.visible = visible
+
+    def shards(self, queryset):
+        # Reference tables are copied whole to every shard; read them once.
+        return sharding.scatter(queryset) if self.model in sharding.SHARD_KEYS else [queryset]
+
+    def serialize(self, rows, user):
+        return self.serializer_class(rows, many=True, context={'user': user}).data
+
+    def page(self, user, after, limit):
+        """Up to ``limit`` rows with a primary key above ``after``, in order."""
+        queryset = self.queryset().filter(pk__gt=after).order_by('pk')
+        if self.visible is not None:
+            queryset = queryset.filter(self.visible(user))
+        return list(archive.merge([shard[:limit] for shard in self.shards(queryset)], ('pk',)))[:limit]
+
+    def changed(self, user, pks):
+        """The rows among ``pks`` still in the collection, and the primary
+        keys of those ``user`` may not see, in one query per shard."""
+        queryset = self.queryset().filter(pk__in=pks)
+        if self.visible is not None:
+            queryset = queryset.annotate(sync_visible=ExpressionWrapper(self.visible(user), output_field=BooleanField()))
+        rows = [row for shard in self.shards(queryset) for row in shard]
+        hidden = {row.pk for row in rows if not getattr(row, 'sync_visible', True)}
+        return [row for row in rows if row.pk not in hidden], hidden
+
+
+COLLECTIONS = {
+    'doctors': Collection(Doctor, lambda: Doctor.objects.with_related(), DoctorSerializer),
+    'appointments': Collection(
+        Appointment,
+        lambda: Appointment.objects.filter(status__in=Appointment.ACTIVE_STATUSES).select_related(
+            'doctor__specialization', 'patient',
+        ).prefetch_related('doctor__qualifications'),
+        AppointmentSerializer,
+        # Their own appointments, to doctor and patient alike.
+        lambda user: Q(doctor__user=user) | Q(patient__user=user),
+    ),
+    'messages': Collection(
+        Message,
+        lambda: Message.objects.select_related('conversation', 'sender'),
+        MessageSerializer,
+        lambda user: Q(conversation__doctor=user) | Q(conversation__patient=user),
+    ),
+    # As in the inbox: a participant's view of their own conversations.
+    'conversations': Collection(Conversation, lambda: Conversation.objects.all(), InboxSerializer, lambda user: Q(doctor=user) | Q(patient=user)),
+}
+
+
+def settle_seconds():
+    # Entries newer than this are held back, so that one whose sequence
+    # number was taken before a neighbour's but committed after it cannot
+    # be skipped by a client's cursor.
+    return getattr(settings, 'CHANGE_FEED_SETTLE_SECONDS', 1)
+
+
+def retention_days():
+    return getattr(settings, 'CHANGE_FEED_RETENTION_DAYS', 7)
+
+
+def record(collection, pks, using=None):
+    """Log that the objects ``pks`` of ``collection`` changed, once the
+    current transaction on ``using`` (where they were written) commits, so
+    that a rolled back write logs nothing and a long transaction does not
+    leave a gap behind the cursors of clients that synced meanwhile."""
+    pks = list(dict.fromkeys(pks))
+    if not pks:
+        return
+    transaction.on_commit(lambda: Change.objects.bulk_create([Change(collection=collection, object_id=pk) for pk in pks]), using=using)
+
+
+def record_rows(collection, rows):
+    # Rows read from several shards, each logged with its own transaction.
+    by_db = {}
+    for row in rows:
+        by_db.setdefault(row._state.db, []).append(row.pk)
+    for db, pks in by_db.items():
+        record(collection, pks, db)
+
+
+def active_appointments(**filters):
+    appointments = Appointment.objects.filter(status__in=Appointment.ACTIVE_STATUSES, **filters).values_list('pk', flat=True)
+    return [pk for shard in sharding.scatter(appointments) for pk in shard]
+
+
+def doctors_changed(pks):
+    """Log doctors whose representation changed, and the active appointments
+    that embed it."""
+    pks = list(pks)
+    record('doctors', pks)
+    if pks:
+        record('appointments', active_appointments(doctor_id__in=pks))
+
+
+def patient_changed(patient):
+    record('appointments', active_appointments(patient_id=patient.pk))
+
+
+def parse_cursor(cursor):
+    """``(seq, after)`` from a cursor: ``seq`` alone while following the
+    feed, ``seq:after`` while reading a snapshot past primary key ``after``."""
+    seq, _, after = cursor.partition(':')
+    return int(seq), int(after) if after else None
+
+
+def snapshot(collection, user, seq, after, limit):
+    rows = collection.page(user, after, limit)
+    more = len(rows) == limit
+    return {
+        'cursor': f'{seq}:{rows[-1].pk}' if more else str(seq),
+        'snapshot': True,
+        'reset': after == 0,
+        'has_more': more,
+        'changes': [{'id': row.pk, 'deleted': False, 'data': data} for row, data in zip(rows, collection.serialize(rows, user))],
+    }
+
+
+def sync(name, user, cursor=None, limit=500):
+    """The changes to collection ``name`` after ``cursor``, at most ``limit``
+    entries of the feed. Without a cursor, or once entries after it have
+    been compacted away, the client gets a snapshot of the collection
+    instead (``reset`` on its first page: drop the local copy), paged by
+    primary key and followed by the changes made while it was read."""
+    collection = COLLECTIONS[name]
+    if cursor is None:
+        return snapshot(collection, user, Change.objects.aggregate(last=Max('seq'))['last'] or 0, 0, limit)
+    seq, after = parse_cursor(cursor)
+    if after is not None:
+        return snapshot(collection, user, seq, after, limit)
+    oldest = Change.objects.aggregate(first=Min('seq'))['first']
+    if oldest is not None and seq < oldest - 1:
+        return snapshot(collection, user, Change.objects.aggregate(last=Max('seq'))['last'], 0, limit)
+    entries = list(Change.objects.filter(collection=name, seq__gt=seq).order_by('seq').values_list('seq', 'object_id', 'created_at')[:limit])
+    more = len(entries) == limit
+    settled = timezone.now() - datetime.timedelta(seconds=settle_seconds())
+    for index, (_, _, created_at) in enumerate(entries):
+        if created_at > settled:
+            entries, more = entries[:index], False
+            break
+    if not entries:
+        return {'cursor': str(seq), 'snapshot': False, 'reset': False, 'has_more': False, 'changes': []}
+    # An object changed several times is sent once, at its latest position.
+    latest = {pk: position for position, (_, pk, _) in enumerate(entries)}
+    pks = sorted(latest, key=latest.get)
+    rows, hidden = collection.changed(user, pks)
+    found = {row.pk: data for row, data in zip(rows, collection.serialize(rows, user))}
+    return {
+        'cursor': str(entries[-1][0]),
+        'snapshot': False,
+        'reset': False,
+        'has_more': more,
+        'changes': [
+            {'id': pk, 'deleted': False, 'data': found[pk]} if pk in found else {'id': pk, 'deleted': True}
+            for pk in pks if pk not in hidden
+        ],
+    }
+
+
+def compact(older_than_days=None):
+    """Drop entries superseded by a later one for the same object, then
+    entries older than CHANGE_FEED_RETENTION_DAYS (always keeping the
+    newest). Returns ``(superseded, expired)``. Clients whose cursor is
+    older than the oldest remaining entry get a snapshot on their next sync."""
+    newer = Change.objects.filter(collection=OuterRef('collection'), object_id=OuterRef('object_id'), seq__gt=OuterRef('seq'))
+    superseded, _ = Change.objects.filter(Exists(newer)).delete()
+    days = older_than_days if older_than_days is not None else retention_days()
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    last = Change.objects.aggregate(last=Max('seq'))['last']
+    expired, _ = Change.objects.filter(created_at__lt=cutoff, seq__lt=last).delete() if last else (0, None)
+    return superseded, expired
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Error, Tags, register
+
+PROCESS_LOCAL_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_caches(app_configs, **kwargs):
+    """Doctor presence and JWT revocations are only correct if every process
+    sees the same cache."""
+    if settings.DEBUG:
+        return []
+    aliases = {'PRESENCE_CACHE_ALIAS': getattr(settings, 'PRESENCE_CACHE_ALIAS', 'default')}
+    if getattr(settings, 'JWT_AUTH', False):
+        aliases['JWT_REVOCATION_CACHE_ALIAS'] = getattr(settings, 'JWT_REVOCATION_CACHE_ALIAS', 'default')
+    errors = []
+    for setting, alias in aliases.items():
+        backend = settings.CACHES.get(alias, {}).get('BACKEND')
+        if backend in PROCESS_LOCAL_BACKENDS:
+            errors.append(Error(
+                f"{setting} ('{alias}') uses {backend}, which is not shared between processes.",
+                hint='Set CACHE_REDIS_URL, or point the alias at a shared cache backend.',
+                id='baseapp.E001',
+            ))
+    return errors
@@ -0,0 +1,34 @@
+import hashlib
+
+from django.views.decorators.http import condition
+
+
+def etag(*parts):
+    return hashlib.md5(repr(parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def conditional(validators):
+    """Like Django's ``condition`` with a single function returning
+    ``(etag, last_modified)``, or None to skip the check, evaluated once per
+    request. Apply it below ``@api_view`` so that authentication and
+    permissions run before a 304 can be answered.
+
+    The ETag covers the query string and the negotiated media type, since
+    both change the body without changing the data behind it. Return None
+    for ``last_modified`` unless a timestamp moves on every change the ETag
+    covers: Django answers If-Modified-Since alone when a client sends no
+    If-None-Match.
+    """
+    def cached(request, *args, **kwargs):
+        if not hasattr(request, '_conditional_validators'):
+            found = validators(request, *args, **kwargs) if request.method in ('GET', 'HEAD') else None
+            if found is not None:
+                tag, last_modified = found
+                found = (etag(tag, request.get_full_path(), getattr(request, 'accepted_media_type', None)), last_modified)
+            request._conditional_validators = found or (None, None)
+        return request._conditional_validators
+
+    return condition(
+        etag_func=lambda request, *args, **kwargs: cached(request, *args, **kwargs)[0],
+        last_modified_func=lambda request, *args, **kwargs: cached(request, *args, **kwargs)[1],
+    )
@@ -0,0 +1,130 @@
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import inbox, sharding
+from .models import Doctor, Patient, Appointment, MedicalRecord, Qualification, Specialization, Conversation, Message
+
+
+SPECIALIZATIONS = ['Cardiology', 'Dermatology', 'Neurology', 'Oncology', 'Orthopedics', 'Pediatrics', 'Psychiatry', 'Radiology']
+QUALIFICATIONS = ['MBBS', 'MD', 'MS', 'DM', 'MCh', 'DNB', 'FRCS', 'MRCP']
+FIRST_NAMES = ['Asha', 'Arun', 'Divya', 'Karthik', 'Meena', 'Nikhil', 'Priya', 'Rahul', 'Sneha', 'Vikram']
+LAST_NAMES = ['Iyer', 'Kumar', 'Menon', 'Nair', 'Patel', 'Rao', 'Reddy', 'Sharma', 'Singh', 'Verma']
+BLOOD_GROUPS = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+PASSWORD = 'benchmark-password'
+
+VOLUMES = {
+    'doctors': 200,
+    'patients': 2000,
+    'appointment_days': 14,
+    'medical_records': 5000,
+    'conversations': 1000,
+    'messages': 20000,
+}
+
+
+def _name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+
+
+def _users(prefix, count, password):
+    users = [User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password=password) for i in range(count)]
+    User.objects.bulk_create(users, batch_size=1000)
+    return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+@transaction.atomic
+def seed(scale=1.0, seed=0, start_date=None):
+    """Create a deterministic data set sized by ``scale`` and return the
+    created objects by kind. The same ``seed`` and ``scale`` always give the
+    same rows, with dates counted from ``start_date`` (default: tomorrow)."""
+    rng = random.Random(seed)
+    counts = {key: max(1, int(value * scale)) for key, value in VOLUMES.items()}
+    counts['appointment_days'] = VOLUMES['appointment_days']
+    start_date = start_date or timezone.localdate() + datetime.timedelta(days=1)
+    password = make_password(PASSWORD)
+
+    specializations = Specialization.objects.bulk_create([Specialization(name=name) for name in SPECIALIZATIONS])
+    qualifications = Qualification.objects.bulk_create([Qualification(name=name) for name in QUALIFICATIONS])
+
+    doctor_users = _users('bench-doctor-', counts['doctors'], password)
+    doctors = Doctor.objects.bulk_create([
+        Doctor(
+            user=user,
+            name=f'Dr. {_name(rng)}',
+            email=user.email,
+            office_number=str(100 + i),
+            specialization=rng.choice(specializations),
+            years_of_experience=rng.randint(1, 35),
+            available=rng.random() < 0.8,
+        )
+        for i, user in enumerate(doctor_users)
+    ], batch_size=1000)
+    Through = Doctor.qualifications.through
+    Through.objects.bulk_create([
+        Through(doctor_id=doctor.pk, qualification_id=qualification.pk)
+        for doctor in doctors
+        for qualification in rng.sample(qualifications, rng.randint(1, 3))
+    ], batch_size=1000)
+
+    patient_users = _users('bench-patient-', counts['patients'], password)
+    patients = Patient.objects.bulk_create([
+        Patient(
+            user=user,
+            name=_name(rng),
+            date_of_birth=datetime.date(1940, 1, 1) + datetime.timedelta(days=rng.randint(0, 365 * 80)),
+            gender=rng.choice('MFO'),
+            phone_number=f'{rng.randint(0, 10 ** 10 - 1):010d}',
+            email=user.email,
+            age=rng.randint(1, 90),
+            blood_group=rng.choice(BLOOD_GROUPS),
+        )
+        for user in patient_users
+    ], batch_size=1000)
+
+    # bulk_create sends no signals, so the shards' copies are synced here.
+    sharding.sync_reference_tables()
+
+    # Each doctor takes a few half-hour slots a day; a patient is never
+    # booked twice for the same slot, as the unique constraints require.
+    appointments = []
+    for day in range(counts['appointment_days']):
+        date = start_date + datetime.timedelta(days=day)
+        for slot in range(16):
+            time = datetime.time(9 + slot // 2, 30 * (slot % 2))
+            booked = [doctor for doctor in doctors if rng.random() < 0.15]
+            for doctor, patient in zip(booked, rng.sample(patients, min(len(booked), len(patients)))):
+                appointments.append(Appointment(doctor=doctor, patient=patient, date=date, time=time, status=rng.choice(['pending', 'confirmed'])))
+    appointments = Appointment.objects.bulk_create(appointments, batch_size=1000)
+
+    records = MedicalRecord.objects.bulk_create([
+        MedicalRecord(patient=rng.choice(patients), doctor=rng.choice(doctors), description=f'Follow-up visit {i}: {rng.choice(SPECIALIZATIONS).lower()} review.')
+        for i in range(counts['medical_records'])
+    ], batch_size=1000)
+
+    conversations = Conversation.objects.bulk_create([
+        Conversation(doctor=doctor.user, patient=patient.user)
+        for doctor, patient in ((rng.choice(doctors), rng.choice(patients)) for _ in range(counts['conversations']))
+    ], batch_size=1000)
+    messages = []
+    for i in range(counts['messages']):
+        conversation = rng.choice(conversations)
+        sender_id = conversation.doctor_id if rng.random() < 0.5 else conversation.patient_id
+        messages.append(Message(conversation=conversation, sender_id=sender_id, content=f'Message {i}'))
+    messages = Message.objects.bulk_create(messages, batch_size=1000)
+    inbox.rebuild()
+
+    return {
+        'specializations': specializations,
+        'qualifications': qualifications,
+        'doctors': doctors,
+        'patients': patients,
+        'appointments': appointments,
+        'medical_records': records,
+        'conversations': conversations,
+        'messages': messages,
+    }
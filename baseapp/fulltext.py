@@ -0,0 +1,45 @@
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+# Both indexes are created by migration 0008 and kept current by the
+# database itself: a generated tsvector column on PostgreSQL, triggers
+# feeding an FTS5 table on SQLite.
+INDEXED_TABLE = 'baseapp_medicalrecord'
+FTS_TABLE = 'baseapp_medicalrecord_fts'
+TEXT_SEARCH_CONFIG = 'english'
+
+
+def terms(query):
+    return re.findall(r'\w+', query or '')
+
+
+def search_medical_records(queryset, query):
+    """Filter ``queryset`` to records whose description matches every word
+    of ``query``, the last one as a prefix so it works while typing. Uses
+    the backend's full-text index where there is one; archived records
+    have none and are scanned."""
+    words = terms(query)
+    if not words:
+        return queryset
+    vendor = connections[queryset.db].vendor
+    table = queryset.model._meta.db_table
+    if table != INDEXED_TABLE:
+        vendor = None
+    if vendor == 'postgresql':
+        matches = RawSQL(
+            f'"{table}"."search_vector" @@ to_tsquery(%s, %s)',
+            (TEXT_SEARCH_CONFIG, ' & '.join(words) + ':*'),
+            output_field=BooleanField(),
+        )
+        return queryset.alias(fulltext_match=matches).filter(fulltext_match=True)
+    if vendor == 'sqlite':
+        match = ' '.join(f'"{word}"' for word in words) + '*'
+        rowids = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', (match,))
+        return queryset.filter(pk__in=rowids)
+    condition = Q()
+    for word in words:
+        condition &= Q(description__icontains=word)
+    return queryset.filter(condition)
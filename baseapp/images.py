@@ -0,0 +1,99 @@
+import hashlib
+import io
+import posixpath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.urls import reverse
+from PIL import Image, ImageOps, features
+
+from .models import Doctor
+
+
+DEFAULT_VARIANTS = {'thumb': 64, 'small': 128, 'medium': 256}
+
+
+def variant_sizes():
+    return getattr(settings, 'DOCTOR_IMAGE_VARIANTS', DEFAULT_VARIANTS)
+
+
+def variant_format():
+    return 'WEBP' if features.check('webp') else 'JPEG'
+
+
+def variant_extension():
+    return 'webp' if variant_format() == 'WEBP' else 'jpg'
+
+
+def content_hash(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def update_image_hash(doctor):
+    """Keep ``doctor.image_hash`` in step with the image content. Only new
+    uploads, replaced images (``image.save()`` stores the file before the
+    row) and rows without a hash are read, so ordinary saves do no I/O."""
+    name = doctor.image.name if doctor.image else ''
+    replaced = name != getattr(doctor, '_stored_image', name)
+    if not doctor.image:
+        doctor.image_hash = ''
+    elif not doctor.image._committed:
+        doctor.image_hash = content_hash(doctor.image.file)
+    elif (replaced or not doctor.image_hash) and doctor.image.storage.exists(name):
+        with doctor.image.storage.open(name) as file:
+            doctor.image_hash = content_hash(file)
+
+
+def variant_urls(image_hash):
+    if not image_hash:
+        return None
+    return {
+        name: reverse('get_doctor_image_variant', kwargs={'digest': image_hash, 'variant': name})
+        for name in variant_sizes()
+    }
+
+
+def variant_storage():
+    return Doctor._meta.get_field('image').storage
+
+
+def variant_name(image_hash, variant):
+    directory = Doctor._meta.get_field('image').upload_to
+    return posixpath.join(directory, 'variants', f'{image_hash}-{variant}.{variant_extension()}')
+
+
+def variant_content_type():
+    return 'image/webp' if variant_format() == 'WEBP' else 'image/jpeg'
+
+
+def render_variant(source, size):
+    image = ImageOps.exif_transpose(Image.open(source))
+    if variant_format() == 'JPEG':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, variant_format(), quality=getattr(settings, 'DOCTOR_IMAGE_QUALITY', 80))
+    return output.getvalue()
+
+
+def ensure_variant(doctor, variant):
+    """Return the storage name of ``variant``, rendering it on first use.
+    Names carry the source content hash, so a stored file never goes stale."""
+    storage = variant_storage()
+    name = variant_name(doctor.image_hash, variant)
+    if not storage.exists(name):
+        with storage.open(doctor.image.name) as source:
+            data = render_variant(source, variant_sizes()[variant])
+        name = storage.save(name, ContentFile(data))
+    return name
+
+
+def ensure_variants(doctor):
+    return {variant: ensure_variant(doctor, variant) for variant in variant_sizes()}
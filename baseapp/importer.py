@@ -0,0 +1,188 @@
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import changes, sharding
+from .cache import doctor_cache
+from .models import Doctor, ImportJob, Patient, Qualification, Specialization
+from .search import search_index
+from .serializers import DoctorImportSerializer, PatientImportSerializer
+
+SERIALIZERS = {'doctor': DoctorImportSerializer, 'patient': PatientImportSerializer}
+USER_FIELDS = ('username', 'password', 'first_name', 'last_name')
+
+
+def detect_format(name):
+    return 'jsonl' if name.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per input row from a text stream. Empty CSV cells are
+    treated as missing; CSV qualifications are separated by semicolons."""
+    if fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as exc:
+                    yield {'__error__': f'Invalid JSON: {exc}'}
+        return
+    for row in csv.DictReader(stream):
+        row = {key: value for key, value in row.items() if key and value not in ('', None)}
+        if isinstance(row.get('qualifications'), str):
+            row['qualifications'] = [q.strip() for q in row['qualifications'].split(';') if q.strip()]
+        yield row
+
+
+def text_stream(uploaded):
+    return io.TextIOWrapper(uploaded, encoding='utf-8-sig', newline='')
+
+
+def _hash(password):
+    return make_password(password or None)
+
+
+class Importer:
+    """Validates rows in batches with the import serializers, hashes
+    passwords in a process pool and inserts each batch of users, profiles
+    and qualification links with ``bulk_create`` in one transaction. The
+    batch also advances ``job.rows_processed``, which is what a resumed run
+    skips up to."""
+
+    def __init__(self, job, batch_size=None, workers=None):
+        self.job = job
+        self.serializer_class = SERIALIZERS[job.kind]
+        self.batch_size = batch_size or getattr(settings, 'IMPORT_BATCH_SIZE', 500)
+        self.workers = workers if workers is not None else getattr(settings, 'IMPORT_HASH_WORKERS', os.cpu_count() or 1)
+        # Below this many passwords a batch is hashed in-process; starting
+        # worker processes costs more than it saves.
+        self.pool_threshold = getattr(settings, 'IMPORT_POOL_THRESHOLD', 64)
+        self._pool = None
+
+    def hash_passwords(self, passwords):
+        if self.workers <= 1 or len(passwords) < self.pool_threshold:
+            return [_hash(p) for p in passwords]
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=django.setup)
+        return list(self._pool.map(_hash, passwords, chunksize=max(1, len(passwords) // (self.workers * 4))))
+
+    def run(self, rows):
+        job = self.job
+        rows = itertools.islice(enumerate(rows, start=1), job.rows_processed, None)
+        try:
+            while batch := list(itertools.islice(rows, self.batch_size)):
+                self.import_batch(batch)
+        except BaseException:
+            ImportJob.objects.filter(pk=job.pk).update(status='failed')
+            job.status = 'failed'
+            raise
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+            if job.kind == 'doctor' and job.rows_imported:
+                # bulk_create sends no signals.
+                doctor_cache.bump_version()
+                search_index.clear()
+        job.status = 'completed'
+        job.save(update_fields=['status', 'updated_at'])
+        return job
+
+    def validate(self, batch):
+        valid, errors = [], []
+        for number, row in batch:
+            if '__error__' in row:
+                errors.append({'row': number, 'errors': {'non_field_errors': [row['__error__']]}})
+                continue
+            serializer = self.serializer_class(data=row)
+            if serializer.is_valid():
+                valid.append((number, serializer.validated_data))
+            else:
+                errors.append({'row': number, 'username': row.get('username'), 'errors': serializer.errors})
+        # Usernames must be unique within the file and against the table;
+        # both are checked once per batch instead of once per row.
+        usernames = [data['username'] for _, data in valid]
+        taken = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        unique = []
+        for number, data in valid:
+            if data['username'] in taken:
+                errors.append({'row': number, 'username': data['username'], 'errors': {'username': ['A user with that username already exists.']}})
+            else:
+                taken.add(data['username'])
+                unique.append((number, data))
+        errors.sort(key=lambda error: error['row'])
+        return unique, errors
+
+    def import_batch(self, batch):
+        valid, errors = self.validate(batch)
+        hashes = self.hash_passwords([data.get('password') for _, data in valid])
+        # (model, rows) in foreign key order, for the shards' copies.
+        created = []
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(
+                    username=data['username'],
+                    password=password,
+                    email=data.get('email') or '',
+                    first_name=data.get('first_name', ''),
+                    last_name=data.get('last_name', ''),
+                )
+                for (_, data), password in zip(valid, hashes)
+            ])
+            created.append((User, users))
+            if self.job.kind == 'doctor':
+                self.create_doctors(valid, users, created)
+            else:
+                created.append((Patient, Patient.objects.bulk_create([
+                    Patient(user_id=user.pk, **{k: v for k, v in data.items() if k not in USER_FIELDS})
+                    for (_, data), user in zip(valid, users)
+                ])))
+            self.job.rows_processed = batch[-1][0]
+            self.job.rows_imported += len(valid)
+            self.job.errors = self.job.errors + errors
+            self.job.save(update_fields=['rows_processed', 'rows_imported', 'errors', 'updated_at'])
+        # bulk_create sends no signals, so the rows are copied explicitly.
+        for model, rows in created:
+            sharding.after_commit(functools.partial(sharding.copy_to_shards, model, rows))
+
+    def create_doctors(self, valid, users, created):
+        specializations = self.resolve(Specialization, {data['specialization']['name'] for _, data in valid}, created)
+        qualifications = self.resolve(Qualification, {name for _, data in valid for name in data.get('qualifications', [])}, created)
+        doctors = Doctor.objects.bulk_create([
+            Doctor(
+                user_id=user.pk,
+                specialization=specializations[data['specialization']['name']],
+                **{k: v for k, v in data.items() if k not in USER_FIELDS + ('specialization', 'qualifications')},
+            )
+            for (_, data), user in zip(valid, users)
+        ])
+        Through = Doctor.qualifications.through
+        links = Through.objects.bulk_create([
+            Through(doctor_id=doctor.pk, qualification_id=qualifications[name].pk)
+            for (_, data), doctor in zip(valid, doctors)
+            for name in dict.fromkeys(data.get('qualifications', []))
+        ])
+        created += [(Doctor, doctors), (Through, links)]
+        changes.record('doctors', [doctor.pk for doctor in doctors])
+
+    @staticmethod
+    def resolve(model, names, created):
+        """Map names to rows of ``model``, creating the missing ones."""
+        found = {}
+        for instance in model.objects.filter(name__in=names).order_by('id'):
+            found.setdefault(instance.name, instance)
+        missing = [model(name=name) for name in sorted(names - set(found))]
+        created.append((model, model.objects.bulk_create(missing)))
+        for instance in created[-1][1]:
+            found[instance.name] = instance
+        return found
@@ -0,0 +1,173 @@
+import datetime
+
+from django.db.models import BigIntegerField, Case, Count, DateTimeField, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Substr
+from django.utils import timezone
+
+from . import sharding
+from .models import ArchivedMessage, Conversation, Message
+from .pagination import keyset_after
+
+PREVIEW_LENGTH = Conversation._meta.get_field('last_message_preview').max_length
+SIDES = ('doctor', 'patient')
+# Messages are ordered by (timestamp, id): ids are reserved in blocks per
+# process, so a higher id is not a newer message. Read markers and the last
+# message are positions in that order.
+NOTHING_READ = (datetime.datetime.min.replace(tzinfo=datetime.timezone.utc), 0)
+
+
+def read_marker(side):
+    return (f'{side}_last_read_at', f'{side}_last_read_id')
+
+
+def side_of(conversation, user):
+    """'doctor' or 'patient', whichever participant ``user`` is, else None."""
+    for side in SIDES:
+        if getattr(conversation, f'{side}_id') == user.pk:
+            return side
+    return None
+
+
+def conversations(message):
+    # A message is stored on its conversation's shard.
+    return sharding.using(Conversation.objects.filter(pk=message.conversation_id), message._state.db)
+
+
+def message_created(message):
+    """Make ``message`` the conversation's last message and count it as
+    unread for the other participant, in one UPDATE. Guarded on the message's
+    position, so concurrent senders cannot move the last message backwards."""
+    newer = Q(last_message_at__isnull=True) | keyset_after(('last_message_at', 'last_message_id'), (message.timestamp, message.pk), 'lt')
+
+    def latest(value, field):
+        return Case(When(newer, then=Value(value)), default=F(field), output_field=Conversation._meta.get_field(field))
+
+    conversations(message).update(
+        last_message_id=latest(message.pk, 'last_message_id'),
+        last_message_at=latest(message.timestamp, 'last_message_at'),
+        last_message_preview=latest(message.content[:PREVIEW_LENGTH], 'last_message_preview'),
+        last_sender_id=latest(message.sender_id, 'last_sender_id'),
+        updated_at=timezone.now(),
+        **{
+            f'{side}_unread': Case(When(**{side: message.sender_id}, then=F(f'{side}_unread')), default=F(f'{side}_unread') + 1)
+            for side in SIDES
+        },
+    )
+
+
+def message_changed(message):
+    conversations(message).update(
+        last_message_preview=Case(
+            When(last_message_id=message.pk, then=Value(message.content[:PREVIEW_LENGTH])),
+            default=F('last_message_preview'),
+        ),
+        updated_at=timezone.now(),
+    )
+
+
+def message_deleted(message):
+    """Take a deleted message out of the counts and, if it was the last one,
+    fall back to the newest remaining message, archived ones included."""
+    unread = {}
+    for side in SIDES:
+        unread_by_side = (
+            ~Q(**{side: message.sender_id})
+            & (Q(**{f'{side}_last_read_at__isnull': True}) | keyset_after(read_marker(side), (message.timestamp, message.pk), 'lt'))
+            & Q(**{f'{side}_unread__gt': 0})
+        )
+        unread[f'{side}_unread'] = Case(
+            When(unread_by_side, then=F(f'{side}_unread') - 1),
+            default=F(f'{side}_unread'),
+            output_field=Conversation._meta.get_field(f'{side}_unread'),
+        )
+    conversation = conversations(message)
+    conversation.update(updated_at=timezone.now(), **unread)
+    conversation.filter(last_message_id=message.pk).update(**last_message_fields())
+
+
+def last_message_fields():
+    """Update expressions recomputing the last message columns from the
+    conversation's newest hot message, or archived one if none is left."""
+    def latest(model, column):
+        rows = model.objects.filter(conversation=OuterRef('pk')).order_by('-timestamp', '-id')
+        return Subquery(rows.annotate(preview=Substr('content', 1, PREVIEW_LENGTH)).values(column)[:1])
+
+    columns = {'last_message_id': 'id', 'last_message_at': 'timestamp', 'last_message_preview': 'preview', 'last_sender_id': 'sender_id'}
+    fields = {
+        field: Coalesce(latest(Message, column), latest(ArchivedMessage, column), output_field=Conversation._meta.get_field(field))
+        for field, column in columns.items()
+    }
+    fields['last_message_preview'] = Coalesce(fields['last_message_preview'], Value(''))
+    return fields
+
+
+def unread_count(side, read_upto):
+    """The number of messages after ``read_upto``, a ``(timestamp, id)``
+    position, not sent by ``side``."""
+    messages = (
+        Message.objects
+        .filter(keyset_after(('timestamp', 'id'), read_upto), conversation=OuterRef('pk'))
+        .exclude(sender=OuterRef(side))
+        .order_by()
+        .values('conversation')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    return Coalesce(Subquery(messages), 0)
+
+
+def rebuild(conversations=None):
+    """Recompute the inbox state of ``conversations`` (default: all) from
+    their messages, e.g. after messages were written with ``bulk_create``,
+    which sends no signals."""
+    def read_upto(side):
+        at, read_id = read_marker(side)
+        return (
+            Coalesce(OuterRef(at), Value(NOTHING_READ[0]), output_field=DateTimeField()),
+            Coalesce(OuterRef(read_id), NOTHING_READ[1], output_field=BigIntegerField()),
+        )
+
+    fields = {**last_message_fields(), **{f'{side}_unread': unread_count(side, read_upto(side)) for side in SIDES}}
+    if conversations is None:
+        return sum(shard.update(**fields) for shard in sharding.scatter(Conversation.objects.all()))
+    return conversations.update(**fields)
+
+
+def position(conversation, message_id):
+    """The ``(timestamp, id)`` of message ``message_id`` of ``conversation``,
+    hot or archived, or None if it has no such message."""
+    for model in (Message, ArchivedMessage):
+        messages = sharding.using(model.objects.filter(conversation_id=conversation.pk, pk=message_id), conversation._state.db)
+        found = messages.values_list('timestamp', 'id').first()
+        if found is not None:
+            return found
+    return None
+
+
+def mark_read(conversation, side, message_id=None):
+    """Record that ``side`` has read ``conversation`` up to ``message_id``
+    (default: its last message) and recount what is still unread, in one
+    UPDATE. Read markers only move forward; an id that is not one of the
+    conversation's messages leaves them where they are."""
+    if message_id is None:
+        def read_upto(ref):
+            return (ref('last_message_at'), ref('last_message_id'))
+    else:
+        found = position(conversation, message_id)
+        if found is None:
+            conversation.refresh_from_db()
+            return conversation
+
+        def read_upto(ref):
+            return found
+
+    marker = read_marker(side)
+    behind = Q(**{f'{marker[0]}__isnull': True}) | keyset_after(marker, read_upto(F), 'lt')
+    conversations = Conversation.objects.filter(behind, pk=conversation.pk, last_message_at__isnull=False)
+    sharding.using(conversations, conversation._state.db).update(**{
+        **dict(zip(marker, read_upto(F))),
+        f'{side}_unread': unread_count(side, read_upto(OuterRef)),
+        'updated_at': timezone.now(),
+    })
+    conversation.refresh_from_db()
+    return conversation
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from baseapp import archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Move appointments, medical records and messages older than the cutoff "
+        "from the hot tables into their archive tables, optionally exporting "
+        "them to gzip-compressed monthly JSON lines files as well. Archived "
+        "rows stay readable through the API with ?archived=true."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=archive.archive_after_days(), help='Age in days (default: ARCHIVE_AFTER_DAYS).')
+        parser.add_argument('--model', action='append', dest='models', help='appointment, medicalrecord or message (repeatable; default all).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--export-dir', help='Also append the moved rows to <model>-<YYYY-MM>.jsonl.gz files here.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would move.')
+
+    def handle(self, *args, **options):
+        by_name = {model._meta.model_name: model for model in archive.ARCHIVES}
+        names = options['models'] or list(by_name)
+        unknown = sorted(set(names) - set(by_name))
+        if unknown:
+            raise CommandError(f"Unknown model(s): {', '.join(unknown)}")
+        exporter = archive.Exporter(options['export_dir']) if options['export_dir'] and not options['dry_run'] else None
+        for name in names:
+            model = by_name[name]
+            cutoff = archive.cutoff_for(model, options['older_than'])
+            count = archive.archive_rows(model, cutoff, options['batch_size'], exporter, options['dry_run'])
+            verb = 'Would archive' if options['dry_run'] else 'Archived'
+            self.stdout.write(f'{verb} {count} {name} row(s) older than {cutoff}')
@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from baseapp import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a deterministic data set into fresh test databases, drive every "
+        "baseapp route and report latency percentiles, throughput, query counts "
+        "and peak memory. Fails if a route regresses against the saved baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for the seeded data volumes.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--iterations', type=int, default=20, help='Timed requests per route.')
+        parser.add_argument('--warmup', type=int, default=2, help='Untimed requests per route before timing.')
+        parser.add_argument('--route', action='append', dest='routes', help='Only run this route name (repeatable).')
+        parser.add_argument('--baseline', default=str(Path(settings.BASE_DIR) / 'benchmarks' / 'baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline.')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fractional p95 latency growth.')
+
+    def handle(self, *args, **options):
+        names = benchmarks.route_names()
+        missing = sorted(set(names) - set(benchmarks.SCENARIOS))
+        if missing:
+            raise CommandError(f"No benchmark scenario for route(s): {', '.join(missing)}")
+        routes = options['routes'] or names
+        unknown = sorted(set(routes) - set(names))
+        if unknown:
+            raise CommandError(f"Unknown route(s): {', '.join(unknown)}")
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.stdout.write(benchmarks.HEADER)
+            results = benchmarks.run(
+                scale=options['scale'],
+                seed=options['seed'],
+                iterations=options['iterations'],
+                warmup=options['warmup'],
+                routes=routes,
+                stdout=self.stdout,
+            )
+        except benchmarks.ScenarioError as exc:
+            raise CommandError(str(exc))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+            baseline.update(results)
+            baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(f'Baseline saved to {baseline_path}')
+            return
+        if not baseline_path.exists():
+            self.stdout.write(f'No baseline at {baseline_path}; run with --save-baseline to record one.')
+            return
+        found = benchmarks.regressions(results, json.loads(baseline_path.read_text()), tolerance=options['tolerance'])
+        if found:
+            raise CommandError('Performance regressions:\n  ' + '\n  '.join(found))
+        self.stdout.write('No regressions against the baseline.')
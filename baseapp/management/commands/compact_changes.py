@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from baseapp import changes
+
+
+class Command(BaseCommand):
+    help = (
+        "Compact the change feed served by /sync/<collection>/: drop entries "
+        "superseded by a later change to the same object, then entries older "
+        "than the retention period. Clients whose cursor predates what is "
+        "left get a fresh snapshot. Run it periodically, e.g. daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=changes.retention_days(), help='Age in days (default: CHANGE_FEED_RETENTION_DAYS).')
+
+    def handle(self, *args, **options):
+        superseded, expired = changes.compact(options['older_than'])
+        self.stdout.write(f'Deleted {superseded} superseded and {expired} expired change(s)')
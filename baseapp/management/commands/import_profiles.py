@@ -0,0 +1,51 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from baseapp.importer import Importer, detect_format, read_rows
+from baseapp.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-import doctors or patients from a CSV or JSON lines file. Invalid "
+        "rows are skipped and reported; a failed import can be resumed with "
+        "--resume <job id> against the same file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=[kind for kind, _ in ImportJob.KIND_CHOICES])
+        parser.add_argument('path', help="Input file, or - for standard input.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Default: from the file extension.')
+        parser.add_argument('--batch-size', type=int, help='Rows per transaction (default: IMPORT_BATCH_SIZE).')
+        parser.add_argument('--workers', type=int, help='Password hashing processes (default: IMPORT_HASH_WORKERS).')
+        parser.add_argument('--resume', type=int, metavar='JOB_ID', help='Continue a failed import after its last committed row.')
+        parser.add_argument('--report', help='Write the per-row errors here as JSON lines.')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            job = ImportJob.objects.filter(pk=options['resume'], kind=options['kind']).first()
+            if job is None:
+                raise CommandError(f"No {options['kind']} import with id {options['resume']}")
+            if job.status == 'completed':
+                raise CommandError(f'Import {job.pk} already completed')
+            job.status = 'running'
+            job.save(update_fields=['status', 'updated_at'])
+        else:
+            job = ImportJob.objects.create(kind=options['kind'], source=options['path'])
+        self.stdout.write(f'Import {job.pk}: starting after row {job.rows_processed}')
+
+        fmt = options['format'] or detect_format(options['path'])
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8-sig', newline='')
+        try:
+            Importer(job, batch_size=options['batch_size'], workers=options['workers']).run(read_rows(stream, fmt))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        if options['report']:
+            with open(options['report'], 'w', encoding='utf-8') as report:
+                for error in job.errors:
+                    report.write(json.dumps(error) + '\n')
+        self.stdout.write(f'Import {job.pk}: {job.rows_imported} imported, {len(job.errors)} rejected, {job.rows_processed} rows read')
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from baseapp import sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the reference tables (users, doctors, patients, specializations, "
+        "qualifications) to every shard in DATABASE_SHARDS, then move "
+        "appointments, medical records, conversations and messages that are "
+        "not on the shard their key maps to. Run it after adding or removing "
+        "a shard; it can be repeated after an interruption."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drain', action='append', default=[], help='A database alias no longer in DATABASE_SHARDS to move rows off (repeatable).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would move.')
+
+    def handle(self, *args, **options):
+        unknown = sorted(set(options['drain']) - set(settings.DATABASES))
+        if unknown:
+            raise CommandError(f"Unknown database(s): {', '.join(unknown)}")
+        if not options['dry_run']:
+            sharding.sync_reference_tables(options['batch_size'])
+        moved = sharding.rebalance(options['drain'], options['batch_size'], options['dry_run'])
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        for label, count in moved.items():
+            self.stdout.write(f'{verb} {count} {label} row(s)')
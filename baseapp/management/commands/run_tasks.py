@@ -0,0 +1,57 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from baseapp import tasks
+
+
+def work(options):
+    worker = tasks.Worker(options['batch_size'], options['poll_interval'], options['burst'], options['max_tasks'])
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    try:
+        return worker.run()
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background tasks queued with baseapp.tasks.enqueue. Failed tasks "
+        "are retried with exponential backoff; SIGTERM lets the tasks in hand "
+        "finish before exiting."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to start (default 1).')
+        parser.add_argument('--batch-size', type=int, default=10, help='Tasks claimed per query.')
+        parser.add_argument('--poll-interval', type=float, help='Seconds to wait when the queue is empty (default: TASK_POLL_INTERVAL).')
+        parser.add_argument('--burst', action='store_true', help='Exit once no task is due.')
+        parser.add_argument('--max-tasks', type=int, help='Exit after running this many tasks (per process).')
+
+    def handle(self, *args, **options):
+        pruned = tasks.prune()
+        if pruned:
+            self.stdout.write(f'Pruned {pruned} finished task(s)')
+        if options['processes'] <= 1:
+            ran = work(options)
+            self.stdout.write(f'Ran {ran} task(s)')
+            return
+        # Children must not share the parent's database connections.
+        connections.close_all()
+        processes = [multiprocessing.Process(target=work, args=(options,), daemon=False) for _ in range(options['processes'])]
+        for process in processes:
+            process.start()
+
+        def forward(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for process in processes:
+            process.join()
+        self.stdout.write(f'Stopped {len(processes)} worker process(es)')
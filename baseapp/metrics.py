@@ -0,0 +1,150 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+class RequestStats:
+    def __init__(self, log_queries=False, parent=None):
+        self.parent = parent
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.log_queries = log_queries
+        self.statements = {}
+
+    def add_query(self, sql, params, duration):
+        self.queries += 1
+        self.sql_time += duration
+        if self.log_queries:
+            try:
+                key = (sql, repr(params))
+            except Exception:
+                key = (sql, None)
+            self.statements[key] = self.statements.get(key, 0) + 1
+        if self.parent is not None:
+            self.parent.add_query(sql, params, duration)
+
+
+_current = contextvars.ContextVar('baseapp_request_stats', default=None)
+
+
+def current_stats():
+    return _current.get()
+
+
+@contextmanager
+def collect(log_queries=False):
+    # Nested collectors (e.g. a benchmark around the middleware) also see
+    # the queries counted by the inner one.
+    stats = RequestStats(log_queries, parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection when it is
+    opened. It reads the stats from a context variable rather than holding
+    them, so queries made on worker threads (async views, sync views under
+    ASGI) land in the right request."""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(sql, params, time.perf_counter() - start)
+
+
+@contextmanager
+def serializer_timer():
+    # Nested serializers run inside their parent's timer; only the outermost
+    # one is counted so a payload is not timed once per nesting level.
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    stats.serializer_depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serializer_depth -= 1
+        if not stats.serializer_depth:
+            stats.serializer_time += time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, route, value):
+        series = self.series.get(route)
+        if series is None:
+            series = self.series[route] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for route, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{route="{route}",le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{route="{route}"}} {total:.6f}')
+            lines.append(f'{self.name}_count{{route="{route}"}} {count}')
+        return lines
+
+
+class Registry:
+    """Per-process request metrics, labelled by URL route name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        seconds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+        self.latency = Histogram('baseapp_request_duration_seconds', 'Time from request to response.', seconds)
+        self.queries = Histogram('baseapp_request_sql_queries', 'SQL queries run per request.', (0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+        self.sql_time = Histogram('baseapp_request_sql_duration_seconds', 'Time spent in SQL per request.', seconds)
+        self.serializer_time = Histogram('baseapp_request_serializer_duration_seconds', 'Time spent serializing per request.', seconds)
+        self.response_size = Histogram('baseapp_response_size_bytes', 'Response body size.', (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+        self.responses = {}
+
+    def observe(self, route, status_code, duration, stats, size):
+        with self._lock:
+            self.latency.observe(route, duration)
+            if stats is not None:
+                self.queries.observe(route, stats.queries)
+                self.sql_time.observe(route, stats.sql_time)
+                self.serializer_time.observe(route, stats.serializer_time)
+            if size is not None:
+                self.response_size.observe(route, size)
+            key = (route, status_code)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def render(self, extra_lines=()):
+        with self._lock:
+            lines = ['# HELP baseapp_responses_total Responses by route and status.', '# TYPE baseapp_responses_total counter']
+            for (route, status_code), count in sorted(self.responses.items()):
+                lines.append(f'baseapp_responses_total{{route="{route}",status="{status_code}"}} {count}')
+            for histogram in (self.latency, self.queries, self.sql_time, self.serializer_time, self.response_size):
+                lines.extend(histogram.render())
+        lines.extend(extra_lines)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
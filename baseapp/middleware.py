@@ -0,0 +1,73 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger('baseapp.metrics')
+
+
+def _route(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.url_name if match is not None and match.url_name else 'unmatched'
+
+
+def _size(response):
+    if response.streaming:
+        return None
+    return len(response.content)
+
+
+class MetricsMiddleware:
+    """Records latency, SQL queries and time, serializer time and response
+    size per route into ``baseapp.metrics.registry``.
+
+    With ``METRICS_LOG_QUERIES`` on it also logs statements that repeat
+    within one request: the same SQL with different parameters (a likely
+    N+1) or with the same parameters (a duplicate query). Work done while a
+    streaming response is consumed is not counted.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.log_queries = getattr(settings, 'METRICS_LOG_QUERIES', False)
+        self.repeat_threshold = getattr(settings, 'METRICS_REPEAT_THRESHOLD', 5)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with metrics.collect(self.log_queries) as stats:
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with metrics.collect(self.log_queries) as stats:
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    def record(self, request, response, duration, stats):
+        route = _route(request)
+        metrics.registry.observe(route, response.status_code, duration, stats, _size(response))
+        if stats.log_queries:
+            self.log_repeats(route, stats)
+
+    def log_repeats(self, route, stats):
+        templates = {}
+        for (sql, params), count in stats.statements.items():
+            templates[sql] = templates.get(sql, 0) + count
+            if count > 1:
+                logger.warning('Duplicate query on %s (%d times): %s', route, count, sql)
+        for sql, count in templates.items():
+            if count >= self.repeat_threshold:
+                logger.warning('Possible N+1 on %s (%d times): %s', route, count, sql)
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.3 on 2026-10-18 11:46
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def cancel_duplicate_bookings(apps, schema_editor):
+    # Nothing stopped double bookings before these constraints: keep the
+    # earliest active appointment of each doctor's and patient's slot and
+    # cancel the others, so that the constraints can be added.
+    Appointment = apps.get_model('baseapp', 'Appointment')
+    active = Appointment.objects.using(schema_editor.connection.alias).filter(status__in=['pending', 'confirmed'])
+    for owner in ('doctor', 'patient'):
+        duplicates = active.values(owner, 'date', 'time').annotate(first=Min('id'), count=Count('id')).filter(count__gt=1)
+        for slot in duplicates:
+            active.filter(**{owner: slot[owner], 'date': slot['date'], 'time': slot['time']}).exclude(pk=slot['first']).update(status='cancelled')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0002_doctor_available'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_duplicate_bookings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'confirmed'])), fields=('doctor', 'date', 'time'), name='unique_active_doctor_slot'),
+        ),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'confirmed'])), fields=('patient', 'date', 'time'), name='unique_active_patient_slot'),
+        ),
+    ]
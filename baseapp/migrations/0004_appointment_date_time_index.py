@@ -0,0 +1,17 @@
+# Generated by Django 5.0.3 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0003_appointment_slot_constraints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['date', 'time', 'id'], name='appointment_date_time_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.3 on 2026-10-18 11:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0004_appointment_date_time_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='qualification',
+            options={'ordering': ['name', 'id']},
+        ),
+    ]
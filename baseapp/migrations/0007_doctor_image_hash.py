@@ -0,0 +1,34 @@
+# Generated by Django 5.0.3 on 2026-10-18 11:58
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_existing_images(apps, schema_editor):
+    Doctor = apps.get_model('baseapp', 'Doctor')
+    for doctor in Doctor.objects.exclude(image='').exclude(image__isnull=True).iterator():
+        storage = doctor.image.storage
+        if not storage.exists(doctor.image.name):
+            continue
+        digest = hashlib.sha256()
+        with storage.open(doctor.image.name) as file:
+            for chunk in file.chunks():
+                digest.update(chunk)
+        Doctor.objects.filter(pk=doctor.pk).update(image_hash=digest.hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0006_message_conversation_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doctor',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(hash_existing_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.3 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+# The full-text indexes live outside the model state: the ORM never reads
+# or writes them directly, see baseapp.fulltext. On SQLite a migration that
+# rebuilds baseapp_medicalrecord drops the triggers and must recreate them.
+POSTGRESQL_FORWARD = [
+    "ALTER TABLE baseapp_medicalrecord ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('english', description)) STORED",
+    "CREATE INDEX medicalrecord_search_vector_idx ON baseapp_medicalrecord USING GIN (search_vector)",
+]
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS medicalrecord_search_vector_idx",
+    "ALTER TABLE baseapp_medicalrecord DROP COLUMN IF EXISTS search_vector",
+]
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE baseapp_medicalrecord_fts USING fts5("
+    "description, content='baseapp_medicalrecord', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER baseapp_medicalrecord_fts_insert AFTER INSERT ON baseapp_medicalrecord BEGIN "
+    "INSERT INTO baseapp_medicalrecord_fts(rowid, description) VALUES (new.id, new.description); END",
+    "CREATE TRIGGER baseapp_medicalrecord_fts_delete AFTER DELETE ON baseapp_medicalrecord BEGIN "
+    "INSERT INTO baseapp_medicalrecord_fts(baseapp_medicalrecord_fts, rowid, description) VALUES ('delete', old.id, old.description); END",
+    "CREATE TRIGGER baseapp_medicalrecord_fts_update AFTER UPDATE OF description ON baseapp_medicalrecord BEGIN "
+    "INSERT INTO baseapp_medicalrecord_fts(baseapp_medicalrecord_fts, rowid, description) VALUES ('delete', old.id, old.description); "
+    "INSERT INTO baseapp_medicalrecord_fts(rowid, description) VALUES (new.id, new.description); END",
+    "INSERT INTO baseapp_medicalrecord_fts(baseapp_medicalrecord_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS baseapp_medicalrecord_fts_insert",
+    "DROP TRIGGER IF EXISTS baseapp_medicalrecord_fts_delete",
+    "DROP TRIGGER IF EXISTS baseapp_medicalrecord_fts_update",
+    "DROP TABLE IF EXISTS baseapp_medicalrecord_fts",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0007_doctor_image_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='medicalrecord',
+            index=models.Index(fields=['patient', 'date', 'id'], name='medicalrecord_patient_date_idx'),
+        ),
+        migrations.RunPython(
+            run_for_vendor({'postgresql': POSTGRESQL_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            run_for_vendor({'postgresql': POSTGRESQL_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.0.3 on 2026-10-18 12:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.functions import Substr
+
+
+def backfill_inbox(apps, schema_editor):
+    # There were no read receipts before this migration, so existing
+    # messages start out read and unread counts at zero.
+    Conversation = apps.get_model('baseapp', 'Conversation')
+    Message = apps.get_model('baseapp', 'Message')
+    latest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-timestamp', '-id').annotate(preview=Substr('content', 1, 200))
+    Conversation.objects.filter(Exists(latest)).update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+        last_message_preview=Subquery(latest.values('preview')[:1]),
+        last_sender_id=Subquery(latest.values('sender_id')[:1]),
+        doctor_last_read_id=Subquery(latest.values('id')[:1]),
+        patient_last_read_id=Subquery(latest.values('id')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0012_importjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='doctor_last_read_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='doctor_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='patient_last_read_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='patient_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['doctor', 'last_message_at', 'id'], name='conversation_doctor_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['patient', 'last_message_at', 'id'], name='conversation_patient_inbox_idx'),
+        ),
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
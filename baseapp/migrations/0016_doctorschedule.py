@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 12:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0015_shardsequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('appointments', models.JSONField(blank=True, default=list)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='baseapp.doctor')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='doctorschedule',
+            constraint=models.UniqueConstraint(fields=('doctor', 'date'), name='unique_doctor_schedule_day'),
+        ),
+    ]
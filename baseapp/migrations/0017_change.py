@@ -0,0 +1,26 @@
+# Generated by Django 5.0.3 on 2026-10-18 12:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0016_doctorschedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('collection', models.CharField(max_length=50)),
+                ('object_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['collection', 'seq'], name='change_collection_seq_idx'), models.Index(fields=['collection', 'object_id', 'seq'], name='change_object_idx'), models.Index(fields=['created_at'], name='change_created_at_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:45
+
+import itertools
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def claim_active_slots(apps, schema_editor):
+    # Each shard claims the slots of its own active appointments on the
+    # default database, which is migrated first. A patient double booked
+    # across shards keeps the appointment that claimed the slot first; as in
+    # 0003, the later one is cancelled, since its next save would fail on the
+    # claim. Its stored day view is dropped, to be rebuilt on the next read,
+    # and the change feed is told.
+    alias = schema_editor.connection.alias
+    if alias not in getattr(settings, 'DATABASE_SHARDS', [DEFAULT_DB_ALIAS]):
+        return
+    Appointment = apps.get_model('baseapp', 'Appointment')
+    PatientSlotClaim = apps.get_model('baseapp', 'PatientSlotClaim')
+    active = Appointment.objects.using(alias).filter(status__in=['pending', 'confirmed']).order_by('id').values_list('id', 'patient_id', 'date', 'time')
+    claims = PatientSlotClaim.objects.using(DEFAULT_DB_ALIAS)
+    unclaimed = []
+    rows = active.iterator(chunk_size=1000)
+    while batch := list(itertools.islice(rows, 1000)):
+        claims.bulk_create([PatientSlotClaim(appointment_id=pk, patient_id=patient_id, date=date, time=time) for pk, patient_id, date, time in batch], ignore_conflicts=True)
+        held = set(claims.filter(appointment_id__in=[row[0] for row in batch]).values_list('appointment_id', flat=True))
+        unclaimed.extend(row[0] for row in batch if row[0] not in held)
+    if not unclaimed:
+        return
+    cancelled = Appointment.objects.using(alias).filter(pk__in=unclaimed)
+    days = set(cancelled.values_list('doctor_id', 'date'))
+    cancelled.update(status='cancelled', version=F('version') + 1, updated_at=timezone.now())
+    schedules = apps.get_model('baseapp', 'DoctorSchedule').objects.using(alias)
+    for doctor_id, date in days:
+        schedules.filter(doctor_id=doctor_id, date=date).delete()
+    Change = apps.get_model('baseapp', 'Change')
+    Change.objects.using(DEFAULT_DB_ALIAS).bulk_create([Change(collection='appointments', object_id=pk) for pk in unclaimed])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0017_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSlotClaim',
+            fields=[
+                ('appointment_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('time', models.TimeField()),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='baseapp.patient')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='patientslotclaim',
+            constraint=models.UniqueConstraint(fields=('patient', 'date', 'time'), name='unique_patient_slot_claim'),
+        ),
+        migrations.RunPython(claim_active_slots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:35
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def date_read_markers(apps, schema_editor):
+    # Until now message ids were reserved in send order, so a marker covered
+    # the messages up to its id; the newest of those dates it. Hot messages
+    # are all newer than archived ones.
+    alias = schema_editor.connection.alias
+    if alias not in getattr(settings, 'DATABASE_SHARDS', [DEFAULT_DB_ALIAS]):
+        return
+    Conversation = apps.get_model('baseapp', 'Conversation')
+
+    def newest_read(model, side):
+        rows = apps.get_model('baseapp', model).objects.filter(conversation=OuterRef('pk'), id__lte=OuterRef(f'{side}_last_read_id'))
+        return Subquery(rows.order_by().values('conversation').annotate(last=Max('timestamp')).values('last'))
+
+    for side in ('doctor', 'patient'):
+        Conversation.objects.using(alias).filter(**{f'{side}_last_read_id__isnull': False}).update(**{
+            f'{side}_last_read_at': Coalesce(newest_read('Message', side), newest_read('ArchivedMessage', side)),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('baseapp', '0018_patientslotclaim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='doctor_last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='patient_last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(date_read_markers, migrations.RunPython.noop),
+    ]
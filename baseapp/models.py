@@ -7,6 +7,9 @@ from django.utils import timezone
 class Qualification(models.Model):
     name = models.CharField(max_length=100)
 
+    class Meta:
+        ordering = ['name', 'id']
+
     def __str__(self):
         return self.name
 
@@ -16,6 +19,36 @@ class Specialization(models.Model):
     def __str__(self):
         return self.name
 
+class DoctorQuerySet(models.QuerySet):
+    def with_related(self):
+        return self.select_related('specialization').prefetch_related('qualifications')
+
+class ShardedQuerySet(models.QuerySet):
+    """For models spread over DATABASE_SHARDS (see baseapp.sharding): rows
+    created without an explicit ``using()`` go to the shard of their key."""
+
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        # QuerySet.create routes before the instance exists; save() routes
+        # with it as a hint.
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True)
+        return obj
+
+    def bulk_create(self, objs, *args, **kwargs):
+        from . import sharding
+        if not sharding.is_sharded():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        sharding.assign_ids(objs)
+        if self._db is not None:
+            return super().bulk_create(objs, *args, **kwargs)
+        for alias, shard_objs in sharding.group_by_shard(objs).items():
+            self.using(alias).bulk_create(shard_objs, *args, **kwargs)
+        return objs
+
 class Doctor(models.Model):
 
     def get_qualifications_display(self):
@@ -29,7 +62,24 @@ class Doctor(models.Model):
     qualifications = models.ManyToManyField(Qualification)
     years_of_experience = models.PositiveIntegerField()
     image = models.ImageField(upload_to='doctors/', null=True, blank=True)
+    image_hash = models.CharField(max_length=64, blank=True, default='', db_index=True, editable=False)
     available=models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = DoctorQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored image name, so that a replaced image is hashed again.
+        if 'image' in field_names and values[field_names.index('image')] is not models.DEFERRED:
+            instance._stored_image = values[field_names.index('image')] or ''
+        return instance
+
+    @property
+    def image_variants(self):
+        from .images import variant_urls
+        return variant_urls(self.image_hash)
 
     def __str__(self):
         return self.name
@@ -48,47 +98,124 @@ class Patient(models.Model):
     email = models.EmailField(null=True)
     age = models.PositiveIntegerField()
     blood_group = models.CharField(max_length=3)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
 
 
 class Appointment(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('confirmed', 'Confirmed'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    ACTIVE_STATUSES = ('pending', 'confirmed')
+
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE)
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     date = models.DateField()
     time = models.TimeField()
-    status = models.CharField(max_length=20, choices=[('pending', 'Pending'), ('confirmed', 'Confirmed')])
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    # Bumped by every write, so clients can detect concurrent changes.
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
 
-    def clean(self):
-        same_doctor_patients = Appointment.objects.filter(doctor=self.doctor, patient__in=[self.patient, self.patient.user])
-        same_patient_doctors = Appointment.objects.filter(patient=self.patient, doctor__in=[self.doctor, self.doctor.user])
-        conflicting_appointments = same_doctor_patients | same_patient_doctors
-        conflicting_appointments = conflicting_appointments.exclude(pk=self.pk).filter(date=self.date, time=self.time)
-        if conflicting_appointments.exists():
-            raise ValidationError("The appointment date and time conflicts with another appointment for the same doctor and patient.")
+    objects = ShardedQuerySet.as_manager()
 
-        if not self.doctor.user.is_active or not self.patient.user.is_active:
-            raise ValidationError("The doctor or patient has been deleted or changed.")
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['doctor', 'date', 'time'],
+                condition=models.Q(status__in=['pending', 'confirmed']),
+                name='unique_active_doctor_slot',
+            ),
+            models.UniqueConstraint(
+                fields=['patient', 'date', 'time'],
+                condition=models.Q(status__in=['pending', 'confirmed']),
+                name='unique_active_patient_slot',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'time', 'id'], name='appointment_date_time_idx'),
+        ]
 
-        if self.date < timezone.now().date():
-            raise ValidationError("The appointment date is in the past.")
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+
+    def clean(self):
+        from .booking import validate_appointment
+        validate_appointment(self.doctor, self.patient, self.date, self.time, exclude_pk=self.pk)
 
     def __str__(self):
         return f"{self.doctor.user.username} - {self.patient.user.username} - {self.date} - {self.time}"
 
+class PatientSlotClaim(models.Model):
+    """The slot an active appointment holds in its patient's day. Appointments
+    are sharded by doctor, so their own constraint on the patient's slot only
+    covers one shard; these rows stay on the default database and cover all
+    of them. Kept current by the appointment signals."""
+    appointment_id = models.BigIntegerField(primary_key=True)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='+')
+    date = models.DateField()
+    time = models.TimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'date', 'time'], name='unique_patient_slot_claim'),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_id} - {self.date} - {self.time} ({self.appointment_id})"
+
 class MedicalRecord(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE)
     description = models.TextField()
     date = models.DateTimeField(auto_now_add=True)
 
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'date', 'id'], name='medicalrecord_patient_date_idx'),
+        ]
+
     def __str__(self):
         return f"{self.patient.user.username} - {self.doctor.user.username} - {self.date}"
 
 class Conversation(models.Model):
     doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='doctor_conversations')
     patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='patient_conversations')
+    # Also bumped when one of its messages is saved or deleted.
+    updated_at = models.DateTimeField(auto_now=True)
+    # Inbox state, kept current by the Message signals and read receipts
+    # (see baseapp.inbox) so an inbox never has to scan messages.
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=200, blank=True, default='')
+    last_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    doctor_unread = models.PositiveIntegerField(default=0)
+    patient_unread = models.PositiveIntegerField(default=0)
+    # Read markers: the id and timestamp of the last message read. Messages
+    # are ordered by (timestamp, id); ids alone are not in send order.
+    doctor_last_read_id = models.BigIntegerField(null=True, blank=True)
+    doctor_last_read_at = models.DateTimeField(null=True, blank=True)
+    patient_last_read_id = models.BigIntegerField(null=True, blank=True)
+    patient_last_read_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'last_message_at', 'id'], name='conversation_doctor_inbox_idx'),
+            models.Index(fields=['patient', 'last_message_at', 'id'], name='conversation_patient_inbox_idx'),
+        ]
 
     def __str__(self):
         return f"{self.doctor.username} - {self.patient.username}"
@@ -99,7 +226,170 @@ class Message(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conversation_time_idx'),
+        ]
+
     def __str__(self):
         return f"{self.sender.username} - {self.conversation} - {self.timestamp}"
 
 
+
+
+class DoctorSchedule(models.Model):
+    """A doctor's appointments on one day, serialized (see
+    baseapp.schedules). Kept current by the appointment signals, so a day
+    view is one key lookup."""
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='+')
+    date = models.DateField()
+    appointments = models.JSONField(default=list, blank=True)
+    # Bumped by every refresh; part of the schedule's ETag.
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'date'], name='unique_doctor_schedule_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor_id} - {self.date} (v{self.version})"
+
+
+# Cold copies of old rows, moved out of the hot tables by the
+# archive_records command (see baseapp.archive). Rows keep their original
+# primary keys and column names so the same serializers read both.
+
+class ArchivedAppointment(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='+')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='+')
+    date = models.DateField()
+    time = models.TimeField()
+    status = models.CharField(max_length=20)
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'time', 'id'], name='archived_appt_date_time_idx'),
+        ]
+
+
+class ArchivedMedicalRecord(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='+')
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='+')
+    description = models.TextField()
+    date = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'date', 'id'], name='archived_record_patient_idx'),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='+')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='archived_message_conv_idx'),
+        ]
+
+
+class ImportJob(models.Model):
+    """Progress of a bulk doctor or patient import. Rows up to
+    ``rows_processed`` are committed, so a failed job resumes from there."""
+    KIND_CHOICES = [('doctor', 'Doctor'), ('patient', 'Patient')]
+    STATUS_CHOICES = [('running', 'Running'), ('failed', 'Failed'), ('completed', 'Completed')]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    source = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='running')
+    rows_processed = models.PositiveIntegerField(default=0)
+    rows_imported = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} import {self.pk} ({self.status})"
+
+class Task(models.Model):
+    """A unit of background work, run by the ``run_tasks`` workers (see
+    baseapp.tasks). At most one queued or running task may hold a given
+    ``dedup_key``."""
+    STATUS_CHOICES = [('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')]
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    name = models.CharField(max_length=200)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    dedup_key = models.CharField(max_length=200, null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    lease = models.CharField(max_length=32, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at', 'id'], name='task_status_run_at_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['dedup_key'], condition=models.Q(status__in=['queued', 'running']), name='task_active_dedup_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.pk} ({self.status})"
+
+class ShardSequence(models.Model):
+    """Next free primary key of a sharded model (see baseapp.sharding). Kept
+    on the default database and handed out in blocks, so ids stay unique
+    across shards."""
+    name = models.CharField(max_length=100, primary_key=True)
+    next_id = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name} -> {self.next_id}"
+
+class Change(models.Model):
+    """An entry of the change feed (see baseapp.changes): an object of a
+    synced collection was created, changed or deleted. ``seq`` orders the
+    feed; the object's data is read when a client syncs."""
+    seq = models.BigAutoField(primary_key=True)
+    collection = models.CharField(max_length=50)
+    object_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'seq'], name='change_collection_seq_idx'),
+            models.Index(fields=['collection', 'object_id', 'seq'], name='change_object_idx'),
+            models.Index(fields=['created_at'], name='change_created_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.seq}: {self.collection} {self.object_id}"
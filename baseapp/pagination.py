@@ -0,0 +1,121 @@
+import base64
+import heapq
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class DoctorCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class KeysetPagination:
+    """Newest-first pages over ``fields`` (a unique key, e.g. timestamp, id).
+
+    ``?before=<cursor>`` pages back into older rows and ``?after=<cursor>``
+    fetches rows newer than the cursor, so both work as a single range scan
+    on an index over ``fields`` no matter how deep the page is. Pages may
+    hold model instances or ``values()`` rows.
+    """
+    fields = ('timestamp', 'id')
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def encode_cursor(self, item):
+        values = [item[f] if isinstance(item, dict) else getattr(item, f) for f in self.fields]
+        payload = json.dumps([v.isoformat() if hasattr(v, 'isoformat') else v for v in values])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, model, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return [model._meta.get_field(f).to_python(v) for f, v in zip(self.fields, values, strict=True)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def key(self, item):
+        return tuple(item[f] if isinstance(item, dict) else getattr(item, f) for f in self.fields)
+
+    def paginate_queryset(self, queryset, request):
+        """Return one page of ``queryset``, or of several querysets over the
+        same fields (e.g. a hot and an archive table) read as one."""
+        querysets = list(queryset) if isinstance(queryset, (list, tuple)) else [queryset]
+        model = querysets[0].model
+        size = self.page_size
+        if request.query_params.get('page_size', '').isdigit():
+            size = min(max(int(request.query_params['page_size']), 1), self.max_page_size)
+        before = request.query_params.get('before')
+        self.after = request.query_params.get('after')
+        if self.after:
+            values = self.decode_cursor(model, self.after)
+            rows = self.merge([qs.filter(keyset_after(self.fields, values)).order_by(*self.fields)[:size + 1] for qs in querysets], size + 1)
+            self.has_older = True
+            page = rows[:size][::-1]
+        else:
+            if before:
+                values = self.decode_cursor(model, before)
+                querysets = [qs.filter(keyset_after(self.fields, values, lookup='lt')) for qs in querysets]
+            rows = self.merge([qs.order_by(*('-' + f for f in self.fields))[:size + 1] for qs in querysets], size + 1, reverse=True)
+            self.has_older = len(rows) > size
+            page = rows[:size]
+        self.page = page
+        return page
+
+    def merge(self, querysets, limit, reverse=False):
+        if len(querysets) == 1:
+            return list(querysets[0])
+        return list(heapq.merge(*querysets, key=self.key, reverse=reverse))[:limit]
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'before': self.encode_cursor(self.page[-1]) if self.page and self.has_older else None,
+            'after': self.encode_cursor(self.page[0]) if self.page else self.after,
+        })
+
+
+class MedicalRecordPagination(KeysetPagination):
+    fields = ('date', 'id')
+
+
+class InboxPagination(KeysetPagination):
+    fields = ('last_message_at', 'id')
+
+
+def keyset_chunks(queryset, fields, chunk_size=500):
+    """Yield ``queryset`` in chunks ordered by ``fields``, each chunk fetched
+    with a ``WHERE (fields) > (last row)`` filter instead of an OFFSET.
+
+    Works with model instances as well as ``values()`` rows, as long as the
+    rows carry every field in ``fields``.
+    """
+    queryset = queryset.order_by(*fields)
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(keyset_after(fields, [last[f] if isinstance(last, dict) else getattr(last, f) for f in fields]))
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+
+
+def keyset_after(fields, values, lookup='gt'):
+    """``(fields) > (values)`` as a Q object; ``lookup='lt'`` flips it."""
+    condition = Q()
+    for i in reversed(range(len(fields))):
+        equal = {f: v for f, v in zip(fields[:i], values[:i])}
+        condition = Q(**equal, **{f'{fields[i]}__{lookup}': values[i]}) | condition
+    return condition
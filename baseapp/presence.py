@@ -0,0 +1,201 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from django.utils import timezone
+
+from . import sharding
+from .cache import doctor_cache
+from .models import Doctor
+from .search import search_index
+
+
+class DoctorPresence:
+    """Live doctor availability, fed by heartbeats and kept in Django's cache
+    framework so that workers share it. Entries hold ``(available,
+    expires_at)``: staying on duty takes a heartbeat every ``ttl()`` seconds,
+    going off duty takes effect at once. Doctors without an entry fall back
+    to the Doctor.available column, which ``flush`` brings up to date in
+    batches; readers never need it otherwise. The cache must be shared by
+    every process (see the baseapp.E001 deploy check).
+
+    The doctors whose live availability may differ from the column are
+    tracked in the cache too: those whose availability changed since the
+    last flush, and those on duty, who go off duty by expiring. Filters and
+    flushes only look at them. The cache has no sets, so they are kept as a
+    log of slots, each holding one doctor id: ``incr`` hands out slots
+    without a race, and ``flush`` moves the start past the slots it read."""
+
+    key_prefix = 'doctor-presence'
+    version_key = 'doctor-presence:version'
+    tracked_start_key = 'doctor-presence:tracked:start'
+    tracked_end_key = 'doctor-presence:tracked:end'
+
+    def __init__(self, alias=None, retention=None):
+        self.alias = alias or getattr(settings, 'PRESENCE_CACHE_ALIAS', 'default')
+        # Kept well past expiry, so that ``flush`` still sees the doctor go.
+        self.retention = retention or getattr(settings, 'PRESENCE_RETENTION', 24 * 60 * 60)
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def ttl(self):
+        # An on-duty doctor who has not sent a heartbeat for this long is
+        # taken to be off duty.
+        return getattr(settings, 'PRESENCE_TTL', 90)
+
+    def flush_interval(self):
+        return getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 30)
+
+    def key(self, doctor_id):
+        return f'{self.key_prefix}:{doctor_id}'
+
+    @staticmethod
+    def live(entry, now):
+        available, expires_at = entry
+        return available and expires_at > now
+
+    def version(self):
+        """Moves whenever a doctor goes on or off duty; part of the doctor
+        list's ETag."""
+        version = self.shared.get(self.version_key)
+        if version is None:
+            # As in DoctorCache: an evicted key must not restart at an old
+            # number, or ETags issued before would match again.
+            self.shared.add(self.version_key, time.time_ns(), None)
+            version = self.shared.get(self.version_key)
+        return version
+
+    def bump_version(self):
+        try:
+            self.shared.incr(self.version_key)
+        except ValueError:
+            self.shared.add(self.version_key, time.time_ns(), None)
+
+    def doctor_for(self, user):
+        """The id of ``user``'s doctor profile, or None; cached, as it is
+        looked up on every heartbeat."""
+        key = f'{self.key_prefix}:user:{user.pk}'
+        doctor_id = self.shared.get(key)
+        if doctor_id is None:
+            doctor_id = Doctor.objects.filter(user_id=user.pk).values_list('pk', flat=True).first()
+            if doctor_id is not None:
+                self.shared.set(key, doctor_id, self.retention)
+        return doctor_id
+
+    def heartbeat(self, doctor_id, available=True):
+        """Record that the doctor is on (or off) duty as of now. Returns
+        whether their live availability changed."""
+        now = time.time()
+        key = self.key(doctor_id)
+        previous = self.shared.get(key)
+        self.shared.set(key, (available, now + self.ttl()), self.retention)
+        if previous is not None and self.live(previous, now) == available:
+            return False
+        self.track([doctor_id])
+        self.bump_version()
+        return True
+
+    def slot_key(self, slot):
+        return f'{self.key_prefix}:tracked:{slot}'
+
+    def track(self, doctor_ids):
+        """Add ``doctor_ids`` to the tracked doctors, in two cache round
+        trips."""
+        if not doctor_ids:
+            return
+        try:
+            end = self.shared.incr(self.tracked_end_key, len(doctor_ids))
+        except ValueError:
+            self.shared.add(self.tracked_end_key, 0, None)
+            end = self.shared.incr(self.tracked_end_key, len(doctor_ids))
+        first = end - len(doctor_ids) + 1
+        self.shared.set_many({self.slot_key(first + i): pk for i, pk in enumerate(doctor_ids)}, self.retention)
+
+    def tracked(self):
+        """``(doctor ids, end)``: the tracked doctors, and the last slot
+        read, up to which ``flush`` may drop them."""
+        start = self.shared.get(self.tracked_start_key, 1)
+        end = self.shared.get(self.tracked_end_key, 0)
+        if end < start:
+            return set(), end
+        return set(self.shared.get_many([self.slot_key(slot) for slot in range(start, end + 1)]).values()), end
+
+    def is_available(self, doctor_id, stored):
+        entry = self.shared.get(self.key(doctor_id))
+        return stored if entry is None else self.live(entry, time.time())
+
+    def live_values(self, stored):
+        """``{pk: live availability}`` for a ``{pk: Doctor.available}``
+        mapping, in one cache round trip."""
+        entries = self.shared.get_many([self.key(pk) for pk in stored])
+        now = time.time()
+        return {
+            pk: available if self.key(pk) not in entries else self.live(entries[self.key(pk)], now)
+            for pk, available in stored.items()
+        }
+
+    def availability(self, doctors):
+        """``{pk: live availability}`` for Doctor instances."""
+        return self.live_values({doctor.pk: doctor.available for doctor in doctors})
+
+    def diverged(self, doctors):
+        """``{pk: live availability}`` for the doctors in the ``doctors``
+        queryset whose live availability differs from Doctor.available,
+        i.e. the ones the next ``flush`` would write. Only tracked doctors
+        are read, so the cost does not grow with the table."""
+        ids, _ = self.tracked()
+        return self._diverged(doctors, ids)
+
+    def _diverged(self, doctors, ids):
+        if not ids:
+            return {}
+        stored = dict(doctors.filter(pk__in=ids).values_list('pk', 'available'))
+        return {pk: live for pk, live in self.live_values(stored).items() if live != stored[pk]}
+
+    def matching(self, doctors, available):
+        """``doctors`` narrowed to those whose live availability is
+        ``available``. Only the few rows not yet flushed are listed by id,
+        so the filter stays on the indexed column."""
+        diverged = self.diverged(doctors)
+        joining = [pk for pk, live in diverged.items() if live == available]
+        leaving = [pk for pk, live in diverged.items() if live != available]
+        return doctors.filter(Q(available=available) | Q(pk__in=joining)).exclude(pk__in=leaving)
+
+    def flush(self):
+        """Write live availability back to Doctor.available where the two
+        differ, e.g. after presence expired, with one UPDATE per value. The
+        copies on other shards, the search index and the doctor cache
+        follow. Doctors no longer on duty stop being tracked. Returns the
+        ids of the doctors written."""
+        ids, end = self.tracked()
+        changed = {True: [], False: []}
+        for pk, live in self._diverged(Doctor.objects.all(), ids).items():
+            changed[live].append(pk)
+        for available, pks in changed.items():
+            if pks:
+                Doctor.objects.filter(pk__in=pks).update(available=available, updated_at=timezone.now())
+        pks = changed[True] + changed[False]
+        if pks:
+            doctors = list(Doctor.objects.select_related('specialization').filter(pk__in=pks))
+            sharding.copy_to_shards(Doctor, doctors)
+            for doctor in doctors:
+                search_index.update_doctor(doctor)
+            # update() sends no signals, so the cached doctors go stale.
+            doctor_cache.bump_version()
+        self._compact(ids, end)
+        return pks
+
+    def _compact(self, ids, end):
+        # The ones on duty may still expire; they go back in the log before
+        # the slots read are dropped, and heartbeats since took later slots.
+        entries = self.shared.get_many([self.key(pk) for pk in ids])
+        now = time.time()
+        self.track([pk for pk in ids if self.key(pk) in entries and self.live(entries[self.key(pk)], now)])
+        start = self.shared.get(self.tracked_start_key, 1)
+        self.shared.set(self.tracked_start_key, end + 1, None)
+        self.shared.delete_many([self.slot_key(slot) for slot in range(start, end + 1)])
+
+presence = DoctorPresence()
@@ -0,0 +1,199 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'db_primary_pin'
+
+
+class RoutingState:
+    """Per-request routing: the replica chosen for a read-only view, and
+    whether the request has written (after which it reads the primary)."""
+
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+
+_state = contextvars.ContextVar('baseapp_db_routing', default=None)
+
+
+def mark_wrote():
+    """Record that the current request wrote, so that it reads the primary
+    from now on and its client is pinned there. Every router that routes a
+    write calls this, as the first one to answer is the only one asked."""
+    state = _state.get()
+    if state is not None:
+        state.wrote = True
+
+
+def replica_aliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def pin_seconds():
+    # Long enough to cover replication lag: after a write, the same client
+    # reads from the primary for this long.
+    return getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 5)
+
+
+def pin_cache():
+    return caches[getattr(settings, 'DATABASE_REPLICA_PIN_CACHE', 'default')]
+
+
+class ReplicaHealth:
+    """Picks a replica for a request, skipping any that failed to connect
+    within the last DATABASE_REPLICA_RETRY_SECONDS. Open persistent
+    connections are checked by Django itself (CONN_HEALTH_CHECKS)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._down_until = {}
+
+    def mark_down(self, alias):
+        with self._lock:
+            self._down_until[alias] = time.monotonic() + getattr(settings, 'DATABASE_REPLICA_RETRY_SECONDS', 30)
+
+    def available(self):
+        now = time.monotonic()
+        with self._lock:
+            return [alias for alias in replica_aliases() if self._down_until.get(alias, 0) <= now]
+
+    def choose(self):
+        candidates = self.available()
+        random.shuffle(candidates)
+        for alias in candidates:
+            try:
+                connections[alias].ensure_connection()
+            except DatabaseError:
+                logger.warning('Replica %s is unreachable, reading from the primary', alias, exc_info=True)
+                self.mark_down(alias)
+                continue
+            return alias
+        return None
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    """Sends reads made inside a ``read_replica`` view to the replica chosen
+    for the request. Everything else, including every read after the
+    request has written or inside a transaction, uses the primary."""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None:
+            return None
+        if state.replica is None or state.wrote or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # Explicit, or Django would follow an instance hint back to a replica.
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        mark_wrote()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive the schema from the primary.
+        if db in replica_aliases():
+            return False
+        return None
+
+
+def pinned(request):
+    if request.COOKIES.get(PIN_COOKIE):
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_authenticated and pin_cache().get(f'db-primary-pin:{user.pk}'))
+
+
+def read_replica(view):
+    """Let GET and HEAD requests to ``view`` read from a replica, unless the
+    client wrote recently. Apply it below ``@api_view`` so that
+    authentication has run and reads the primary."""
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        state = _state.get()
+        if state is not None and request.method in ('GET', 'HEAD') and replica_aliases() and not pinned(request):
+            state.replica = replica_health.choose()
+        return view(request, *args, **kwargs)
+    return wrapped
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside this block, e.g. to fill a shared cache
+    that must not be seeded from a lagging replica."""
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    replica, state.replica = state.replica, None
+    try:
+        yield
+    finally:
+        state.replica = replica
+
+
+class ReplicaRoutingMiddleware:
+    """Scopes routing state to a request. A request that wrote pins its
+    client to the primary for ``pin_seconds()``: by cookie, and for
+    authenticated users also in the cache so that token clients without
+    cookies are covered."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote:
+            self.pin(request, response)
+        return response
+
+    async def __acall__(self, request):
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote:
+            await sync_to_async(self.pin)(request, response)
+        return response
+
+    def pin(self, request, response):
+        if not replica_aliases():
+            return
+        response.set_cookie(PIN_COOKIE, '1', max_age=pin_seconds(), httponly=True, samesite='Lax')
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            pin_cache().set(f'db-primary-pin:{user.pk}', True, pin_seconds())
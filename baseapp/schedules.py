@@ -0,0 +1,211 @@
+import copy
+import functools
+import operator
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import sharding
+from .models import Appointment, Doctor, DoctorSchedule
+from .serializers import ScheduleEntrySerializer
+
+
+def build(doctor_id, date):
+    appointments = Appointment.objects.filter(doctor_id=doctor_id, date=date).select_related('patient').order_by('time', 'id')
+    return ScheduleEntrySerializer(sharding.on_shard(appointments, doctor=doctor_id), many=True).data
+
+
+def refresh(doctor_id, date, create=True):
+    """Rebuild one day from its appointments, holding a lock on the schedule
+    row so that concurrent bookings of the same day cannot overwrite it
+    with a list that misses the other one. With ``create=False`` only a day
+    that is already materialized is rebuilt."""
+    schedules = sharding.on_shard(DoctorSchedule.objects.select_for_update(), doctor=doctor_id)
+    with transaction.atomic(using=sharding.shard_for('doctor', doctor_id)):
+        if create:
+            schedule, created = schedules.get_or_create(doctor_id=doctor_id, date=date, defaults={'appointments': lambda: build(doctor_id, date)})
+            if created:
+                return schedule
+        else:
+            schedule = schedules.filter(doctor_id=doctor_id, date=date).first()
+            if schedule is None:
+                return None
+        schedule.appointments = build(doctor_id, date)
+        schedule.version += 1
+        schedule.save()
+    return schedule
+
+
+def day_of(appointment):
+    # Instances saved straight from request data may still hold strings.
+    return appointment.doctor_id, Appointment._meta.get_field('date').to_python(appointment.date)
+
+
+def entry(appointment):
+    """The day view entry of ``appointment``, as saved."""
+    appointment = copy.copy(appointment)
+    # Instances saved straight from request data may still hold strings.
+    appointment.time = Appointment._meta.get_field('time').to_python(appointment.time)
+    return ScheduleEntrySerializer(appointment).data
+
+
+def apply(appointment, previous=None, deleted=False):
+    """Bring the stored days of ``appointment``, as saved or deleted, up to
+    date: take it out of ``previous``, the ``(doctor_id, date)`` it moved
+    from, and put its entry in its day, or take it out if it was deleted.
+    The other entries are left alone. A day that is not stored yet is built
+    from its appointments, unless the appointment was deleted from it."""
+    day = day_of(appointment)
+    if previous is not None and tuple(previous) != day:
+        _patch(previous, appointment.pk)
+    _patch(day, appointment.pk, None if deleted else entry(appointment))
+
+
+def _patch(day, pk, new_entry=None):
+    doctor_id, date = day
+    schedules = sharding.on_shard(DoctorSchedule.objects.select_for_update(), doctor=doctor_id)
+    with transaction.atomic(using=sharding.shard_for('doctor', doctor_id)):
+        if new_entry is None:
+            schedule = schedules.filter(doctor_id=doctor_id, date=date).first()
+            if schedule is None:
+                return
+        else:
+            schedule, created = schedules.get_or_create(doctor_id=doctor_id, date=date, defaults={'appointments': lambda: build(doctor_id, date)})
+            if created:
+                return
+        old_entry = next((e for e in schedule.appointments if e['id'] == pk), None)
+        if new_entry is None and old_entry is None:
+            return
+        # Callbacks of concurrent writes may run out of order.
+        if new_entry is not None and old_entry is not None and old_entry['version'] >= new_entry['version']:
+            return
+        entries = [e for e in schedule.appointments if e['id'] != pk]
+        if new_entry is not None:
+            entries.append(new_entry)
+            entries.sort(key=lambda e: (e['time'], e['id']))
+        schedule.appointments = entries
+        schedule.version += 1
+        schedule.save(update_fields=['appointments', 'version', 'updated_at'])
+
+
+def apply_many(appointments):
+    """Patch the status, version and update time of ``appointments``, all
+    read from one shard, into their stored days: one locked read of the
+    rows and one bulk update. Days not stored yet are built."""
+    alias = appointments[0]._state.db
+    by_day = {}
+    for appointment in appointments:
+        by_day.setdefault(day_of(appointment), {})[appointment.pk] = appointment
+    updated_at = ScheduleEntrySerializer().fields['updated_at']
+    with transaction.atomic(using=alias):
+        locked = DoctorSchedule.objects.select_for_update().filter(_matching(by_day)).order_by('doctor_id', 'date')
+        schedules = list(sharding.using(locked, alias))
+        now = timezone.now()
+        changed = []
+        for schedule in schedules:
+            day = by_day[schedule.doctor_id, schedule.date]
+            stale = [e for e in schedule.appointments if e['id'] in day and day[e['id']].version > e['version']]
+            for e in stale:
+                appointment = day[e['id']]
+                e.update(status=appointment.status, version=appointment.version, updated_at=updated_at.to_representation(appointment.updated_at))
+            if stale:
+                schedule.version, schedule.updated_at = schedule.version + 1, now
+                changed.append(schedule)
+        if changed:
+            sharding.using(DoctorSchedule.objects, alias).bulk_update(changed, ['appointments', 'version', 'updated_at'])
+        missing = set(by_day) - {(schedule.doctor_id, schedule.date) for schedule in schedules}
+        if missing:
+            _refresh_shard(alias, missing, create=True, existing={})
+
+
+def _matching(days):
+    return functools.reduce(operator.or_, (Q(doctor_id=doctor_id, date=date) for doctor_id, date in days))
+
+
+def refresh_days(days, create=True):
+    """Rebuild several days as ``refresh`` does, with a fixed number of
+    queries per shard however many days there are: the schedule rows
+    (locked), the appointments, one bulk update and one bulk insert."""
+    days = set(days)
+    if len(days) == 1:
+        # E.g. a single booking, for which get_or_create takes fewer queries.
+        (doctor_id, date), = days
+        refresh(doctor_id, date, create)
+        return
+    by_shard = {}
+    for doctor_id, date in days:
+        by_shard.setdefault(sharding.shard_for('doctor', doctor_id), set()).add((doctor_id, date))
+    for alias, shard_days in by_shard.items():
+        with transaction.atomic(using=alias):
+            _refresh_shard(alias, shard_days, create)
+
+
+def _refresh_shard(alias, days, create, existing=None):
+    # ``existing``, if given, holds the rows of ``days`` already locked.
+    if existing is None:
+        # Locked in a fixed order, so that concurrent refreshes lock rows alike.
+        locked = DoctorSchedule.objects.select_for_update().filter(_matching(days)).order_by('doctor_id', 'date')
+        existing = {(schedule.doctor_id, schedule.date): schedule for schedule in sharding.using(locked, alias)}
+    if not create:
+        days = set(existing)
+    if not days:
+        return
+    entries = {day: [] for day in days}
+    appointments = Appointment.objects.filter(_matching(days)).select_related('patient').order_by('time', 'id')
+    for appointment in sharding.using(appointments, alias):
+        entries[appointment.doctor_id, appointment.date].append(appointment)
+    now = timezone.now()
+    changed, created = [], []
+    for (doctor_id, date), day_appointments in sorted(entries.items()):
+        data = ScheduleEntrySerializer(day_appointments, many=True).data
+        schedule = existing.get((doctor_id, date))
+        if schedule is None:
+            created.append(DoctorSchedule(doctor_id=doctor_id, date=date, appointments=data))
+        else:
+            schedule.appointments, schedule.version, schedule.updated_at = data, schedule.version + 1, now
+            changed.append(schedule)
+    if changed:
+        sharding.using(DoctorSchedule.objects, alias).bulk_update(changed, ['appointments', 'version', 'updated_at'])
+    if created:
+        try:
+            with transaction.atomic(using=alias):
+                sharding.using(DoctorSchedule.objects, alias).bulk_create(created)
+        except IntegrityError:
+            # A concurrent refresh inserted one of the days first; take
+            # them one at a time, under its lock.
+            for schedule in created:
+                refresh(schedule.doctor_id, schedule.date)
+
+
+def patient_changed(patient):
+    """Refresh the upcoming days the patient is booked on; past days keep
+    the details they were served with."""
+    days = Appointment.objects.filter(patient_id=patient.pk, date__gte=timezone.localdate()).values_list('doctor_id', 'date').distinct()
+    refresh_days({day for shard in sharding.scatter(days) for day in shard}, create=False)
+
+
+def materialize(date):
+    """Whether a read of ``date`` may store its schedule: only days within
+    SCHEDULE_WINDOW_DAYS of today, so that requests for arbitrary dates do
+    not fill the table. Writes store any day they touch."""
+    return abs((date - timezone.localdate()).days) <= getattr(settings, 'SCHEDULE_WINDOW_DAYS', 90)
+
+
+def lookup(doctor_id, date):
+    """The schedule of ``doctor_id`` on ``date`` as a dict, in one query.
+    Days never materialized are built now, and stored if ``materialize``
+    allows; those that are not have no ``updated_at``. None if there is no
+    such doctor."""
+    found = sharding.on_shard(DoctorSchedule.objects.filter(doctor_id=doctor_id, date=date), doctor=doctor_id).values(
+        'appointments', 'version', 'updated_at',
+    ).first()
+    if found is not None:
+        return found
+    if not Doctor.objects.filter(pk=doctor_id).exists():
+        return None
+    if not materialize(date):
+        return {'appointments': build(doctor_id, date), 'version': 0, 'updated_at': None}
+    schedule = refresh(doctor_id, date)
+    return {'appointments': schedule.appointments, 'version': schedule.version, 'updated_at': schedule.updated_at}
@@ -0,0 +1,223 @@
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from django.conf import settings
+
+from .models import Doctor, Qualification, Specialization
+
+FIELD_WEIGHTS = {'name': 3.0, 'specialization': 2.0, 'qualification': 1.0}
+EXACT, PREFIX, FUZZY = 1.0, 0.8, 0.6
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return re.findall(r'[a-z0-9]+', text)
+
+
+def trigrams(term):
+    # Padded like pg_trgm, so short terms and word starts still match.
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DoctorSearchIndex:
+    """In-memory inverted index over doctor, specialization and qualification
+    names for typeahead search.
+
+    Terms map to the doctors they occur in, weighted by field. Query tokens
+    match terms exactly, by prefix (a bisect over the sorted vocabulary) or,
+    from three characters on, by trigram similarity. The index is built with
+    two queries on first use, kept current by the signals in
+    ``baseapp.signals`` and rebuilt after ``ttl`` seconds so that changes
+    made by other workers are picked up.
+    """
+
+    def __init__(self, ttl=None, fuzzy_threshold=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'DOCTOR_SEARCH_INDEX_TTL', 300)
+        self.fuzzy_threshold = fuzzy_threshold if fuzzy_threshold is not None else getattr(settings, 'DOCTOR_SEARCH_FUZZY_THRESHOLD', 0.3)
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+            self._doctors = {}
+            self._specializations = {}
+            self._qualifications = {}
+            self._postings = {}
+            self._terms = []
+            self._trigrams = {}
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def _load(self):
+        now = time.monotonic()
+        if self.loaded and now - self._loaded_at <= self.ttl:
+            return
+        rows = Doctor.objects.values_list('id', 'name', 'specialization_id', 'specialization__name', 'available')
+        links = Doctor.qualifications.through.objects.values_list('doctor_id', 'qualification_id', 'qualification__name')
+        doctors, qualification_ids = {}, {}
+        specializations, qualifications = {}, {}
+        for doctor_id, qualification_id, name in links.iterator():
+            qualification_ids.setdefault(doctor_id, set()).add(qualification_id)
+            qualifications[qualification_id] = name
+        for doctor_id, name, specialization_id, specialization, available in rows.iterator():
+            doctors[doctor_id] = (name, specialization_id, qualification_ids.get(doctor_id, set()), available)
+            specializations[specialization_id] = specialization
+        with self._lock:
+            self.clear()
+            self._specializations = specializations
+            self._qualifications = qualifications
+            for doctor_id, entry in doctors.items():
+                self._index(doctor_id, entry)
+            self._loaded_at = now
+
+    def _fields(self, entry):
+        name, specialization_id, qualification_ids, _ = entry
+        yield 'name', name
+        yield 'specialization', self._specializations.get(specialization_id, '')
+        for qualification_id in qualification_ids:
+            yield 'qualification', self._qualifications.get(qualification_id, '')
+
+    def _weights(self, entry):
+        weights = {}
+        for field, text in self._fields(entry):
+            for term in tokenize(text):
+                weights[term] = max(weights.get(term, 0.0), FIELD_WEIGHTS[field])
+        return weights
+
+    def _index(self, doctor_id, entry):
+        self._doctors[doctor_id] = entry
+        for term, weight in self._weights(entry).items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = {}
+                bisect.insort(self._terms, term)
+                for gram in trigrams(term):
+                    self._trigrams.setdefault(gram, set()).add(term)
+            posting[doctor_id] = weight
+
+    def _unindex(self, doctor_id):
+        entry = self._doctors.pop(doctor_id, None)
+        if entry is None:
+            return None
+        for term in self._weights(entry):
+            posting = self._postings[term]
+            posting.pop(doctor_id, None)
+            if not posting:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+                for gram in trigrams(term):
+                    self._trigrams[gram].discard(term)
+        return entry
+
+    def update_doctor(self, doctor, deleted=False):
+        with self._lock:
+            if not self.loaded:
+                return
+            previous = self._unindex(doctor.pk)
+            if deleted:
+                return
+            if doctor.specialization_id not in self._specializations:
+                self._specializations[doctor.specialization_id] = doctor.specialization.name
+            qualification_ids = previous[2] if previous is not None else set()
+            self._index(doctor.pk, (doctor.name, doctor.specialization_id, qualification_ids, doctor.available))
+
+    def update_qualifications(self, doctor_id, qualification_ids=None, added=(), removed=()):
+        """Replace (``qualification_ids``) or adjust a doctor's links."""
+        with self._lock:
+            entry = self._unindex(doctor_id) if self.loaded else None
+            if entry is None:
+                return
+            current = set(entry[2]) if qualification_ids is None else set(qualification_ids)
+            current = (current | set(added)) - set(removed)
+            missing = current - set(self._qualifications)
+            if missing:
+                self._qualifications.update(Qualification.objects.filter(pk__in=missing).values_list('id', 'name'))
+            self._index(doctor_id, entry[:2] + (current, entry[3]))
+
+    def remove_qualification(self, qualification_id):
+        with self._lock:
+            for doctor_id, entry in list(self._doctors.items()):
+                if qualification_id in entry[2]:
+                    self.update_qualifications(doctor_id, removed=[qualification_id])
+            self._qualifications.pop(qualification_id, None)
+
+    def rename(self, instance):
+        """Apply a saved Specialization or Qualification name."""
+        with self._lock:
+            if not self.loaded:
+                return
+            if isinstance(instance, Specialization):
+                doctor_ids = [d for d, entry in self._doctors.items() if entry[1] == instance.pk]
+                names = self._specializations
+            else:
+                doctor_ids = [d for d, entry in self._doctors.items() if instance.pk in entry[2]]
+                names = self._qualifications
+            affected = [(doctor_id, self._unindex(doctor_id)) for doctor_id in doctor_ids]
+            names[instance.pk] = instance.name
+            for doctor_id, entry in affected:
+                self._index(doctor_id, entry)
+
+    def _matches(self, token):
+        """Yield ``(term, score)`` for vocabulary terms matching ``token``."""
+        position = bisect.bisect_left(self._terms, token)
+        while position < len(self._terms) and self._terms[position].startswith(token):
+            term = self._terms[position]
+            yield term, EXACT if term == token else PREFIX
+            position += 1
+        if len(token) < 3:
+            return
+        grams = trigrams(token)
+        shared = Counter(term for gram in grams for term in self._trigrams.get(gram, ()))
+        for term, count in shared.items():
+            if term.startswith(token):
+                continue
+            similarity = count / (len(grams) + len(trigrams(term)) - count)
+            if similarity >= self.fuzzy_threshold:
+                yield term, FUZZY * similarity
+
+    def search(self, query, limit=10, available=None, live=None):
+        """Return ``(doctor_id, score)`` pairs, best first. Every query
+        token has to match some term of the doctor. ``live`` maps
+        ``{doctor_id: indexed availability}`` to the current one, which
+        is then used to filter and rank instead."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        self._load()
+        with self._lock:
+            scores = None
+            for token in dict.fromkeys(tokens):
+                token_scores = {}
+                for term, match in self._matches(token):
+                    for doctor_id, weight in self._postings[term].items():
+                        score = match * weight
+                        if score > token_scores.get(doctor_id, 0.0):
+                            token_scores[doctor_id] = score
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {d: s + token_scores[d] for d, s in scores.items() if d in token_scores}
+                if not scores:
+                    return []
+            candidates = {doctor_id: self._doctors[doctor_id] for doctor_id in scores}
+        availability = {doctor_id: doctor[3] for doctor_id, doctor in candidates.items()}
+        if live is not None:
+            availability = live(availability)
+        ranked = [
+            (-score, not availability[doctor_id], candidates[doctor_id][0], doctor_id)
+            for doctor_id, score in scores.items()
+            if available is None or availability[doctor_id] == available
+        ]
+        ranked.sort()
+        return [(doctor_id, -score) for score, _, _, doctor_id in ranked[:limit]]
+
+
+search_index = DoctorSearchIndex()
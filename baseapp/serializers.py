@@ -1,23 +1,43 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Doctor, Patient, Appointment, MedicalRecord, Qualification, Specialization, Conversation, Message
+from .models import Doctor, Patient, Appointment, MedicalRecord, Qualification, Specialization, Conversation, Message, ImportJob
+from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.utils import timezone
+from django.conf import settings
+from .cache import doctor_cache
+from .presence import presence
+from .inbox import side_of
+from .booking import TRANSITIONS, insert_appointment, validate_appointment
+from django.core.exceptions import ValidationError as DjangoValidationError
+from .metrics import serializer_timer
 
 
-class QualificationSerializer(serializers.ModelSerializer):
+class TimedModelSerializer(serializers.ModelSerializer):
+    def to_representation(self, instance):
+        with serializer_timer():
+            return super().to_representation(instance)
+
+class QualificationSerializer(TimedModelSerializer):
     class Meta:
         model = Qualification
         fields = '__all__'
 
-class SpecializationSerializer(serializers.ModelSerializer):
+class SpecializationSerializer(TimedModelSerializer):
     class Meta:
         model = Specialization
         fields = '__all__'
 
-class DoctorSerializer(serializers.ModelSerializer):
+class DoctorListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        doctors = list(data.all() if hasattr(data, 'all') else data)
+        self.child.live_availability = presence.availability(doctors)
+        return super().to_representation(doctors)
+
+class DoctorSerializer(TimedModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
     specialization = serializers.CharField(source='specialization.name')
     qualifications = serializers.CharField(source='get_qualifications_display', read_only=True)
+    image_variants = serializers.DictField(read_only=True, allow_null=True)
 
     class Meta:
         model = Doctor
@@ -28,17 +48,65 @@ class DoctorSerializer(serializers.ModelSerializer):
             'qualifications',
             'specialization',
             'image',
+            'image_variants',
             'email',
             'office_number',
             'available',
         ]
-
-class PatientSerializer(serializers.ModelSerializer):
+        list_serializer_class = DoctorListSerializer
+
+    def to_representation(self, instance):
+        request = self.context.get('request')
+        # updated_at retires a doctor's entry as soon as their row changes;
+        # the catalogue version covers specializations and qualifications.
+        key = f'{instance.pk}:{instance.updated_at.timestamp() if instance.updated_at else 0}'
+        if request is not None:
+            key = f'{key}:{request.get_host()}'
+        data = doctor_cache.get_or_set(key, lambda: super(DoctorSerializer, self).to_representation(instance)).copy()
+        # Changes too often to cache; read live from the presence service.
+        live = getattr(self, 'live_availability', {})
+        data['available'] = live[instance.pk] if instance.pk in live else presence.is_available(instance.pk, instance.available)
+        return data
+
+class HeartbeatSerializer(serializers.Serializer):
+    available = serializers.BooleanField(default=True)
+
+class PatientSerializer(TimedModelSerializer):
     class Meta:
         model = Patient
         fields = '__all__'
 
-class AppointmentSerializer(serializers.ModelSerializer):
+class ImportUserFieldsMixin(serializers.Serializer):
+    # The account fields of an import row; the rest is validated by the
+    # profile serializer the mixin is combined with.
+    username = serializers.CharField(max_length=150, validators=[UnicodeUsernameValidator()])
+    password = serializers.CharField(required=False, allow_blank=True, write_only=True)
+    first_name = serializers.CharField(required=False, allow_blank=True, max_length=150)
+    last_name = serializers.CharField(required=False, allow_blank=True, max_length=150)
+
+class DoctorImportSerializer(ImportUserFieldsMixin, DoctorSerializer):
+    user = None
+    qualifications = serializers.ListField(child=serializers.CharField(max_length=100), required=False)
+
+    class Meta(DoctorSerializer.Meta):
+        fields = [
+            'username', 'password', 'first_name', 'last_name', 'name', 'email', 'office_number',
+            'specialization', 'qualifications', 'years_of_experience', 'available',
+        ]
+
+class PatientImportSerializer(ImportUserFieldsMixin, PatientSerializer):
+    class Meta(PatientSerializer.Meta):
+        fields = [
+            'username', 'password', 'first_name', 'last_name', 'name', 'email', 'date_of_birth',
+            'gender', 'phone_number', 'age', 'blood_group',
+        ]
+
+class ImportJobSerializer(TimedModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = '__all__'
+
+class AppointmentSerializer(TimedModelSerializer):
     doctor = DoctorSerializer()
     patient = PatientSerializer()
 
@@ -46,21 +114,63 @@ class AppointmentSerializer(serializers.ModelSerializer):
         model = Appointment
         fields = '__all__'
 
-    def clean(self):
-        same_doctor_patients = Appointment.objects.filter(doctor=self.validated_data['doctor'], patient__in=[self.validated_data['patient'], self.validated_data['patient'].user])
-        same_patient_doctors = Appointment.objects.filter(patient=self.validated_data['patient'], doctor__in=[self.validated_data['doctor'], self.validated_data['doctor'].user])
-        conflicting_appointments = same_doctor_patients | same_patient_doctors
-        conflicting_appointments = conflicting_appointments.exclude(pk=self.instance.pk).filter(date=self.validated_data['date'])
-        if conflicting_appointments.exists():
-            raise serializers.ValidationError("The appointment date conflicts with another appointment for the same doctor and patient.")
+class ScheduleEntrySerializer(TimedModelSerializer):
+    """An appointment in a doctor's day view; the doctor and date are the
+    schedule's own."""
+    patient = PatientSerializer()
 
-        if not self.validated_data['doctor'].user.is_active or not self.validated_data['patient'].user.is_active:
-            raise serializers.ValidationError("The doctor or patient has been deleted or changed.")
+    class Meta:
+        model = Appointment
+        fields = ['id', 'time', 'status', 'version', 'updated_at', 'patient']
 
-        if self.validated_data['date'] < timezone.now():
-            raise serializers.ValidationError("The appointment date is in the past.")
+class AppointmentBookingSerializer(TimedModelSerializer):
+    doctor = serializers.PrimaryKeyRelatedField(queryset=Doctor.objects.select_related('user'))
+    patient = serializers.PrimaryKeyRelatedField(queryset=Patient.objects.select_related('user'))
 
-class MedicalRecordSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Appointment
+        fields = ['doctor', 'patient', 'date', 'time']
+
+    def validate(self, attrs):
+        try:
+            validate_appointment(attrs['doctor'], attrs['patient'], attrs['date'], attrs['time'])
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return attrs
+
+    def create(self, validated_data):
+        try:
+            return insert_appointment(**validated_data)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+
+class AppointmentTransitionSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=list(TRANSITIONS))
+    version = serializers.IntegerField(min_value=1, required=False)
+
+class BulkTransitionSerializer(serializers.Serializer):
+    transitions = AppointmentTransitionSerializer(many=True, required=False)
+    # Shorthand for moving many appointments to one status.
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+    status = serializers.ChoiceField(choices=list(TRANSITIONS), required=False)
+
+    def validate(self, data):
+        changes = [(item['id'], item['status'], item.get('version')) for item in data.get('transitions', [])]
+        if data.get('ids'):
+            if 'status' not in data:
+                raise serializers.ValidationError({'status': 'This field is required with ids.'})
+            changes += [(pk, data['status'], None) for pk in data['ids']]
+        if not changes:
+            raise serializers.ValidationError('No transitions given.')
+        limit = getattr(settings, 'APPOINTMENT_BULK_TRANSITION_LIMIT', 1000)
+        if len(changes) > limit:
+            raise serializers.ValidationError(f'At most {limit} transitions per request.')
+        if len({pk for pk, _, _ in changes}) < len(changes):
+            raise serializers.ValidationError('Each appointment may appear only once.')
+        return changes
+
+class MedicalRecordSerializer(TimedModelSerializer):
     patient = PatientSerializer()
     doctor = DoctorSerializer()
 
@@ -68,14 +178,38 @@ class MedicalRecordSerializer(serializers.ModelSerializer):
         model = MedicalRecord
         fields = '__all__'
 
-class ConversationSerializer(serializers.ModelSerializer):
+class ConversationSerializer(TimedModelSerializer):
     class Meta:
         model = Conversation
-        fields = '__all__'
+        # Inbox state is per participant; see InboxSerializer.
+        fields = ['id', 'doctor', 'patient', 'updated_at']
+
+class InboxSerializer(TimedModelSerializer):
+    """A conversation as seen by ``context['user']``, one of its participants."""
+    unread = serializers.SerializerMethodField()
+    last_read_id = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Conversation
+        fields = ['id', 'doctor', 'patient', 'last_message_id', 'last_message_at', 'last_message_preview', 'last_sender', 'unread', 'last_read_id', 'updated_at']
+
+    def get_unread(self, conversation):
+        return getattr(conversation, f'{side_of(conversation, self.context["user"])}_unread')
+
+    def get_last_read_id(self, conversation):
+        return getattr(conversation, f'{side_of(conversation, self.context["user"])}_last_read_id')
+
+class ReadReceiptSerializer(serializers.Serializer):
+    message = serializers.IntegerField(min_value=1, required=False)
+
+class SenderSerializer(TimedModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name']
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(TimedModelSerializer):
     conversation = ConversationSerializer()
-    sender = DoctorSerializer()
+    sender = SenderSerializer()
 
     class Meta:
         model = Message
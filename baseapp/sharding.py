@@ -0,0 +1,378 @@
+import copy
+import functools
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F, Max
+from django.db.models.deletion import Collector
+
+from .models import (
+    Appointment, ArchivedAppointment, ArchivedMedicalRecord, ArchivedMessage, Conversation, Doctor,
+    DoctorSchedule, MedicalRecord, Message, Patient, Qualification, ShardSequence, Specialization,
+)
+from .pagination import keyset_chunks
+from .routers import mark_wrote
+
+logger = logging.getLogger(__name__)
+
+# Sharded model -> (shard key attribute, key space). Rows whose keys are
+# equal within a key space live on the same shard: an archive table with
+# its hot table, and messages with their conversation. Appointments follow
+# the doctor so that the doctor's slot constraint stays on one database.
+SHARD_KEYS = {
+    Appointment: ('doctor_id', 'doctor'),
+    ArchivedAppointment: ('doctor_id', 'doctor'),
+    DoctorSchedule: ('doctor_id', 'doctor'),
+    MedicalRecord: ('patient_id', 'patient'),
+    ArchivedMedicalRecord: ('patient_id', 'patient'),
+    Conversation: ('id', 'conversation'),
+    Message: ('conversation_id', 'conversation'),
+    ArchivedMessage: ('conversation_id', 'conversation'),
+}
+
+# Model handing out ids -> the tables sharing its id space.
+ID_TABLES = {
+    Appointment: (Appointment, ArchivedAppointment),
+    MedicalRecord: (MedicalRecord, ArchivedMedicalRecord),
+    Conversation: (Conversation,),
+    Message: (Message, ArchivedMessage),
+}
+
+# Small tables the sharded ones point at, kept whole on every shard (in
+# foreign key order) so that joins and select_related work on each shard.
+# Written on the default database; the copies follow through signals once
+# it commits, leaving out saves that only touch User.last_login.
+REFERENCE_MODELS = [User, Specialization, Qualification, Doctor, Doctor.qualifications.through, Patient]
+
+
+def shard_aliases():
+    return list(getattr(settings, 'DATABASE_SHARDS', [DEFAULT_DB_ALIAS]))
+
+
+def is_sharded():
+    return len(shard_aliases()) > 1
+
+
+def other_shards():
+    return [alias for alias in shard_aliases() if alias != DEFAULT_DB_ALIAS]
+
+
+def shard_for(space, key, aliases=None):
+    """The shard holding ``key`` of ``space``, by rendezvous hashing: adding
+    or removing a shard only moves the keys that land on or left it."""
+    aliases = aliases or shard_aliases()
+
+    def weight(alias):
+        return hashlib.md5(f'{alias}:{space}:{key}'.encode(), usedforsecurity=False).digest()
+
+    return max(aliases, key=weight)
+
+
+def shard_of(instance, aliases=None):
+    field, space = SHARD_KEYS[instance._meta.concrete_model]
+    return shard_for(space, getattr(instance, field), aliases)
+
+
+def group_by_shard(objs):
+    shards = {}
+    for obj in objs:
+        shards.setdefault(shard_of(obj), []).append(obj)
+    return shards
+
+
+def scatter(queryset, **key):
+    """``queryset`` once per shard, or only on the shard holding ``key``
+    (e.g. ``doctor=5``). Unsharded it is returned as is, so that the other
+    routers (replica reads, write pinning) still apply."""
+    if not is_sharded():
+        return [queryset]
+    if key:
+        (space, value), = key.items()
+        return [queryset.using(shard_for(space, value))]
+    return [queryset.using(alias) for alias in shard_aliases()]
+
+
+def on_shard(queryset, **key):
+    return scatter(queryset, **key)[0]
+
+
+def using(queryset, alias):
+    """``queryset`` on ``alias``, the database of rows already read; as
+    ``scatter``, unsharded it is left to the routers."""
+    return queryset.using(alias) if is_sharded() else queryset
+
+
+def first(querysets):
+    """The first row found in any of ``querysets``, e.g. a primary key
+    looked up on every shard."""
+    for queryset in querysets:
+        found = queryset.first()
+        if found is not None:
+            return found
+    return None
+
+
+def block_size(model):
+    return getattr(settings, 'SHARD_ID_BLOCK_SIZE', 100)
+
+
+def max_id(model):
+    return max(
+        table._base_manager.using(alias).aggregate(last=Max('pk'))['last'] or 0
+        for table in ID_TABLES.get(model, (model,))
+        for alias in shard_aliases()
+    )
+
+
+def reserve(model, count):
+    """Reserve ``count`` ids for ``model`` on the default database and
+    return them as ``(start, end)``."""
+    name = model._meta.label_lower
+    sequences = ShardSequence.objects.using(DEFAULT_DB_ALIAS)
+    sequences.get_or_create(name=name, defaults={'next_id': max_id(model) + 1})
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        sequences.filter(name=name).update(next_id=F('next_id') + count)
+        end = sequences.get(name=name).next_id
+    return end - count, end
+
+
+class IdAllocator:
+    """Hands out primary keys for sharded rows from blocks reserved in
+    ShardSequence, one round trip per SHARD_ID_BLOCK_SIZE ids. Blocks are
+    per process, so ids are unique but only roughly increasing: order rows
+    by time, not id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def allocate(self, model, count):
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                start, end = self._blocks.get(model, (0, 0))
+                if start == end:
+                    start, end = reserve(model, max(count - len(ids), block_size(model)))
+                take = min(end - start, count - len(ids))
+                ids.extend(range(start, start + take))
+                self._blocks[model] = (start + take, end)
+        return ids
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+id_allocator = IdAllocator()
+
+
+def assign_ids(objs):
+    """Give unsaved sharded rows their primary keys before they are routed;
+    a database sequence would only be unique within one shard."""
+    by_model = {}
+    for obj in objs:
+        if obj.pk is None:
+            by_model.setdefault(obj._meta.concrete_model, []).append(obj)
+    for model, missing in by_model.items():
+        for obj, pk in zip(missing, id_allocator.allocate(model, len(missing))):
+            obj.pk = pk
+
+
+class ShardRouter:
+    """Routes sharded models (SHARD_KEYS) by the instance at hand: a new row
+    to the shard of its key, an existing one to where it was read. Queries
+    without an instance must pick their shards with ``scatter``/``on_shard``;
+    otherwise they fall through to the next router, i.e. the default
+    database, which is one of the shards."""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if not is_sharded() or model not in SHARD_KEYS or instance is None:
+            return None
+        if instance._meta.concrete_model in SHARD_KEYS:
+            return instance._state.db
+        return None
+
+    def db_for_write(self, model, **hints):
+        alias = self._db_for_write(model, hints.get('instance'))
+        if alias is not None:
+            # ReplicaRouter, which would otherwise record the write, is not asked.
+            mark_wrote()
+        return alias
+
+    def _db_for_write(self, model, instance):
+        if not is_sharded() or model not in SHARD_KEYS or instance is None:
+            return None
+        if instance._meta.concrete_model is not model:
+            # A related manager passes the object it hangs off.
+            return instance._state.db if instance._meta.concrete_model in SHARD_KEYS else None
+        if instance._state.adding:
+            assign_ids([instance])
+            return shard_of(instance)
+        return instance._state.db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = shard_aliases()
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+def _upsert(alias, model, objs):
+    if objs:
+        model._base_manager.using(alias).bulk_create(
+            [copy.copy(obj) for obj in objs],
+            update_conflicts=True,
+            unique_fields=[model._meta.pk.name],
+            update_fields=[f.name for f in model._meta.concrete_fields if not f.primary_key],
+        )
+
+
+def after_commit(func):
+    """Run ``func`` once the default database commits, or now outside a
+    transaction. Reference rows are copied this way, as the shards cannot
+    join the default database's transaction: a rolled back write must not
+    have reached them."""
+    transaction.on_commit(func, using=DEFAULT_DB_ALIAS)
+
+
+def copy_to_shards(model, objs):
+    """Upsert rows of a reference model, as written on the default database,
+    into every other shard."""
+    if not is_sharded():
+        return
+    objs = list(objs)
+    for alias in other_shards():
+        _upsert(alias, model, objs)
+
+
+def queue_resync(model, **filters):
+    """``resync`` once the default database commits."""
+    if is_sharded():
+        after_commit(functools.partial(resync, model, **filters))
+
+
+def _delete_copies(alias, rows):
+    """Delete reference rows from ``alias`` with the reference rows that
+    depend on them. A row some sharded row still points at is kept and
+    logged instead: a copy's cascade must not delete rows that exist only
+    on that shard."""
+    for row in rows:
+        collector = Collector(using=alias, origin=row)
+        collector.collect([row])
+        blocked = any(model in SHARD_KEYS and instances for model, instances in collector.data.items()) or any(
+            queryset.model in SHARD_KEYS and queryset.exists() for queryset in collector.fast_deletes
+        )
+        if blocked:
+            logger.warning('Kept %s %s on %s: sharded rows there still refer to it.', row._meta.label, row.pk, alias)
+        else:
+            collector.delete()
+
+
+def resync(model, **filters):
+    """Make the rows of ``model`` matching ``filters`` on every other shard
+    equal to those on the default database. Rows deleted there are deleted
+    as ``_delete_copies`` allows."""
+    if not is_sharded():
+        return
+    rows = list(model._base_manager.using(DEFAULT_DB_ALIAS).filter(**filters))
+    for alias in other_shards():
+        with transaction.atomic(using=alias):
+            _delete_copies(alias, model._base_manager.using(alias).filter(**filters).exclude(pk__in=[row.pk for row in rows]))
+            _upsert(alias, model, rows)
+
+
+def sync_reference_tables(batch_size=1000):
+    """Copy every reference table from the default database onto the other
+    shards and drop rows that no longer exist there, e.g. after adding a
+    shard or bulk writes that sent no signals."""
+    if not is_sharded():
+        return
+    for model in REFERENCE_MODELS:
+        for chunk in keyset_chunks(model._base_manager.using(DEFAULT_DB_ALIAS).all(), ('pk',), batch_size):
+            copy_to_shards(model, chunk)
+    for model in reversed(REFERENCE_MODELS):
+        pks = set(model._base_manager.using(DEFAULT_DB_ALIAS).values_list('pk', flat=True))
+        for alias in other_shards():
+            stale = [pk for pk in model._base_manager.using(alias).values_list('pk', flat=True).iterator() if pk not in pks]
+            for start in range(0, len(stale), batch_size):
+                with transaction.atomic(using=alias):
+                    _delete_copies(alias, model._base_manager.using(alias).filter(pk__in=stale[start:start + batch_size]))
+
+
+# Copied before their children, deleted after them.
+MOVE_ORDER = [Conversation, Message, ArchivedMessage, Appointment, ArchivedAppointment, DoctorSchedule, MedicalRecord, ArchivedMedicalRecord]
+
+
+def _insert_rows(alias, model, rows):
+    # Raw, so that auto_now(_add) columns keep their values; rows copied by
+    # an earlier, interrupted run are skipped.
+    connection = connections[alias]
+    fields = model._meta.concrete_fields
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(f.column) for f in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    params = [[f.get_db_prep_save(getattr(row, f.attname), connection) for f in fields] for row in rows]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def _delete_rows(alias, model, pks):
+    # Raw as well: the rows still exist on their new shard, so the delete
+    # signals (slot index, inbox counts) must not fire.
+    connection = connections[alias]
+    sql = 'DELETE FROM {} WHERE {} IN ({})'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(model._meta.pk.column),
+        ', '.join(['%s'] * len(pks)),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, pks)
+
+
+def rebalance(sources=None, batch_size=1000, dry_run=False):
+    """Move sharded rows that are not on the shard their key now maps to,
+    e.g. after a shard was added to DATABASE_SHARDS, and return
+    ``{model label: rows moved}``. ``sources`` may name databases being
+    drained that are no longer shards. Each batch is copied before it is
+    deleted, and copies are idempotent, so an interrupted run can be
+    repeated; conversations are deleted from their old shard last, after
+    their messages."""
+    aliases = shard_aliases()
+    sources = list(dict.fromkeys(aliases + list(sources or [])))
+    moved = {model._meta.label: 0 for model in MOVE_ORDER}
+    emptied = []
+    for model in MOVE_ORDER:
+        for source in sources:
+            for chunk in keyset_chunks(model._base_manager.using(source).all(), ('pk',), batch_size):
+                targets = {}
+                for row in chunk:
+                    target = shard_of(row, aliases)
+                    if target != source:
+                        targets.setdefault(target, []).append(row)
+                misplaced = [row.pk for rows in targets.values() for row in rows]
+                moved[model._meta.label] += len(misplaced)
+                if dry_run or not misplaced:
+                    continue
+                for target, rows in targets.items():
+                    with transaction.atomic(using=target):
+                        _insert_rows(target, model, rows)
+                if model is Conversation:
+                    emptied.append((source, misplaced))
+                else:
+                    with transaction.atomic(using=source):
+                        _delete_rows(source, model, misplaced)
+    for source, pks in emptied:
+        with transaction.atomic(using=source):
+            _delete_rows(source, Conversation, pks)
+    return moved
@@ -0,0 +1,340 @@
+import copy
+import functools
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.backends.signals import connection_created
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import changes, inbox, metrics, schedules, sharding, tasks
+from .booking import appointments_updated, claim_slot, release_slots
+from .broker import get_broker
+from .cache import doctor_cache
+from .images import update_image_hash
+from .presence import presence
+from .models import Appointment, Conversation, Doctor, Message, Patient, Qualification, Specialization
+from .search import search_index
+from .slots import slot_index
+
+
+@receiver(pre_save, sender=Doctor)
+def hash_doctor_image(sender, instance, **kwargs):
+    update_image_hash(instance)
+
+
+@receiver(post_save, sender=Doctor)
+def remember_doctor_image(sender, instance, **kwargs):
+    # Uploads are renamed by the storage as the row is saved.
+    instance._stored_image = instance.image.name if instance.image else ''
+
+
+@receiver(post_save, sender=Doctor)
+def render_doctor_image_variants(sender, instance, **kwargs):
+    if instance.image_hash and getattr(settings, 'DOCTOR_IMAGE_EAGER_VARIANTS', False):
+        tasks.enqueue(
+            tasks.render_doctor_image_variants,
+            {'doctor_id': instance.pk, 'image_hash': instance.image_hash},
+            dedup_key=f'doctor-image-variants:{instance.pk}:{instance.image_hash}',
+        )
+
+
+@receiver(post_save, sender=Doctor)
+def track_doctor_presence(sender, instance, created, raw, using, update_fields, **kwargs):
+    # A write to Doctor.available may disagree with the doctor's presence,
+    # which wins until flushed; filters only compare the tracked doctors.
+    if not created and not raw and using == DEFAULT_DB_ALIAS and (update_fields is None or 'available' in update_fields):
+        presence.track([instance.pk])
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_save, sender=Specialization)
+@receiver(post_delete, sender=Specialization)
+@receiver(post_save, sender=Qualification)
+@receiver(post_delete, sender=Qualification)
+def invalidate_doctor_cache(sender, using, **kwargs):
+    # After commit: bumped earlier, a concurrent reader could refill the
+    # new version from the rows as they were before the write.
+    transaction.on_commit(doctor_cache.bump_version, using=using)
+
+
+@receiver(m2m_changed, sender=Doctor.qualifications.through)
+def invalidate_doctor_cache_on_qualifications(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(doctor_cache.bump_version, using=using)
+
+
+# The search index is shared by the whole process and only takes committed
+# writes: a rolled back create or rename would otherwise be searchable until
+# the next reload.
+@receiver(post_save, sender=Doctor)
+def index_doctor(sender, instance, using, **kwargs):
+    doctor = copy.copy(instance)
+    transaction.on_commit(lambda: search_index.update_doctor(doctor), using=using)
+
+
+@receiver(post_delete, sender=Doctor)
+def unindex_doctor(sender, instance, using, **kwargs):
+    doctor = copy.copy(instance)
+    transaction.on_commit(lambda: search_index.update_doctor(doctor, deleted=True), using=using)
+
+
+@receiver(post_save, sender=Specialization)
+@receiver(post_save, sender=Qualification)
+def reindex_catalogue_name(sender, instance, using, **kwargs):
+    renamed = copy.copy(instance)
+    transaction.on_commit(lambda: search_index.rename(renamed), using=using)
+
+
+@receiver(post_delete, sender=Qualification)
+def unindex_qualification(sender, instance, using, **kwargs):
+    transaction.on_commit(functools.partial(search_index.remove_qualification, instance.pk), using=using)
+
+
+@receiver(m2m_changed, sender=Doctor.qualifications.through)
+def index_doctor_qualifications(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(functools.partial(index_qualification_links, instance.pk, action, reverse, set(pk_set or ())), using=using)
+
+
+def index_qualification_links(pk, action, reverse, pk_set):
+    if not reverse:
+        if action == 'post_clear':
+            search_index.update_qualifications(pk, qualification_ids=())
+        elif action == 'post_add':
+            search_index.update_qualifications(pk, added=pk_set)
+        else:
+            search_index.update_qualifications(pk, removed=pk_set)
+    elif action == 'post_clear':
+        search_index.remove_qualification(pk)
+    else:
+        for doctor_id in pk_set:
+            if action == 'post_add':
+                search_index.update_qualifications(doctor_id, added=[pk])
+            else:
+                search_index.update_qualifications(doctor_id, removed=[pk])
+
+
+# The slot index only takes committed writes too: a rolled back booking
+# would otherwise hold its slot until the day is reloaded. Instances are
+# copied as they are now, as deleting clears the pk.
+@receiver(post_save, sender=Appointment)
+def update_slot_index(sender, instance, using, **kwargs):
+    appointment = copy.copy(instance)
+    transaction.on_commit(lambda: slot_index.update(appointment), using=using)
+
+
+@receiver(post_delete, sender=Appointment)
+def release_slot(sender, instance, using, **kwargs):
+    appointment = copy.copy(instance)
+    transaction.on_commit(lambda: slot_index.update(appointment, deleted=True), using=using)
+
+
+@receiver(appointments_updated, sender=Appointment)
+def update_slot_index_in_bulk(sender, appointments, **kwargs):
+    by_db = {}
+    for appointment in appointments:
+        by_db.setdefault(appointment._state.db, []).append(appointment)
+    for db, batch in by_db.items():
+        transaction.on_commit(functools.partial(slot_index.update_many, batch), using=db)
+
+
+# Slot claims, unlike the slot index, are written within the saving
+# transaction: their constraint is what refuses a patient's second booking
+# of a slot when the two appointments are on different shards.
+@receiver(post_save, sender=Appointment)
+def claim_patient_slot(sender, instance, raw, **kwargs):
+    if not raw:
+        claim_slot(instance)
+
+
+@receiver(post_delete, sender=Appointment)
+def release_patient_slot(sender, instance, **kwargs):
+    release_slots([instance.pk])
+
+
+@receiver(appointments_updated, sender=Appointment)
+def release_patient_slots_in_bulk(sender, appointments, **kwargs):
+    released = [appointment.pk for appointment in appointments if appointment.status not in Appointment.ACTIVE_STATUSES]
+    if released:
+        release_slots(released)
+
+
+@receiver(pre_save, sender=Appointment)
+def remember_schedule_day(sender, instance, raw, **kwargs):
+    # An edit may move the appointment to another doctor or day.
+    if not raw and not instance._state.adding:
+        previous = sharding.using(Appointment.objects.filter(pk=instance.pk), instance._state.db)
+        instance._previous_schedule_day = previous.values_list('doctor_id', 'date').first()
+
+
+# Schedules, like the slot index, take committed writes only, and outside
+# the writing transaction: each write patches its own entry into the stored
+# day, under the day's lock.
+@receiver(post_save, sender=Appointment)
+def update_doctor_schedule(sender, instance, raw, using, **kwargs):
+    if not raw:
+        previous = getattr(instance, '_previous_schedule_day', None)
+        transaction.on_commit(functools.partial(schedules.apply, copy.copy(instance), previous), using=using)
+
+
+@receiver(post_delete, sender=Appointment)
+def update_doctor_schedule_on_delete(sender, instance, using, **kwargs):
+    # Never materializes a day: the doctor may be going away with it.
+    transaction.on_commit(functools.partial(schedules.apply, copy.copy(instance), deleted=True), using=using)
+
+
+@receiver(appointments_updated, sender=Appointment)
+def update_doctor_schedules_in_bulk(sender, appointments, **kwargs):
+    by_db = {}
+    for appointment in appointments:
+        by_db.setdefault(appointment._state.db, []).append(appointment)
+    for db, batch in by_db.items():
+        transaction.on_commit(functools.partial(schedules.apply_many, batch), using=db)
+
+
+@receiver(post_save, sender=Message)
+def update_inbox(sender, instance, created, **kwargs):
+    # Also bumps the conversation's updated_at.
+    if created:
+        inbox.message_created(instance)
+    else:
+        inbox.message_changed(instance)
+
+
+@receiver(post_delete, sender=Message)
+def update_inbox_on_delete(sender, instance, **kwargs):
+    inbox.message_deleted(instance)
+
+
+@receiver(post_save, sender=Message)
+def publish_message(sender, instance, created, **kwargs):
+    if not created:
+        return
+    from .serializers import MessageSerializer
+    # Keyed by the message's position: ids are not in send order.
+    payload = ((instance.timestamp, instance.pk), JSONEncoder().encode(MessageSerializer(instance).data))
+    channel = f'conversation:{instance.conversation_id}'
+    transaction.on_commit(lambda: get_broker().publish(channel, payload), using=instance._state.db)
+
+
+@receiver(pre_save)
+def assign_shard_id(sender, instance, raw, **kwargs):
+    # Saves routed by ShardRouter already have one; save(using=...) skips it.
+    if not raw and sender in sharding.SHARD_KEYS and instance.pk is None and sharding.is_sharded():
+        sharding.assign_ids([instance])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Specialization)
+@receiver(post_save, sender=Qualification)
+@receiver(post_save, sender=Doctor)
+@receiver(post_save, sender=Patient)
+def copy_reference_row(sender, instance, raw, using, update_fields, **kwargs):
+    # Logins only move last_login, which no shard reads.
+    if raw or using != DEFAULT_DB_ALIAS or update_fields == {'last_login'}:
+        return
+    sharding.queue_resync(sender, pk=instance.pk)
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Specialization)
+@receiver(post_delete, sender=Qualification)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Patient)
+def delete_reference_row(sender, instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS:
+        sharding.queue_resync(sender, pk=instance.pk)
+
+
+@receiver(post_save, sender=Patient)
+def refresh_patient_schedules(sender, instance, created, raw, using, **kwargs):
+    # Queued after copy_reference_row, so shards build from the new details.
+    if not raw and not created and using == DEFAULT_DB_ALIAS:
+        sharding.after_commit(functools.partial(schedules.patient_changed, copy.copy(instance)))
+
+
+@receiver(m2m_changed, sender=Doctor.qualifications.through)
+def copy_doctor_qualifications(sender, instance, action, reverse, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and using == DEFAULT_DB_ALIAS:
+        sharding.queue_resync(sender, **{'qualification_id' if reverse else 'doctor_id': instance.pk})
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+def record_doctor_change(sender, instance, using, **kwargs):
+    if not kwargs.get('raw') and using == DEFAULT_DB_ALIAS:
+        changes.doctors_changed([instance.pk])
+
+
+@receiver(post_save, sender=Specialization)
+@receiver(post_save, sender=Qualification)
+def record_catalogue_rename(sender, instance, created, raw, using, **kwargs):
+    # Deleting a specialization deletes its doctors, which log themselves.
+    if not created and not raw and using == DEFAULT_DB_ALIAS:
+        changes.doctors_changed(instance.doctor_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Qualification)
+def record_qualification_delete(sender, instance, using, **kwargs):
+    # Before the links go, which sends no m2m_changed.
+    if using == DEFAULT_DB_ALIAS:
+        changes.doctors_changed(instance.doctor_set.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Doctor.qualifications.through)
+def record_doctor_qualifications(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if using != DEFAULT_DB_ALIAS:
+        return
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        changes.doctors_changed([instance.pk])
+    elif reverse and action in ('post_add', 'post_remove'):
+        changes.doctors_changed(pk_set)
+    elif reverse and action == 'pre_clear':
+        changes.doctors_changed(instance.doctor_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Patient)
+def record_patient_change(sender, instance, created, raw, using, **kwargs):
+    # Appointments embed their patient.
+    if not created and not raw and using == DEFAULT_DB_ALIAS:
+        changes.patient_changed(instance)
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def record_appointment_change(sender, instance, using, **kwargs):
+    if not kwargs.get('raw'):
+        changes.record('appointments', [instance.pk], using)
+
+
+@receiver(appointments_updated, sender=Appointment)
+def record_appointment_changes_in_bulk(sender, appointments, **kwargs):
+    changes.record_rows('appointments', appointments)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def record_message_change(sender, instance, using, **kwargs):
+    # The inbox receivers above also changed the conversation.
+    if not kwargs.get('raw'):
+        changes.record('messages', [instance.pk], using)
+        changes.record('conversations', [instance.conversation_id], using)
+
+
+@receiver(post_save, sender=Conversation)
+@receiver(post_delete, sender=Conversation)
+def record_conversation_change(sender, instance, using, **kwargs):
+    if not kwargs.get('raw'):
+        changes.record('conversations', [instance.pk], using)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Put first: connection.execute_wrapper() blocks pop from the end, and
+    # one may be active when the connection is opened.
+    if metrics.record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, metrics.record_query)
@@ -0,0 +1,197 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import sharding
+from .models import Appointment
+
+
+class SlotIndex:
+    """Per-day occupancy bitmaps of bookable slots, one int per doctor.
+
+    Bit ``i`` of a doctor's mask is set when the ``i``-th slot of the working
+    day is taken by an active appointment. An appointment is taken to last
+    one slot from its start, so one off the slot grid holds both slots it
+    overlaps, and one outside the working day holds none. Days are loaded from the database
+    on first use with one query per shard, kept current by the appointment signals in
+    ``baseapp.signals`` and reloaded after ``ttl`` seconds so that bookings
+    made by other workers are picked up. At most ``max_days`` days are kept,
+    least recently used ones are dropped first.
+
+    The index also knows which appointments hold each slot and where each
+    one sits, so a reschedule releases the slot it left, and a slot is only
+    freed once no active appointment holds it.
+
+    Updates that arrive while days are being loaded are journaled and
+    applied again once the loaded days are swapped in: the rows read by the
+    load may predate them.
+    """
+
+    def __init__(self, day_start=None, day_end=None, slot_minutes=None, ttl=None, max_days=None):
+        self.day_start = day_start if day_start is not None else getattr(settings, 'APPOINTMENT_DAY_START', datetime.time(9, 0))
+        self.day_end = day_end if day_end is not None else getattr(settings, 'APPOINTMENT_DAY_END', datetime.time(17, 0))
+        self.slot_minutes = slot_minutes or getattr(settings, 'APPOINTMENT_SLOT_MINUTES', 30)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'APPOINTMENT_SLOT_INDEX_TTL', 60)
+        self.max_days = max_days or getattr(settings, 'APPOINTMENT_SLOT_INDEX_MAX_DAYS', 120)
+        self.slots_per_day = (self._minutes(self.day_end) - self._minutes(self.day_start)) // self.slot_minutes
+        self.full_mask = (1 << self.slots_per_day) - 1
+        self._lock = threading.Lock()
+        # date -> (loaded at, {doctor_id: mask}, {(doctor_id, slot): {appointment ids}}),
+        # least recently used first.
+        self._days = OrderedDict()
+        # appointment id -> (date, doctor_id, slots), for the loaded days.
+        self._where = {}
+        # Updates received while any load runs, and how many loads run.
+        self._journal = []
+        self._loading = 0
+
+    @staticmethod
+    def _minutes(value):
+        return value.hour * 60 + value.minute
+
+    def slots_of(self, value):
+        """The slots overlapped by an appointment starting at ``value``."""
+        offset = self._minutes(value) - self._minutes(self.day_start)
+        first = max(offset // self.slot_minutes, 0)
+        last = min((offset + self.slot_minutes - 1) // self.slot_minutes, self.slots_per_day - 1)
+        return tuple(range(first, last + 1))
+
+    def time_of(self, slot):
+        minutes = self._minutes(self.day_start) + slot * self.slot_minutes
+        return datetime.time(minutes // 60, minutes % 60)
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+            self._where.clear()
+
+    def _load(self, dates):
+        """Return ``{date: {doctor_id: mask}}`` for ``dates``, loading the
+        days that are missing or older than the TTL first."""
+        now = time.monotonic()
+        with self._lock:
+            missing = [d for d in dates if d not in self._days or now - self._days[d][0] > self.ttl]
+            if not missing:
+                return self._masks(dates)
+            self._loading += 1
+            start = len(self._journal)
+        try:
+            holders = {d: {} for d in missing}
+            rows = Appointment.objects.filter(
+                date__range=(min(missing), max(missing)),
+                status__in=Appointment.ACTIVE_STATUSES,
+            ).values_list('id', 'doctor_id', 'date', 'time')
+            for shard in sharding.scatter(rows):
+                for pk, doctor_id, date, slot_time in shard.iterator():
+                    if date in holders:
+                        for slot in self.slots_of(slot_time):
+                            holders[date].setdefault((doctor_id, slot), set()).add(pk)
+            with self._lock:
+                for date, day in holders.items():
+                    if date in self._days:
+                        self._drop(date)
+                    masks, slots = {}, {}
+                    for (doctor_id, slot), pks in day.items():
+                        masks[doctor_id] = masks.get(doctor_id, 0) | (1 << slot)
+                        for pk in pks:
+                            slots.setdefault(pk, (doctor_id, []))[1].append(slot)
+                    for pk, (doctor_id, held) in slots.items():
+                        self._where[pk] = (date, doctor_id, tuple(held))
+                    self._days[date] = (now, masks, day)
+                for entry in self._journal[start:]:
+                    self._apply(*entry)
+                result = self._masks(dates)
+                while len(self._days) > self.max_days:
+                    self._drop(next(iter(self._days)))
+                return result
+        finally:
+            with self._lock:
+                self._loading -= 1
+                if not self._loading:
+                    self._journal.clear()
+
+    def _masks(self, dates):
+        result = {}
+        for date in dates:
+            self._days.move_to_end(date)
+            result[date] = dict(self._days[date][1])
+        return result
+
+    def _drop(self, date):
+        for pks in self._days.pop(date)[2].values():
+            for pk in pks:
+                self._where.pop(pk, None)
+
+    def _release(self, pk, date, doctor_id, slots):
+        if date not in self._days:
+            return
+        _, masks, holders = self._days[date]
+        for slot in slots:
+            pks = holders.get((doctor_id, slot), set())
+            pks.discard(pk)
+            if not pks:
+                holders.pop((doctor_id, slot), None)
+                masks[doctor_id] = masks.get(doctor_id, 0) & ~(1 << slot)
+
+    def update_many(self, appointments):
+        for appointment in appointments:
+            self.update(appointment)
+
+    def update(self, appointment, deleted=False):
+        # Instances saved straight from request data may still hold strings.
+        date = Appointment._meta.get_field('date').to_python(appointment.date)
+        slots = self.slots_of(Appointment._meta.get_field('time').to_python(appointment.time))
+        active = not deleted and appointment.status in Appointment.ACTIVE_STATUSES and bool(slots)
+        entry = (appointment.pk, appointment.doctor_id, date, slots, active)
+        with self._lock:
+            if self._loading:
+                self._journal.append(entry)
+            self._apply(*entry)
+
+    def _apply(self, pk, doctor_id, date, slots, active):
+        previous = self._where.pop(pk, None)
+        if previous is not None:
+            self._release(pk, *previous)
+        if not active or date not in self._days:
+            return
+        _, masks, holders = self._days[date]
+        for slot in slots:
+            holders.setdefault((doctor_id, slot), set()).add(pk)
+            masks[doctor_id] = masks.get(doctor_id, 0) | (1 << slot)
+        self._where[pk] = (date, doctor_id, slots)
+
+    def next_available(self, doctor_ids, start, days, now=None, limit=None):
+        """Return ``(doctor_id, date, time)`` of each doctor's earliest free
+        slot within ``days`` days of ``start``, earliest first."""
+        dates = [start + datetime.timedelta(days=i) for i in range(days)]
+        loaded = self._load(dates)
+        pending = set(doctor_ids)
+        found = []
+        for date in dates:
+            if not pending:
+                break
+            day = loaded[date]
+            free_from = self.full_mask
+            if now is not None and date == now.date():
+                # Slots that already started today are not bookable.
+                elapsed = self._minutes(now.time()) - self._minutes(self.day_start)
+                passed = min(max(elapsed // self.slot_minutes + 1, 0), self.slots_per_day)
+                free_from &= ~((1 << passed) - 1)
+            day_found = []
+            for doctor_id in pending:
+                free = free_from & ~day.get(doctor_id, 0)
+                if free:
+                    day_found.append(((free & -free).bit_length() - 1, doctor_id))
+            day_found.sort()
+            for slot, doctor_id in day_found:
+                pending.discard(doctor_id)
+                found.append((doctor_id, date, self.time_of(slot)))
+            if limit is not None and len(found) >= limit:
+                return found[:limit]
+        return found
+
+
+slot_index = SlotIndex()
@@ -0,0 +1,245 @@
+import contextlib
+import datetime
+import logging
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import send_mail
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from . import changes, sharding
+from .images import ensure_variants
+from .models import Appointment, Doctor, Task
+from .presence import presence
+
+logger = logging.getLogger(__name__)
+
+# Task name -> function, filled by the @task decorator below.
+TASKS = {}
+
+
+def task(name=None, max_attempts=None, every=None):
+    """Register a function as a task. It is called with the task's payload
+    as keyword arguments, so the payload must be JSON serializable. Tasks
+    with ``every`` (seconds, or a callable returning them) also run on
+    their own that often; see ``schedule_periodic``."""
+    def register(func):
+        func.task_name = name or func.__name__
+        func.max_attempts = max_attempts
+        func.every = every
+        TASKS[func.task_name] = func
+        return func
+    return register
+
+
+def retry_delay(attempts):
+    """Exponential backoff: TASK_RETRY_DELAY seconds after the first
+    failure, doubling up to TASK_RETRY_MAX_DELAY."""
+    base = getattr(settings, 'TASK_RETRY_DELAY', 10)
+    return min(base * 2 ** (attempts - 1), getattr(settings, 'TASK_RETRY_MAX_DELAY', 3600))
+
+
+def lease_seconds():
+    # A running task whose worker has not finished it within this long is
+    # assumed lost and handed to another worker.
+    return getattr(settings, 'TASK_LEASE_SECONDS', 300)
+
+
+def enqueue(func, payload=None, dedup_key=None, delay=0, max_attempts=None):
+    """Queue ``func`` (a registered task or its name) and return the Task.
+    While a task with the same ``dedup_key`` is queued or running, that
+    task is returned instead of queueing another. Inside a transaction the
+    task commits or rolls back with the caller's writes."""
+    name = getattr(func, 'task_name', func)
+    if name not in TASKS:
+        raise LookupError(f'Unknown task {name!r}')
+    max_attempts = max_attempts or getattr(TASKS[name], 'max_attempts', None) or getattr(settings, 'TASK_MAX_ATTEMPTS', 5)
+    fields = {
+        'name': name,
+        'payload': payload or {},
+        'dedup_key': dedup_key,
+        'max_attempts': max_attempts,
+        'run_at': timezone.now() + datetime.timedelta(seconds=delay),
+    }
+    if dedup_key is None:
+        return Task.objects.create(**fields)
+    active = Task.objects.filter(dedup_key=dedup_key, status__in=Task.ACTIVE_STATUSES)
+    existing = active.first()
+    if existing is not None:
+        return existing
+    try:
+        with transaction.atomic():
+            return Task.objects.create(**fields)
+    except IntegrityError:
+        # Lost a race with another enqueue of the same key.
+        return active.get()
+
+
+def schedule_periodic():
+    """Queue the next run of each periodic task, ``every`` seconds from now,
+    unless one is already queued or running. Workers call this as they
+    poll; the dedup key keeps it to one run at a time across all of them."""
+    for func in TASKS.values():
+        if func.every is not None:
+            every = func.every() if callable(func.every) else func.every
+            enqueue(func, dedup_key=f'periodic:{func.task_name}', delay=every)
+
+
+def claim(limit=1):
+    """Lease up to ``limit`` due tasks to the caller and return them. Rows
+    are picked with SKIP LOCKED where the database supports it, and the
+    status check is repeated in the UPDATE, so concurrent workers never
+    claim the same task."""
+    now = timezone.now()
+    lease = uuid.uuid4().hex
+    due = Task.objects.filter(
+        Q(status='queued', run_at__lte=now)
+        | Q(status='running', locked_at__lt=now - datetime.timedelta(seconds=lease_seconds()))
+    )
+    # Without SKIP LOCKED (SQLite) the guarded UPDATE alone decides who gets
+    # a row; staying in autocommit there avoids failed lock upgrades.
+    db = router.db_for_write(Task)
+    locking = connections[db].features.has_select_for_update_skip_locked
+    with transaction.atomic(using=db) if locking else contextlib.nullcontext():
+        ids = list(due.select_for_update(skip_locked=True).order_by('run_at', 'id').values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        due.filter(pk__in=ids).update(status='running', lease=lease, locked_at=now, attempts=F('attempts') + 1)
+    return list(Task.objects.filter(pk__in=ids, lease=lease).order_by('run_at', 'id'))
+
+
+def execute(task):
+    """Run one claimed task and record the outcome. A failure is retried
+    after ``retry_delay`` until the task runs out of attempts. Updates are
+    guarded by the lease, so a task that was handed to another worker after
+    its lease expired is not finished twice."""
+    leased = Task.objects.filter(pk=task.pk, lease=task.lease)
+    started = time.perf_counter()
+    try:
+        if task.attempts > task.max_attempts:
+            raise RuntimeError('Lease expired on the final attempt')
+        func = TASKS.get(task.name)
+        if func is None:
+            raise LookupError(f'Unknown task {task.name!r}')
+        func(**task.payload)
+    except Exception:
+        error = traceback.format_exc()
+        now = timezone.now()
+        if task.attempts >= task.max_attempts:
+            task.status = 'failed'
+            leased.update(status='failed', lease='', last_error=error, finished_at=now)
+        else:
+            task.status = 'queued'
+            leased.update(status='queued', lease='', last_error=error, run_at=now + datetime.timedelta(seconds=retry_delay(task.attempts)))
+        logger.warning('Task %s %s failed (attempt %s of %s)', task.name, task.pk, task.attempts, task.max_attempts, exc_info=True)
+    else:
+        task.status = 'succeeded'
+        leased.update(status='succeeded', lease='', finished_at=timezone.now())
+        logger.info('Task %s %s succeeded in %.3fs', task.name, task.pk, time.perf_counter() - started)
+    return task
+
+
+class Worker:
+    """Claims and runs due tasks, polling every ``poll_interval`` seconds
+    when there are none. ``stop`` (also a signal handler) lets the current
+    batch finish; ``burst`` workers exit as soon as the queue is empty."""
+
+    def __init__(self, batch_size=10, poll_interval=None, burst=False, max_tasks=None):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval if poll_interval is not None else getattr(settings, 'TASK_POLL_INTERVAL', 1.0)
+        self.burst = burst
+        self.max_tasks = max_tasks
+        self.stopping = False
+        self.scheduled_at = None
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        ran = 0
+        while not self.stopping and (self.max_tasks is None or ran < self.max_tasks):
+            # Periodic tasks are checked at most once per poll interval.
+            if self.scheduled_at is None or time.monotonic() - self.scheduled_at >= self.poll_interval:
+                schedule_periodic()
+                self.scheduled_at = time.monotonic()
+            limit = self.batch_size if self.max_tasks is None else min(self.batch_size, self.max_tasks - ran)
+            claimed = claim(limit)
+            if not claimed:
+                if self.burst:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            for task in claimed:
+                execute(task)
+                ran += 1
+        return ran
+
+
+def prune(older_than_days=None):
+    """Delete finished tasks older than TASK_RETENTION_DAYS."""
+    days = older_than_days if older_than_days is not None else getattr(settings, 'TASK_RETENTION_DAYS', 7)
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    deleted, _ = Task.objects.filter(status__in=('succeeded', 'failed'), finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def metric_lines():
+    """Prometheus lines describing the queue, for /metrics/."""
+    lines = ['# HELP baseapp_tasks Tasks by name and status.', '# TYPE baseapp_tasks gauge']
+    for row in Task.objects.values('name', 'status').annotate(count=Count('id')).order_by('name', 'status'):
+        lines.append(f'baseapp_tasks{{name="{row["name"]}",status="{row["status"]}"}} {row["count"]}')
+    retries = Task.objects.filter(attempts__gt=1).values('name').annotate(count=Count('id')).order_by('name')
+    lines += ['# HELP baseapp_tasks_retried Tasks that needed more than one attempt.', '# TYPE baseapp_tasks_retried gauge']
+    lines += [f'baseapp_tasks_retried{{name="{row["name"]}"}} {row["count"]}' for row in retries]
+    now = timezone.now()
+    oldest = Task.objects.filter(status='queued', run_at__lte=now).aggregate(oldest=Min('run_at'))['oldest']
+    lines += [
+        '# HELP baseapp_task_queue_lag_seconds How long the oldest due task has been waiting.',
+        '# TYPE baseapp_task_queue_lag_seconds gauge',
+        f'baseapp_task_queue_lag_seconds {(now - oldest).total_seconds() if oldest else 0:.3f}',
+    ]
+    return lines
+
+
+@task()
+def send_welcome_email(user_id):
+    user = User.objects.filter(pk=user_id).exclude(email='').first()
+    if user is None:
+        return
+    send_mail(
+        'Welcome',
+        f'Hello {user.get_full_name() or user.username},\n\nYour account has been created.',
+        None,
+        [user.email],
+    )
+
+
+@task()
+def send_appointment_confirmation(appointment_id):
+    appointment = sharding.first(sharding.scatter(Appointment.objects.select_related('doctor', 'patient').filter(pk=appointment_id)))
+    if appointment is None or not appointment.patient.email:
+        return
+    send_mail(
+        'Appointment booked',
+        f'Hello {appointment.patient.name},\n\nYour appointment with {appointment.doctor.name} '
+        f'on {appointment.date:%Y-%m-%d} at {appointment.time:%H:%M} is booked.',
+        None,
+        [appointment.patient.email],
+    )
+
+
+@task()
+def render_doctor_image_variants(doctor_id, image_hash):
+    doctor = Doctor.objects.filter(pk=doctor_id, image_hash=image_hash).first()
+    if doctor is not None:
+        ensure_variants(doctor)
+
+
+@task(every=presence.flush_interval)
+def flush_doctor_presence():
+    changes.doctors_changed(presence.flush())
@@ -1,3 +1,1598 @@
-from django.test import TestCase
+import asyncio
+import copy
+import datetime
+import functools
+import io
+import json
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django import test
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from . import archive, benchmarks, booking, changes, factories, images, inbox, metrics, routers, schedules, sharding, tasks
+from .authentication import JWTAuthentication, issue_tokens
+from .booking import insert_appointment, transition_appointments
+from .broker import InProcessBroker
+from .cache import doctor_cache
+from .importer import Importer
+from .middleware import MetricsMiddleware
+from .presence import presence
+from .fast_serializers import fast_appointments, fast_medical_records, fast_messages
+from .models import Doctor, Patient, Appointment, MedicalRecord, Qualification, Specialization, Conversation, Message, ImportJob, Task, Change, DoctorSchedule, PatientSlotClaim
+from .search import DoctorSearchIndex, search_index
+from .slots import SlotIndex, slot_index
+from .serializers import AppointmentSerializer, MedicalRecordSerializer, MessageSerializer
+
+
+
+@contextmanager
+def default_commits():
+    """Run ``sharding.after_commit`` callbacks as commits of the default
+    database would: a TestCase's transaction never commits, and reference
+    rows only reach the other shards after a commit."""
+    pending = []
+
+    def depth():
+        return sum(not block._from_testcase for block in connections[DEFAULT_DB_ALIAS].atomic_blocks)
+
+    def after_commit(func):
+        if depth():
+            pending.append((depth(), func))
+        else:
+            func()
+
+    atomic_exit = transaction.Atomic.__exit__
+
+    def exit(atomic, exc_type, exc_value, traceback):
+        connection = transaction.get_connection(atomic.using)
+        if connection.alias != DEFAULT_DB_ALIAS:
+            return atomic_exit(atomic, exc_type, exc_value, traceback)
+        level, committed = depth(), exc_type is None and not connection.needs_rollback
+        result = atomic_exit(atomic, exc_type, exc_value, traceback)
+        if not committed:
+            pending[:] = [(at, func) for at, func in pending if at < level]
+        elif level > 1:
+            pending[:] = [(min(at, level - 1), func) for at, func in pending]
+        else:
+            while pending:
+                pending.pop(0)[1]()
+        return result
+
+    with mock.patch.object(sharding, 'after_commit', after_commit), mock.patch.object(transaction.Atomic, '__exit__', exit):
+        yield
+
+
+class ShardedTestMixin:
+    # Reference rows are copied to every shard and listings read them all
+    # (see baseapp.sharding), so any test may use any shard.
+    databases = set(settings.DATABASE_SHARDS)
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        # ShardSequence rows are rolled back or flushed after each test, so
+        # ids left in a block reserved earlier would be reserved again.
+        sharding.id_allocator.clear()
+
+    def assertNumQueries(self, num, func=None, *args, using=None, **kwargs):
+        """As TestCase's, but by default counting the queries of every shard."""
+        if using is not None:
+            return super().assertNumQueries(num, func, *args, using=using, **kwargs)
+        context = self.capture_shard_queries(num)
+        if func is None:
+            return context
+        with context:
+            func(*args, **kwargs)
+
+    @contextmanager
+    def capture_shard_queries(self, num):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in sharding.shard_aliases()]
+            yield
+        queries = [query['sql'] for context in captured for query in context.captured_queries]
+        self.assertEqual(len(queries), num, '\n'.join(queries))
+
+
+class TestCase(ShardedTestMixin, test.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # setUpTestData runs in here.
+        with default_commits():
+            super().setUpClass()
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        self.enterContext(default_commits())
+
+    @classmethod
+    @contextmanager
+    def captureOnCommitCallbacks(cls, *, using=None, execute=False):
+        """As TestCase's, but by default for every shard: sharded rows are
+        written, and their callbacks registered, on their shard's connection."""
+        with ExitStack() as stack:
+            callbacks = []
+            for alias in [using] if using else sharding.shard_aliases():
+                callbacks.append(stack.enter_context(super().captureOnCommitCallbacks(using=alias, execute=execute)))
+            yield callbacks[0]
+
+
+class TransactionTestCase(ShardedTestMixin, test.TransactionTestCase):
+    pass
+
+
+class DoctorDirectoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cursor_pages_cover_every_doctor_once_with_bounded_queries(self):
+        cardiology = Specialization.objects.create(name='Cardiology')
+        neurology = Specialization.objects.create(name='Neurology')
+        mbbs = Qualification.objects.create(name='MBBS')
+        doctors = []
+        for i in range(5):
+            doctor = Doctor.objects.create(user=User.objects.create_user(f'doc{i}'), name=f'Doc {i}', email=f'doc{i}@example.com', office_number=str(i), specialization=neurology if i == 3 else cardiology, years_of_experience=i)
+            doctor.qualifications.set([mbbs])
+            doctors.append(doctor)
+        url, seen = reverse('get_all_doctors'), []
+        params = {'page_size': 2}
+        while url:
+            # Validators, page, qualifications: the same for any page size.
+            with self.assertNumQueries(3):
+                page = self.client.get(url, params).json()
+            seen += [d['id'] for d in page['results']]
+            self.assertTrue(all(d['qualifications'] == 'MBBS' for d in page['results']))
+            url, params = page['next'], {}
+        self.assertEqual(seen, [d.pk for d in doctors])
+        with self.assertNumQueries(3):
+            self.client.get(reverse('get_all_doctors'), {'page_size': 200})
+        self.assertEqual([d['id'] for d in self.client.get(reverse('get_all_doctors'), {'specialization': 'neurology'}).json()['results']], [doctors[3].pk])
+        self.assertEqual(self.client.get(reverse('get_all_doctors'), {'cursor': 'bogus'}).status_code, 404)
+
+
+class DoctorCacheTests(TestCase):
+    def test_version_moves_only_once_the_write_commits(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        url = reverse('get_doctor_details', kwargs={'doctor_id': doctor.pk})
+        self.client.force_login(doctor.user)
+        before = doctor_cache.version()
+        with self.captureOnCommitCallbacks(execute=True):
+            doctor.name = 'Renamed'
+            doctor.save()
+            # A reader before the commit still sees, and caches, the old version.
+            self.assertEqual(doctor_cache.version(), before)
+        self.assertNotEqual(doctor_cache.version(), before)
+        self.assertEqual(self.client.get(url).json()['name'], 'Renamed')
+
+
+class FastSerializerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cardiology = Specialization.objects.create(name='Cardiology')
+        mbbs = Qualification.objects.create(name='MBBS')
+        md = Qualification.objects.create(name='MD')
+        cls.doctors = []
+        for i in range(3):
+            doctor = Doctor.objects.create(
+                user=User.objects.create_user(f'doctor{i}'),
+                name=f'Doctor {i}',
+                email=f'doctor{i}@example.com',
+                office_number=str(100 + i),
+                specialization=cardiology,
+                years_of_experience=i,
+                image='doctors/doctor_1.png' if i == 1 else None,
+                available=i != 2,
+            )
+            doctor.qualifications.set([md, mbbs][:i])
+            cls.doctors.append(doctor)
+        patient_user = User.objects.create_user('patient', first_name='Pat')
+        patient = Patient.objects.create(
+            user=patient_user,
+            name='Patient',
+            date_of_birth=datetime.date(1990, 5, 17),
+            gender='F',
+            phone_number='1234567890',
+            age=34,
+            blood_group='O+',
+        )
+        for i, doctor in enumerate(cls.doctors):
+            Appointment.objects.create(doctor=doctor, patient=patient, date=datetime.date(2030, 1, 2), time=datetime.time(9 + i, 30), status='pending')
+            MedicalRecord.objects.create(doctor=doctor, patient=patient, description=f'Visit {i}')
+            conversation = Conversation.objects.create(doctor=doctor.user, patient=patient_user)
+            Message.objects.create(conversation=conversation, sender=doctor.user, content='Hello')
+            Message.objects.create(conversation=conversation, sender=patient_user, content='Hi')
+
+    def assertSameJSON(self, fast, serializer_class, queryset):
+        renderer = JSONRenderer()
+        for queryset in sharding.scatter(queryset):
+            expected = renderer.render(serializer_class(queryset, many=True).data)
+            self.assertEqual(renderer.render(fast.serialize(queryset)), expected)
+
+    def test_appointments(self):
+        self.assertSameJSON(fast_appointments, AppointmentSerializer, Appointment.objects.order_by('date', 'time', 'id'))
+
+    def test_medical_records(self):
+        self.assertSameJSON(fast_medical_records, MedicalRecordSerializer, MedicalRecord.objects.order_by('id'))
+
+    def test_messages(self):
+        self.assertSameJSON(fast_messages, MessageSerializer, Message.objects.order_by('-timestamp', '-id'))
+
+    def test_fixed_query_count(self):
+        with self.assertNumQueries(2):
+            fast_appointments.serialize(Appointment.objects.all())
+
+    def test_live_availability_is_read_once_per_call(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        presence.heartbeat(self.doctors[2].pk)
+        rows = [row for queryset in sharding.scatter(Appointment.objects.all()) for row in fast_appointments.values(queryset)]
+        with mock.patch.object(presence.shared, 'get_many', wraps=presence.shared.get_many) as get_many:
+            data = fast_appointments.serialize_rows(rows)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual({a['doctor']['id']: a['doctor']['available'] for a in data}, {doctor.pk: True for doctor in self.doctors})
+
+    def test_fast_query_param_matches_the_model_serializer_responses(self):
+        patient = Patient.objects.get()
+        self.client.force_login(self.doctors[0].user)
+        for url in (
+            reverse('get_all_appointments_ordered'),
+            reverse('get_all_messages'),
+            reverse('get_patient_medical_records', kwargs={'patient_id': patient.pk}),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url, {'fast': 'true'}).json(), self.client.get(url, {'fast': 'false'}).json())
+
+
+class ConversationHistoryTests(TestCase):
+    def test_before_and_after_cursors_page_without_gaps(self):
+        doctor, patient, stranger = (User.objects.create_user(name) for name in ('doc', 'pat', 'stranger'))
+        conversation = Conversation.objects.create(doctor=doctor, patient=patient)
+        messages = [Message.objects.create(conversation=conversation, sender=patient, content=f'Message {i}') for i in range(5)]
+        url = reverse('get_conversation_messages', kwargs={'conversation_id': conversation.pk})
+        self.client.force_login(patient)
+        first = self.client.get(url, {'page_size': 2}).json()
+        self.assertEqual([m['id'] for m in first['results']], [messages[4].pk, messages[3].pk])
+        second = self.client.get(url, {'page_size': 2, 'before': first['before']}).json()
+        last = self.client.get(url, {'page_size': 2, 'before': second['before']}).json()
+        self.assertEqual([m['id'] for m in second['results'] + last['results']], [messages[2].pk, messages[1].pk, messages[0].pk])
+        self.assertIsNone(last['before'])
+        newer = Message.objects.create(conversation=conversation, sender=doctor, content='Reply')
+        self.assertEqual([m['id'] for m in self.client.get(url, {'after': first['after']}).json()['results']], [newer.pk])
+        self.assertEqual(self.client.get(url, {'before': 'not-a-cursor'}).status_code, 404)
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class MessageEventsAuthTests(TestCase):
+    def setUp(self):
+        self.doctor, self.patient, self.stranger = (User.objects.create_user(name) for name in ('doc', 'pat', 'stranger'))
+        self.conversation = Conversation.objects.create(doctor=self.doctor, patient=self.patient)
+        self.url = reverse('stream_conversation_events', kwargs={'conversation_id': self.conversation.pk})
+
+    def status_of(self, **headers):
+        # Only the headers are read; the stream itself never ends.
+        response = self.client.get(self.url, headers=headers)
+        response.close()
+        return response.status_code
+
+    def test_token_jwt_and_session_clients_are_authenticated(self):
+        self.assertEqual(self.status_of(Authorization=f'Token {Token.objects.create(user=self.patient).key}'), 200)
+        with override_settings(JWT_AUTH=True):
+            self.assertEqual(self.status_of(Authorization=f'Bearer {issue_tokens(self.doctor)["access"]}'), 200)
+        self.client.force_login(self.patient)
+        self.assertEqual(self.status_of(), 200)
+
+    def test_missing_or_bad_credentials_are_rejected(self):
+        self.assertEqual(self.status_of(), 401)
+        self.assertEqual(self.status_of(Authorization='Token not-a-token'), 401)
+
+    def test_only_participants_may_subscribe(self):
+        self.assertEqual(self.status_of(Authorization=f'Token {Token.objects.create(user=self.stranger).key}'), 404)
+
+
+class MessageEventsTests(TestCase):
+    def setUp(self):
+        self.doctor, self.patient = (User.objects.create_user(name) for name in ('doc', 'pat'))
+        self.conversation = Conversation.objects.create(doctor=self.doctor, patient=self.patient)
+        self.url = reverse('stream_conversation_events', kwargs={'conversation_id': self.conversation.pk})
+        self.token = Token.objects.create(user=self.patient).key
+        # A broker of our own, so that the overflow limit is small.
+        patcher = mock.patch('baseapp.broker._broker', InProcessBroker(max_pending=2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, *contents):
+        # As create_message does; messages are published once committed.
+        with self.captureOnCommitCallbacks(execute=True):
+            return [Message.objects.create(conversation=self.conversation, sender=self.doctor, content=content) for content in contents]
+
+    async def subscribe(self, **headers):
+        response = await self.async_client.get(self.url, headers={'Authorization': f'Token {self.token}', **headers})
+        events = aiter(response.streaming_content)
+        self.assertEqual(await anext(events), b'retry: 3000\n\n')
+        return events
+
+    async def test_committed_messages_reach_subscribers(self):
+        events = await self.subscribe()
+        [message] = await sync_to_async(self.send)('Hello')
+        frame = (await asyncio.wait_for(anext(events), 5)).decode()
+        head, data = frame.split('data: ')
+        self.assertEqual(head, f'id: {message.pk}\nevent: message\n')
+        self.assertEqual(json.loads(data)['content'], 'Hello')
+        self.assertEqual(json.loads(data)['id'], message.pk)
+
+    async def test_overflowing_subscribers_are_cut_off_and_replay_on_reconnect(self):
+        events = await self.subscribe()
+        messages = await sync_to_async(self.send)('One', 'Two', 'Three')
+        # The queue holds two: the stream ends rather than drop one silently.
+        with self.assertRaises(StopAsyncIteration):
+            await asyncio.wait_for(anext(events), 5)
+        events = await self.subscribe(**{'Last-Event-ID': str(messages[0].pk)})
+        frames = [(await asyncio.wait_for(anext(events), 5)).decode() for _ in messages[1:]]
+        self.assertEqual([frame.split('\n')[0] for frame in frames], [f'id: {message.pk}' for message in messages[1:]])
+
+    async def test_replay_follows_send_order_not_ids(self):
+        # Ids come from per-process blocks, so a later message may have a lower one.
+        def send(pk, content):
+            with self.captureOnCommitCallbacks(execute=True):
+                return Message.objects.create(pk=pk, conversation=self.conversation, sender=self.doctor, content=content)
+
+        seen = await sync_to_async(send)(500, 'One')
+        missed = await sync_to_async(send)(400, 'Two')
+        events = await self.subscribe(**{'Last-Event-ID': str(seen.pk)})
+        self.assertEqual((await asyncio.wait_for(anext(events), 5)).decode().split('\n')[0], f'id: {missed.pk}')
+        live = await sync_to_async(send)(300, 'Three')
+        self.assertEqual((await asyncio.wait_for(anext(events), 5)).decode().split('\n')[0], f'id: {live.pk}')
+
+
+@override_settings(JWT_AUTH=True)
+class JWTAuthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user('jwt', password='secret')
+
+    def login(self):
+        response = self.client.post(reverse('login_user'), {'username': 'jwt', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def inbox_status(self, access):
+        return self.client.get(reverse('get_inbox'), headers={'Authorization': f'Bearer {access}'}).status_code
+
+    def test_login_issues_tokens_that_authenticate(self):
+        tokens = self.login()
+        self.assertEqual(set(tokens), {'access', 'refresh'})
+        self.assertEqual(self.inbox_status(tokens['access']), 200)
+        # A refresh token is not an access token.
+        self.assertEqual(self.inbox_status(tokens['refresh']), 401)
+
+    def test_expired_token_is_rejected(self):
+        with override_settings(JWT_ACCESS_LIFETIME=-1):
+            tokens = self.login()
+        self.assertEqual(self.inbox_status(tokens['access']), 401)
+
+    def test_logout_revokes_both_tokens(self):
+        tokens = self.login()
+        response = self.client.post(reverse('logout_user'), {'refresh': tokens['refresh']}, headers={'Authorization': f'Bearer {tokens["access"]}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.inbox_status(tokens['access']), 401)
+        self.assertEqual(self.client.post(reverse('refresh_token'), {'refresh': tokens['refresh']}).status_code, 401)
+
+    def test_refresh_token_is_single_use(self):
+        tokens = self.login()
+        response = self.client.post(reverse('refresh_token'), {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.inbox_status(response.json()['access']), 200)
+        self.assertEqual(self.client.post(reverse('refresh_token'), {'refresh': tokens['refresh']}).status_code, 401)
+
+    def test_concurrent_refresh_is_won_once(self):
+        # Both requests passed the revocation check before either revoked.
+        tokens = self.login()
+        with mock.patch('baseapp.authentication.revocations.is_revoked', return_value=False):
+            statuses = [self.client.post(reverse('refresh_token'), {'refresh': tokens['refresh']}).status_code for _ in range(2)]
+        self.assertEqual(statuses, [200, 401])
+
+    def test_access_tokens_carry_the_user_names(self):
+        User.objects.filter(username='jwt').update(first_name='Real', last_name='Name')
+        access = self.login()['access']
+        request = APIRequestFactory().get('/', headers={'Authorization': f'Bearer {access}'})
+        user, _ = JWTAuthentication().authenticate(request)
+        self.assertEqual((user.username, user.first_name, user.last_name), ('jwt', 'Real', 'Name'))
+
+    def test_bearer_tokens_are_ignored_when_disabled(self):
+        tokens = self.login()
+        with override_settings(JWT_AUTH=False):
+            self.assertEqual(self.inbox_status(tokens['access']), 401)
+
+
+@override_settings(METRICS_TOKEN='scraper-token')
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        Doctor.objects.create(user=User.objects.create_user('metered'), name='Metered', email='metered@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+
+    def exported(self):
+        response = self.client.get(reverse('export_metrics'), headers={'Authorization': 'Bearer scraper-token'})
+        self.assertEqual(response.status_code, 200)
+        return dict(line.rsplit(' ', 1) for line in response.content.decode().splitlines() if not line.startswith('#'))
+
+    def test_only_staff_and_the_scraper_token_may_read_metrics(self):
+        url = reverse('export_metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer wrong-token'}).status_code, 403)
+        with override_settings(METRICS_TOKEN=''):
+            # No token configured: an empty bearer token must not match.
+            self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer '}).status_code, 403)
+        user = User.objects.create_user('scraper')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.logout()
+        token = Token.objects.create(user=user)
+        self.assertEqual(self.client.get(url, headers={'Authorization': f'Token {token.key}'}).status_code, 200)
+        with override_settings(JWT_AUTH=True):
+            access = issue_tokens(user)['access']
+            self.assertEqual(self.client.get(url, headers={'Authorization': f'Bearer {access}'}).status_code, 200)
+            self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer scraper-token'}).status_code, 200)
+
+    def test_requests_are_recorded_per_route(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('get_all_doctors'))
+        # Read before the next request resets the query log.
+        expected_queries = len(queries)
+        self.client.get('/no-such-route/')
+        exported = self.exported()
+        self.assertEqual(exported['baseapp_responses_total{route="get_all_doctors",status="200"}'], '1')
+        self.assertEqual(exported['baseapp_responses_total{route="unmatched",status="404"}'], '1')
+        self.assertEqual(float(exported['baseapp_request_sql_queries_sum{route="get_all_doctors"}']), expected_queries)
+        self.assertEqual(float(exported['baseapp_response_size_bytes_sum{route="get_all_doctors"}']), len(response.content))
+        self.assertGreater(float(exported['baseapp_request_serializer_duration_seconds_sum{route="get_all_doctors"}']), 0)
+        self.assertEqual(exported['baseapp_request_duration_seconds_bucket{route="get_all_doctors",le="+Inf"}'], '1')
+
+    @override_settings(METRICS_LOG_QUERIES=True, METRICS_REPEAT_THRESHOLD=2)
+    def test_repeated_queries_are_logged(self):
+        stats = metrics.RequestStats(log_queries=True)
+        for pk in (1, 2, 2):
+            stats.add_query('SELECT * FROM baseapp_doctor WHERE id = %s', (pk,), 0.0)
+        with self.assertLogs('baseapp.metrics', 'WARNING') as logs:
+            MetricsMiddleware(lambda request: None).log_repeats('get_doctor_details', stats)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('Duplicate query on get_doctor_details (2 times)', logs.output[0])
+        self.assertIn('Possible N+1 on get_doctor_details (3 times)', logs.output[1])
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.doctor = Doctor.objects.create(
+            user=User.objects.create_user('imaged'),
+            name='Imaged',
+            email='imaged@example.com',
+            office_number='1',
+            specialization=Specialization.objects.create(name='Radiology'),
+            years_of_experience=1,
+        )
+        output = io.BytesIO()
+        Image.new('RGB', (300, 200), 'red').save(output, 'PNG')
+        self.doctor.image.save('source.png', ContentFile(output.getvalue()))
+
+    def test_variant_is_rendered_once_and_cached_by_content(self):
+        url = self.doctor.image_variants['thumb']
+        self.assertIn(self.doctor.image_hash, url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(b''.join(response.streaming_content))).size, (64, 64))
+        response.close()
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+            response.close()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url.replace('thumb', 'huge')).status_code, 404)
+        self.assertEqual(self.client.get(url.replace(self.doctor.image_hash, '0' * 64)).status_code, 404)
+
+    def upload(self, colour, size=(300, 200)):
+        output = io.BytesIO()
+        Image.new('RGB', size, colour).save(output, 'PNG')
+        self.doctor.image.save('source.png', ContentFile(output.getvalue()))
+
+    def test_hash_follows_the_content_only(self):
+        old_hash, old_urls = self.doctor.image_hash, self.doctor.image_variants
+        self.doctor = Doctor.objects.get(pk=self.doctor.pk)
+        with mock.patch('baseapp.images.content_hash') as content_hash:
+            self.doctor.name = 'Renamed'
+            self.doctor.save()
+        content_hash.assert_not_called()
+        self.upload('blue')
+        self.assertNotEqual(self.doctor.image_hash, old_hash)
+        self.assertNotEqual(self.doctor.image_variants, old_urls)
+        self.assertEqual(set(self.doctor.image_variants), set(images.variant_sizes()))
+        self.doctor.image = None
+        self.doctor.save()
+        self.assertIsNone(self.doctor.image_variants)
+
+    @override_settings(DOCTOR_IMAGE_EAGER_VARIANTS=True)
+    def test_eager_variants_are_rendered_by_a_task(self):
+        self.upload('green', size=(120, 400))
+        self.assertEqual(tasks.Worker(burst=True).run(), 1)
+        storage = images.variant_storage()
+        for variant, size in images.variant_sizes().items():
+            with storage.open(images.variant_name(self.doctor.image_hash, variant)) as file:
+                self.assertEqual(Image.open(file).size, (size, size))
+        # A task queued for an image that has since been replaced does nothing.
+        stale = self.doctor.image_hash
+        Doctor.objects.filter(pk=self.doctor.pk).update(image_hash='f' * 64)
+        tasks.enqueue(tasks.render_doctor_image_variants, {'doctor_id': self.doctor.pk, 'image_hash': stale})
+        with mock.patch('baseapp.tasks.ensure_variants') as ensure_variants:
+            self.assertEqual(tasks.Worker(burst=True).run(), 1)
+        ensure_variants.assert_not_called()
+
+
+class DoctorSearchTests(TestCase):
+    def test_prefix_fuzzy_and_incremental_updates(self):
+        neurology = Specialization.objects.create(name='Neurology')
+        cardiology = Specialization.objects.create(name='Cardiology')
+        meena = Doctor.objects.create(user=User.objects.create_user('meena'), name='Meena Rao', email='m@example.com', office_number='1', specialization=neurology, years_of_experience=3)
+        Doctor.objects.create(user=User.objects.create_user('neil'), name='Neil Kumar', email='n@example.com', office_number='2', specialization=cardiology, years_of_experience=3)
+        index = DoctorSearchIndex(ttl=60)
+        self.assertEqual([d for d, _ in index.search('neu')], [meena.pk])
+        self.assertEqual([d for d, _ in index.search('nuerology rao')], [meena.pk])
+        self.assertEqual(index.search('rao cardiology'), [])
+        index.update_doctor(Doctor(pk=meena.pk, name='Meena Iyer', specialization=neurology, available=True))
+        self.assertEqual(index.search('rao'), [])
+        mrcp = Qualification.objects.create(name='MRCP')
+        index.update_qualifications(meena.pk, added=[mrcp.pk])
+        self.assertEqual([d for d, _ in index.search('mrc iyer')], [meena.pk])
+
+
+class DoctorSearchCommitTests(TransactionTestCase):
+    def setUp(self):
+        search_index.clear()
+        self.addCleanup(search_index.clear)
+
+    def found(self, query):
+        return [doctor_id for doctor_id, _ in search_index.search(query)]
+
+    def test_only_committed_writes_reach_the_index(self):
+        neurology = Specialization.objects.create(name='Neurology')
+        meena = Doctor.objects.create(user=User.objects.create_user('meena'), name='Meena Rao', email='m@example.com', office_number='1', specialization=neurology, years_of_experience=3)
+        self.assertEqual(self.found('neurology'), [meena.pk])
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            Doctor.objects.create(user=User.objects.create_user('neil'), name='Neil Kumar', email='n@example.com', office_number='2', specialization=neurology, years_of_experience=3)
+            neurology.name = 'Cardiology'
+            neurology.save()
+            meena.qualifications.add(Qualification.objects.create(name='MRCP'))
+            raise RuntimeError
+        self.assertEqual(self.found('neurology'), [meena.pk])
+        self.assertEqual(self.found('kumar'), [])
+        self.assertEqual(self.found('cardiology'), [])
+        self.assertEqual(self.found('mrcp'), [])
+        with transaction.atomic():
+            neurology.name = 'Cardiology'
+            neurology.save()
+            meena.qualifications.add(Qualification.objects.create(name='MRCP'))
+        self.assertEqual(self.found('cardiology mrcp'), [meena.pk])
+
+
+class MedicalRecordSearchTests(TestCase):
+    def test_search_is_patient_scoped_and_follows_edits(self):
+        data = factories.seed(scale=0.01)
+        patient, other = data['patients'][:2]
+        doctor = data['doctors'][0]
+        record = MedicalRecord.objects.create(patient=patient, doctor=doctor, description='Recurring migraines with aura')
+        MedicalRecord.objects.create(patient=other, doctor=doctor, description='Migraine follow-up')
+        self.client.force_login(doctor.user)
+        url = reverse('get_patient_medical_records', kwargs={'patient_id': patient.pk})
+        self.assertEqual([r['id'] for r in self.client.get(url, {'q': 'migraine'}).json()['results']], [record.pk])
+        self.assertEqual([r['id'] for r in self.client.get(url, {'q': 'recur', 'fast': 'true'}).json()['results']], [record.pk])
+        record.description = 'Tension headache'
+        record.save()
+        self.assertEqual(self.client.get(url, {'q': 'migraine'}).json()['results'], [])
+        self.client.force_login(other.user)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ArchiveTests(TestCase):
+    def test_archived_rows_are_read_only_on_request(self):
+        data = factories.seed(scale=0.01)
+        conversation = data['conversations'][0]
+        messages = sharding.on_shard(Message.objects.filter(conversation=conversation), conversation=conversation.pk)
+        messages.update(timestamp=timezone.now() - datetime.timedelta(days=400))
+        Message.objects.create(conversation=conversation, sender=conversation.patient, content='Recent')
+        url = reverse('get_conversation_messages', kwargs={'conversation_id': conversation.pk})
+        self.client.force_login(conversation.patient)
+        everything = self.client.get(url).json()['results']
+        call_command('archive_records', '--model', 'message', '--older-than', '365', stdout=io.StringIO())
+        self.assertEqual(messages.count(), 1)
+        self.assertEqual([m['content'] for m in self.client.get(url).json()['results']], ['Recent'])
+        archived = self.client.get(url, {'archived': 'true'}).json()['results']
+        self.assertEqual([(m['id'], m['content']) for m in archived], [(m['id'], m['content']) for m in everything])
+
+    def test_archiving_leaves_the_inbox_and_the_change_feed_alone(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        conversation = Conversation.objects.create(doctor=doctor.user, patient=patient.user)
+        for content in ('Hello', 'Are you there?'):
+            Message.objects.create(conversation=conversation, sender=patient.user, content=content)
+        old = timezone.now() - datetime.timedelta(days=400)
+        messages = sharding.on_shard(Message.objects.all(), conversation=conversation.pk)
+        messages.update(timestamp=old)
+        Appointment.objects.bulk_create([Appointment(doctor=doctor, patient=patient, date=old.date(), time=datetime.time(9), status='completed')])
+        self.client.force_login(doctor.user)
+        inbox = self.client.get(reverse('get_inbox')).json()['results']
+        changes_before = Change.objects.count()
+        with self.captureOnCommitCallbacks(execute=True):
+            for model in ('message', 'appointment'):
+                call_command('archive_records', '--model', model, '--older-than', '365', stdout=io.StringIO())
+        self.assertFalse(messages.exists())
+        self.assertFalse(sharding.on_shard(Appointment.objects.all(), doctor=doctor.pk).exists())
+        self.assertEqual(self.client.get(reverse('get_inbox')).json()['results'], inbox)
+        self.assertEqual([(r['last_message_preview'], r['unread']) for r in inbox], [('Are you there?', 2)])
+        self.assertEqual(Change.objects.count(), changes_before)
+
+
+class BookingConstraintTests(TestCase):
+    def test_active_slot_is_held_by_the_partial_unique_constraint(self):
+        specialization = Specialization.objects.create(name='Cardiology')
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=specialization, years_of_experience=1)
+        patients = [
+            Patient.objects.create(user=User.objects.create_user(f'pat{i}'), name=f'Pat {i}', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+            for i in range(3)
+        ]
+        slot = {'date': datetime.date(2030, 1, 1), 'time': datetime.time(9)}
+        first = insert_appointment(doctor, patients[0], **slot)
+        # As if a concurrent booking passed validate_appointment first.
+        with self.assertRaisesMessage(ValidationError, 'conflicts'):
+            insert_appointment(doctor, patients[1], **slot)
+        self.assertEqual(sharding.on_shard(Appointment.objects.filter(doctor=doctor, **slot), doctor=doctor.pk).count(), 1)
+        first.status = 'cancelled'
+        first.save()
+        self.assertEqual(insert_appointment(doctor, patients[2], **slot).status, 'pending')
+
+
+class SlotConstraintMigrationTests(TransactionTestCase):
+    migrate_from = [('baseapp', '0002_doctor_available')]
+    migrate_to = [('baseapp', '0003_appointment_slot_constraints')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_duplicate_active_bookings_are_cancelled_before_the_constraints(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        apps = executor.loader.project_state(self.migrate_from).apps
+        Doctor, Patient, Appointment = (apps.get_model('baseapp', name) for name in ('Doctor', 'Patient', 'Appointment'))
+        specialization = apps.get_model('baseapp', 'Specialization').objects.create(name='Cardiology')
+        users = apps.get_model('auth', 'User').objects
+        doctors = [
+            Doctor.objects.create(user=users.create(username=f'doc{i}'), name=f'Doc {i}', email='doc@example.com', office_number='1', specialization=specialization, years_of_experience=1)
+            for i in range(2)
+        ]
+        patients = [
+            Patient.objects.create(user=users.create(username=f'pat{i}'), name=f'Pat {i}', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+            for i in range(3)
+        ]
+        slot = {'date': datetime.date(2030, 1, 1), 'time': datetime.time(9)}
+        kept = Appointment.objects.create(doctor=doctors[0], patient=patients[0], status='confirmed', **slot)
+        # Double booked doctor, and a patient booked with both doctors.
+        doctor_duplicate = Appointment.objects.create(doctor=doctors[0], patient=patients[1], status='pending', **slot)
+        patient_duplicate = Appointment.objects.create(doctor=doctors[1], patient=patients[0], status='pending', **slot)
+        elsewhere = Appointment.objects.create(doctor=doctors[1], patient=patients[2], status='pending', date=slot['date'], time=datetime.time(10))
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        apps = executor.loader.project_state(self.migrate_to).apps
+        statuses = dict(apps.get_model('baseapp', 'Appointment').objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {kept.pk: 'confirmed', doctor_duplicate.pk: 'cancelled', patient_duplicate.pk: 'cancelled', elsewhere.pk: 'pending'})
+
+
+@skipUnless(len(settings.DATABASE_SHARDS) > 1, 'Needs several DATABASE_SHARDS.')
+class SlotClaimMigrationTests(TransactionTestCase):
+    databases = '__all__'
+    migrate_from = [('baseapp', '0017_change')]
+    migrate_to = [('baseapp', '0018_patientslotclaim')]
+
+    def setUp(self):
+        self.aliases = [DEFAULT_DB_ALIAS, settings.DATABASE_SHARDS[1]]
+
+    def tearDown(self):
+        for alias in self.aliases:
+            executor = MigrationExecutor(connections[alias])
+            executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self, targets):
+        for alias in self.aliases:
+            executor = MigrationExecutor(connections[alias])
+            executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_cross_shard_double_bookings_keep_the_first_claim(self):
+        apps = self.migrate(self.migrate_from)
+        Appointment = apps.get_model('baseapp', 'Appointment')
+        slot = {'date': datetime.date(2030, 1, 1), 'time': datetime.time(9)}
+        # The reference rows are copied to every shard.
+        for alias in self.aliases:
+            specialization = apps.get_model('baseapp', 'Specialization').objects.using(alias).create(pk=1, name='Cardiology')
+            for pk in (1, 2):
+                user = apps.get_model('auth', 'User').objects.using(alias).create(pk=pk, username=f'doc{pk}')
+                apps.get_model('baseapp', 'Doctor').objects.using(alias).create(pk=pk, user=user, name=f'Doc {pk}', email='doc@example.com', office_number='1', specialization=specialization, years_of_experience=1)
+            user = apps.get_model('auth', 'User').objects.using(alias).create(pk=3, username='pat')
+            apps.get_model('baseapp', 'Patient').objects.using(alias).create(pk=1, user=user, name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        default, shard = self.aliases
+        kept = Appointment.objects.using(default).create(pk=1, doctor_id=1, patient_id=1, status='confirmed', **slot)
+        later = Appointment.objects.using(shard).create(pk=2, doctor_id=2, patient_id=1, status='pending', **slot)
+        elsewhere = Appointment.objects.using(shard).create(pk=3, doctor_id=2, patient_id=1, status='pending', date=slot['date'], time=datetime.time(10))
+        apps.get_model('baseapp', 'DoctorSchedule').objects.using(shard).create(doctor_id=2, date=slot['date'], appointments=[{'id': later.pk}, {'id': elsewhere.pk}])
+
+        apps = self.migrate(self.migrate_to)
+        Appointment = apps.get_model('baseapp', 'Appointment')
+        self.assertEqual(Appointment.objects.using(default).get().status, 'confirmed')
+        self.assertEqual(dict(Appointment.objects.using(shard).values_list('pk', 'status')), {later.pk: 'cancelled', elsewhere.pk: 'pending'})
+        claims = apps.get_model('baseapp', 'PatientSlotClaim').objects.using(default)
+        self.assertEqual(set(claims.values_list('appointment_id', flat=True)), {kept.pk, elsewhere.pk})
+        self.assertFalse(apps.get_model('baseapp', 'DoctorSchedule').objects.using(shard).exists())
+        self.assertEqual(list(apps.get_model('baseapp', 'Change').objects.using(default).values_list('collection', 'object_id')), [('appointments', later.pk)])
+
+
+
+class ReadMarkerMigrationTests(TransactionTestCase):
+    migrate_from = [('baseapp', '0018_patientslotclaim')]
+    migrate_to = [('baseapp', '0019_conversation_last_read_at')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_read_markers_are_dated_by_the_messages_they_cover(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        apps = executor.loader.project_state(self.migrate_from).apps
+        doctor, patient = (apps.get_model('auth', 'User').objects.create(username=name) for name in ('doc', 'pat'))
+        Message = apps.get_model('baseapp', 'Message')
+        conversation = apps.get_model('baseapp', 'Conversation').objects.create(doctor=doctor, patient=patient)
+        read = Message.objects.create(pk=1, conversation=conversation, sender=patient, content='Read')
+        Message.objects.create(pk=3, conversation=conversation, sender=patient, content='Unread')
+        # The marker's own message was deleted since.
+        conversation.doctor_last_read_id = 2
+        conversation.save()
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        apps = executor.loader.project_state(self.migrate_to).apps
+        conversation = apps.get_model('baseapp', 'Conversation').objects.get()
+        self.assertEqual((conversation.doctor_last_read_at, conversation.patient_last_read_at), (read.timestamp, None))
+
+
+class SlotIndexTests(TransactionTestCase):
+    # The index only takes committed writes, so the writes here must commit.
+
+    def setUp(self):
+        slot_index.clear()
+        self.addCleanup(slot_index.clear)
+
+    def earliest(self, doctor, date):
+        return [time for _, _, time in slot_index.next_available([doctor.pk], date, 1)]
+
+    def test_slots_follow_rebookings_and_reschedules(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        date = datetime.date(2030, 1, 1)
+        cancelled = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(9), status='pending')
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9, 30)])
+        cancelled.status = 'cancelled'
+        cancelled.save()
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9)])
+        rebooked = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(9), status='pending')
+        # Touching the cancelled row must not free the slot it no longer holds.
+        cancelled.save()
+        cancelled.delete()
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9, 30)])
+        Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(9, 30), status='pending')
+        rebooked.time = datetime.time(10)
+        rebooked.save()
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9)])
+        rebooked.date = date + datetime.timedelta(days=1)
+        rebooked.time = datetime.time(9)
+        rebooked.save()
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9)])
+        self.assertEqual(self.earliest(doctor, rebooked.date), [datetime.time(9, 30)])
+        # A reload from the database agrees with the incremental updates.
+        slot_index.clear()
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9)])
+        self.assertEqual(self.earliest(doctor, rebooked.date), [datetime.time(9, 30)])
+
+    def test_rolled_back_bookings_leave_the_slot_free(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        date, shard = datetime.date(2030, 1, 1), sharding.shard_for('doctor', doctor.pk)
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9)])
+        with self.assertRaises(RuntimeError), transaction.atomic(using=shard):
+            Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(9), status='pending')
+            raise RuntimeError
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9)])
+        booked = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(9), status='pending')
+        with self.assertRaises(RuntimeError), transaction.atomic(using=shard):
+            booked.delete()
+            raise RuntimeError
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9, 30)])
+
+    def test_off_grid_bookings_hold_every_slot_they_overlap(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        self.client.force_login(patient.user)
+        url = reverse('book_appointment')
+        date = datetime.date(2030, 1, 1)
+        # 09:15 overlaps the 09:00 and 09:30 slots; 08:45 runs into 09:00.
+        for time_ in ('09:15', '08:45'):
+            self.assertEqual(self.client.post(url, {'doctor': doctor.pk, 'patient': patient.pk, 'date': '2030-01-01', 'time': time_}).status_code, 201)
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(10)])
+        slot_index.clear()
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(10)])
+        moved = sharding.on_shard(Appointment.objects.filter(time=datetime.time(9, 15)), doctor=doctor.pk).get()
+        moved.time = datetime.time(17)
+        moved.save()
+        # After hours holds no slot, and 08:45 still holds 09:00.
+        self.assertEqual(self.earliest(doctor, date), [datetime.time(9, 30)])
+
+    def test_days_are_bounded_and_updates_during_a_load_are_kept(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        index = SlotIndex(max_days=3)
+        date = datetime.date(2030, 1, 1)
+        index.next_available([], date, 5)
+        self.assertEqual(list(index._days), [date + datetime.timedelta(days=i) for i in range(2, 5)])
+        index.clear()
+        scatter = sharding.scatter
+        booked = Appointment(pk=10 ** 6, doctor=doctor, patient=patient, date=date, time=datetime.time(9), status='pending')
+
+        def commit_during_the_query(rows):
+            # The rows are read, then a booking commits before the swap.
+            shards = [list(shard) for shard in scatter(rows)]
+            index.update(booked)
+            return [mock.Mock(iterator=iter(shard).__iter__) for shard in shards]
+
+        with mock.patch.object(sharding, 'scatter', commit_during_the_query):
+            self.assertEqual([time for _, _, time in index.next_available([doctor.pk], date, 1)], [datetime.time(9, 30)])
+        self.assertEqual(index._journal, [])
+
+
+class AppointmentStreamTests(TestCase):
+    def test_ndjson_stream_matches_the_json_list(self):
+        data = factories.seed(scale=0.01)
+        self.client.force_login(data['patients'][0].user)
+        url = reverse('get_all_appointments_ordered')
+        expected = self.client.get(url).json()
+        self.assertGreater(len(expected), 1)
+        # Small chunks, so rows cross several keyset boundaries.
+        small_chunks = functools.partial(archive.merge_chunks, chunk_size=3)
+        for fast in ('false', 'true'):
+            with mock.patch('baseapp.archive.merge_chunks', small_chunks):
+                response = self.client.get(url, {'stream': 'true', 'fast': fast})
+                lines = b''.join(response.streaming_content).decode().splitlines()
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in lines], expected)
+
+
+# Counts the queries of one database: on several, the updates and
+# schedules are split by shard.
+@override_settings(DATABASE_SHARDS=['default'])
+class BulkTransitionTests(TestCase):
+    def test_one_update_per_status_with_version_checks(self):
+        data = factories.seed(scale=0.01)
+        staff = data['patients'][0].user
+        staff.is_staff = True
+        staff.save()
+        first, second, third = data['appointments'][:3]
+        self.client.force_login(staff)
+        url = reverse('bulk_transition_appointments')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'transitions': [
+                {'id': first.pk, 'status': 'completed'},
+                {'id': second.pk, 'status': 'cancelled', 'version': first.version},
+                {'id': third.pk, 'status': 'cancelled', 'version': 7},
+            ]}, content_type='application/json')
+        self.assertEqual([(r['result'], r['version']) for r in response.json()['results']], [('updated', 2), ('updated', 2), ('conflict', 1)])
+        self.assertEqual(sum(q['sql'].startswith('UPDATE') for q in queries.captured_queries), 2)
+        # Session, user, appointments, two updates, one delete of the
+        # released slot claims; and savepoints.
+        self.assertLessEqual(len(queries), 12)
+        days = {(a.doctor_id, a.date) for a in data['appointments'][3:43]}
+        self.assertGreater(len(days), 10)
+        # As many queries for 40 appointments over many days.
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(9):
+            response = self.client.post(url, {'ids': [a.pk for a in data['appointments'][3:43]], 'status': 'cancelled'}, content_type='application/json')
+        self.assertEqual({r['result'] for r in response.json()['results']}, {'updated'})
+        # Then, once committed, the schedules of every day touched: rows
+        # (locked), the appointments of the days not stored yet and one
+        # insert; the change feed; and savepoints.
+        with self.assertNumQueries(8):
+            for callback in callbacks:
+                callback()
+        self.assertLessEqual(days, set(DoctorSchedule.objects.values_list('doctor_id', 'date')))
+        cancelled = data['appointments'][3]
+        entries = DoctorSchedule.objects.get(doctor_id=cancelled.doctor_id, date=cancelled.date).appointments
+        self.assertEqual([e['status'] for e in entries if e['id'] == cancelled.pk], ['cancelled'])
+        # Days already stored have their entries patched, not rebuilt.
+        stored = data['appointments'][43:53]
+        for appointment in stored:
+            schedules.lookup(appointment.doctor_id, appointment.date)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(url, {'ids': [a.pk for a in stored], 'status': 'cancelled'}, content_type='application/json')
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+        self.assertFalse([q for q in queries.captured_queries if '"baseapp_appointment"' in q['sql']])
+        for appointment in stored:
+            entries = DoctorSchedule.objects.get(doctor_id=appointment.doctor_id, date=appointment.date).appointments
+            self.assertEqual([e['status'] for e in entries if e['id'] == appointment.pk], ['cancelled'])
+        response = self.client.post(url, {'ids': [first.pk], 'status': 'cancelled'}, content_type='application/json')
+        self.assertEqual(response.json()['results'][0]['result'], 'invalid_transition')
+        self.assertEqual(Appointment.objects.get(pk=first.pk).status, 'completed')
+
+
+class ConditionalGetTests(TestCase):
+    def test_unchanged_resources_answer_304_from_one_query(self):
+        data = factories.seed(scale=0.01)
+        appointment = data['appointments'][0]
+        url = reverse('get_appointment_details', kwargs={'appointment_id': appointment.pk})
+        self.client.force_login(appointment.patient.user)
+        etag = self.client.get(url)['ETag']
+        # Session, user, then validators on each shard up to the appointment's.
+        with self.assertNumQueries(3 + sharding.shard_aliases().index(sharding.shard_of(appointment))):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        doctor = appointment.doctor
+        doctor.office_number = '999'
+        doctor.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_aggregates_are_not_answered_from_if_modified_since(self):
+        data = factories.seed(scale=0.01)
+        url = reverse('get_all_doctors')
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+        # Deleting a doctor leaves Max(updated_at) where it was.
+        data['doctors'][-1].delete()
+        since = http_date(time.time() + 3600)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+        self.assertNotEqual(self.client.get(url)['ETag'], response['ETag'])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], IMPORT_BATCH_SIZE=2)
+class ImportTests(TestCase):
+    def test_import_reports_bad_rows_and_resumes(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        rows = [
+            {'username': f'imported{i}', 'password': 'secret', 'name': f'Imported {i}', 'email': f'i{i}@example.com', 'date_of_birth': '1990-01-01',
+             'gender': 'X' if i == 1 else 'F', 'phone_number': '1234567890', 'age': 30, 'blood_group': 'O+'}
+            for i in range(5)
+        ]
+        original = Importer.import_batch
+        def fail_on_third_batch(importer, batch):
+            if batch[0][0] == 5:
+                raise RuntimeError('connection lost')
+            original(importer, batch)
+        url = reverse('import_profiles', kwargs={'kind': 'patient'})
+        with mock.patch.object(Importer, 'import_batch', fail_on_third_batch), self.assertRaises(RuntimeError):
+            self.client.post(url, {'rows': rows}, content_type='application/json')
+        job = ImportJob.objects.get()
+        self.assertEqual((job.status, job.rows_processed, job.rows_imported), ('failed', 4, 3))
+        job = self.client.post(url, {'rows': rows, 'job': job.pk}, content_type='application/json').json()
+        self.assertEqual((job['status'], job['rows_processed'], job['rows_imported']), ('completed', 5, 4))
+        self.assertEqual([(e['row'], list(e['errors'])) for e in job['errors']], [(2, ['gender'])])
+        self.assertTrue(Patient.objects.get(user__username='imported4').user.check_password('secret'))
+
+
+class InboxTests(TestCase):
+    def test_inbox_tracks_last_message_and_unread_counts(self):
+        doctor, patient, other = (User.objects.create_user(name) for name in ('doc', 'pat', 'other'))
+        quiet = Conversation.objects.create(doctor=doctor, patient=other)
+        Message.objects.create(conversation=quiet, sender=other, content='Earlier')
+        conversation = Conversation.objects.create(doctor=doctor, patient=patient)
+        first = Message.objects.create(conversation=conversation, sender=patient, content='Hello')
+        second = Message.objects.create(conversation=conversation, sender=patient, content='Are you there?')
+        Conversation.objects.create(doctor=doctor, patient=patient)
+        self.client.force_login(doctor)
+        url = reverse('get_inbox')
+        # Session, user, then a page of conversations from each shard.
+        with self.assertNumQueries(2 + len(sharding.shard_aliases())):
+            results = self.client.get(url).json()['results']
+        self.assertEqual([(r['id'], r['last_message_preview'], r['unread']) for r in results], [(conversation.pk, 'Are you there?', 2), (quiet.pk, 'Earlier', 1)])
+        read = reverse('mark_conversation_read', kwargs={'conversation_id': conversation.pk})
+        self.assertEqual(self.client.post(read, {'message': first.pk}).json()['unread'], 1)
+        self.assertEqual(self.client.post(read).json()['unread'], 0)
+        Message.objects.create(conversation=conversation, sender=doctor, content='Yes')
+        second.delete()
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.doctor_unread, conversation.patient_unread, conversation.last_message_preview), (0, 1, 'Yes'))
+        self.client.force_login(patient)
+        self.assertEqual([(r['id'], r['unread']) for r in self.client.get(url).json()['results']], [(conversation.pk, 1)])
+
+    def test_messages_are_ordered_by_time_not_id(self):
+        # Ids come from per-process blocks, so a later message may have a lower one.
+        doctor, patient = (User.objects.create_user(name) for name in ('doc', 'pat'))
+        conversation = Conversation.objects.create(doctor=doctor, patient=patient)
+        first = Message.objects.create(pk=500, conversation=conversation, sender=patient, content='First')
+        Message.objects.create(pk=400, conversation=conversation, sender=patient, content='Second')
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.last_message_preview, conversation.doctor_unread), ('Second', 2))
+        self.assertEqual(inbox.mark_read(conversation, 'doctor', first.pk).doctor_unread, 1)
+        Message.objects.create(pk=300, conversation=conversation, sender=patient, content='Third')
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.last_message_preview, conversation.doctor_unread), ('Third', 2))
+        inbox.rebuild(Conversation.objects.filter(pk=conversation.pk))
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.doctor_unread, 2)
+
+
+class DoctorScheduleTests(TestCase):
+    def test_day_view_is_one_lookup_kept_current_by_appointment_events(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        date = timezone.localdate() + datetime.timedelta(days=1)
+        url = reverse('get_doctor_schedule', kwargs={'doctor_id': doctor.pk})
+        self.client.force_login(patient.user)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(doctor.user)
+        self.assertEqual(self.client.get(url, {'date': date}).json()['appointments'], [])
+        # Schedules are updated once the appointment's shard commits.
+        with self.captureOnCommitCallbacks(execute=True):
+            late = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(11), status='pending')
+            early = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(9), status='pending')
+        # Session, user, ownership, schedule row.
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {'date': date})
+        self.assertEqual([(a['id'], a['status'], a['patient']['name']) for a in response.json()['appointments']], [(early.pk, 'pending', 'Pat'), (late.pk, 'pending', 'Pat')])
+        self.assertEqual(self.client.get(url, {'date': date}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(reverse('mark_appointment_cancelled', kwargs={'appointment_id': early.pk}))
+            patient.name = 'Patricia'
+            patient.save()
+            late.delete()
+        response = self.client.get(url, {'date': date}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual([(a['id'], a['status'], a['patient']['name']) for a in response.json()['appointments']], [(early.pk, 'cancelled', 'Patricia')])
+        early.refresh_from_db()
+        early.date += datetime.timedelta(days=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            early.save()
+        self.assertEqual(self.client.get(url, {'date': date}).json()['appointments'], [])
+        self.assertEqual([a['id'] for a in self.client.get(url, {'date': early.date}).json()['appointments']], [early.pk])
+
+    def test_a_write_patches_its_entry_after_commit(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        date = timezone.localdate() + datetime.timedelta(days=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time=datetime.time(11), status='pending')
+        stored = schedules.lookup(doctor.pk, date)
+        shard = sharding.shard_for('doctor', doctor.pk)
+        with self.captureOnCommitCallbacks(using=shard) as callbacks:
+            second = Appointment.objects.create(doctor=doctor, patient=patient, date=date, time='9:00', status='pending')
+        # Nothing within the booking's transaction.
+        self.assertEqual(schedules.lookup(doctor.pk, date), stored)
+        with CaptureQueriesContext(connections[shard]) as queries:
+            for callback in callbacks:
+                callback()
+        # The locked row and its update: the other entries are not rebuilt
+        # from their appointments.
+        touched = [q['sql'].split()[0] for q in queries.captured_queries if '"baseapp_doctorschedule"' in q['sql'] or '"baseapp_appointment"' in q['sql']]
+        self.assertEqual(touched, ['SELECT', 'UPDATE'])
+        schedule = schedules.lookup(doctor.pk, date)
+        self.assertEqual([(a['id'], a['time']) for a in schedule['appointments']], [(second.pk, '09:00:00'), (first.pk, '11:00:00')])
+        self.assertEqual(schedule['appointments'][1], stored['appointments'][0])
+        self.assertEqual(schedule['version'], stored['version'] + 1)
+        # A callback of an older write that runs late changes nothing.
+        stale = copy.copy(second)
+        second.status = 'confirmed'
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        schedules.apply(stale)
+        self.assertEqual(schedules.lookup(doctor.pk, date)['appointments'][0]['status'], 'confirmed')
+
+    @override_settings(SCHEDULE_WINDOW_DAYS=30)
+    def test_reads_store_only_days_near_today_and_only_for_the_doctor(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+        url = reverse('get_doctor_schedule', kwargs={'doctor_id': doctor.pk})
+        schedules = sharding.on_shard(DoctorSchedule.objects.all(), doctor=doctor.pk)
+        self.client.force_login(User.objects.create_user('other'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertFalse(schedules.exists())
+        self.client.force_login(doctor.user)
+        far = timezone.localdate() + datetime.timedelta(days=400)
+        response = self.client.get(url, {'date': far})
+        self.assertEqual((response.status_code, response.json()['appointments']), (200, []))
+        self.assertFalse(schedules.exists())
+        # Built each time, with an ETag that follows the content.
+        self.assertEqual(self.client.get(url, {'date': far}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+        Appointment.objects.bulk_create([Appointment(doctor=doctor, patient=patient, date=far, time=datetime.time(9), status='pending')])
+        response = self.client.get(url, {'date': far}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(len(response.json()['appointments']), 1)
+        self.assertFalse(schedules.exists())
+        self.client.get(url)
+        self.assertEqual(list(schedules.values_list('date', flat=True)), [timezone.localdate()])
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(reverse('get_doctor_schedule', kwargs={'doctor_id': doctor.pk + 1})).status_code, 404)
+
+
+@override_settings(CHANGE_FEED_SETTLE_SECONDS=0)
+class ChangeFeedTests(TestCase):
+    def sync(self, collection, cursor=None):
+        params = {} if cursor is None else {'cursor': cursor}
+        return self.client.get(reverse('sync_changes', kwargs={'collection': collection}), params).json()
+
+    def test_sync_sends_changes_after_the_cursor_and_snapshots_when_compacted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+            patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+            first = Appointment.objects.create(doctor=doctor, patient=patient, date=datetime.date(2030, 1, 1), time=datetime.time(9), status='pending')
+        self.client.force_login(patient.user)
+        snapshot = self.sync('appointments')
+        self.assertEqual((snapshot['snapshot'], snapshot['reset'], [c['id'] for c in snapshot['changes']]), (True, True, [first.pk]))
+        self.assertEqual(self.sync('appointments', snapshot['cursor'])['changes'], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(reverse('mark_appointment_cancelled', kwargs={'appointment_id': first.pk}))
+            second = Appointment.objects.create(doctor=doctor, patient=patient, date=datetime.date(2030, 1, 1), time=datetime.time(10), status='pending')
+            patient.name = 'Patricia'
+            patient.save()
+        delta = self.sync('appointments', snapshot['cursor'])
+        self.assertEqual(delta['snapshot'], False)
+        # Cancelled appointments leave the collection; the rename is sent once.
+        self.assertEqual(
+            [(c['id'], c['deleted'], c.get('data', {}).get('patient', {}).get('name')) for c in delta['changes']],
+            [(first.pk, True, None), (second.pk, False, 'Patricia')],
+        )
+        self.assertEqual(self.sync('appointments', delta['cursor'])['changes'], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            mine = Conversation.objects.create(doctor=doctor.user, patient=patient.user)
+            Conversation.objects.create(doctor=doctor.user, patient=User.objects.create_user('other'))
+        self.assertEqual([c['id'] for c in self.sync('conversations', delta['cursor'])['changes']], [mine.pk])
+        self.assertEqual(self.client.get(reverse('sync_changes', kwargs={'collection': 'appointments'}), {'cursor': 'x'}).status_code, 404)
+        Change.objects.update(created_at=timezone.now() - datetime.timedelta(days=30))
+        out = io.StringIO()
+        call_command('compact_changes', stdout=out)
+        self.assertEqual(Change.objects.count(), 1)
+        self.assertIn('expired', out.getvalue())
+        stale = self.sync('appointments', delta['cursor'])
+        self.assertEqual((stale['snapshot'], stale['reset'], [c['id'] for c in stale['changes']]), (True, True, [second.pk]))
+
+    def test_users_sync_only_their_own_appointments_and_messages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1)
+            patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+            appointment = Appointment.objects.create(doctor=doctor, patient=patient, date=datetime.date(2030, 1, 1), time=datetime.time(9), status='pending')
+            conversation = Conversation.objects.create(doctor=doctor.user, patient=patient.user)
+            message = Message.objects.create(conversation=conversation, sender=patient.user, content='Private')
+        stranger = User.objects.create_user('stranger')
+        expected = {'appointments': appointment.pk, 'messages': message.pk}
+        for user in (doctor.user, patient.user):
+            self.client.force_login(user)
+            for collection, pk in expected.items():
+                self.assertEqual([c['id'] for c in self.sync(collection)['changes']], [pk])
+                self.assertEqual([c['id'] for c in self.sync(collection, '0')['changes']], [pk])
+        self.client.force_login(stranger)
+        for collection in expected:
+            self.assertEqual(self.sync(collection)['changes'], [])
+            # Nor are they reported as deleted from the feed.
+            self.assertEqual(self.sync(collection, '0')['changes'], [])
+
+
+class DoctorPresenceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_heartbeats_drive_live_availability_and_expire_into_the_column(self):
+        doctor = Doctor.objects.create(user=User.objects.create_user('doc'), name='Doc', email='doc@example.com', office_number='1', specialization=Specialization.objects.create(name='Cardiology'), years_of_experience=1, available=False)
+        url = reverse('doctor_heartbeat')
+        listing = reverse('get_all_doctors')
+        etag = self.client.get(listing)['ETag']
+        self.client.force_login(User.objects.create_user('pat'))
+        self.assertEqual(self.client.post(url).status_code, 403)
+        self.client.force_login(doctor.user)
+        self.assertEqual(self.client.post(url).json(), {'doctor': doctor.pk, 'available': True, 'expires_in': presence.ttl()})
+        # Read live, past the cached representation and the ETag.
+        response = self.client.get(listing, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([d['available'] for d in response.json()['results']], [True])
+        self.assertEqual(Doctor.objects.get().available, False)
+        # Workers queue the flush themselves, every PRESENCE_FLUSH_INTERVAL.
+        tasks.Worker(burst=True).run()
+        flush = Task.objects.get(name='flush_doctor_presence')
+        self.assertGreater(flush.run_at, timezone.now() + datetime.timedelta(seconds=presence.flush_interval() - 5))
+        tasks.Worker(burst=True).run()
+        self.assertEqual(Task.objects.filter(name='flush_doctor_presence').count(), 1)
+        tasks.flush_doctor_presence()
+        self.assertEqual(Doctor.objects.get().available, True)
+        with mock.patch('baseapp.presence.time.time', return_value=time.time() + presence.ttl() + 1):
+            self.assertEqual([d['available'] for d in self.client.get(listing).json()['results']], [False])
+            self.assertEqual(presence.flush(), [doctor.pk])
+        self.assertEqual(Doctor.objects.get().available, False)
+        self.client.post(url, {'available': False})
+        self.assertEqual(self.client.get(reverse('get_doctor_details', kwargs={'doctor_id': doctor.pk})).json()['available'], False)
+
+    def test_only_tracked_doctors_are_compared_with_the_column(self):
+        specialization = Specialization.objects.create(name='Cardiology')
+        on, off, idle = (
+            Doctor.objects.create(user=User.objects.create_user(name), name=name.title(), email=f'{name}@example.com', office_number='1', specialization=specialization, years_of_experience=1, available=False)
+            for name in ('on', 'off', 'idle')
+        )
+        presence.heartbeat(on.pk)
+        presence.heartbeat(off.pk, available=False)
+        self.assertEqual(presence.tracked()[0], {on.pk, off.pk})
+        with mock.patch.object(presence, 'live_values', wraps=presence.live_values) as live_values:
+            self.assertEqual(list(presence.matching(Doctor.objects.all(), True)), [on])
+        self.assertEqual(set(live_values.call_args.args[0]), {on.pk, off.pk})
+        version = doctor_cache.version()
+        self.assertEqual(presence.flush(), [on.pk])
+        # Written with update(), which sends no signals.
+        self.assertNotEqual(doctor_cache.version(), version)
+        # Off duty and flushed: nothing left to compare until a heartbeat.
+        self.assertEqual(presence.tracked()[0], {on.pk})
+        with mock.patch('baseapp.presence.time.time', return_value=time.time() + presence.ttl() + 1):
+            self.assertEqual(list(presence.matching(Doctor.objects.all(), True)), [])
+            self.assertEqual(presence.flush(), [on.pk])
+        self.assertEqual(presence.tracked()[0], set())
+        # A write to the column is compared with the presence, which wins.
+        off.available = True
+        off.save()
+        self.assertEqual(list(presence.matching(Doctor.objects.all(), True)), [])
+
+    def test_an_evicted_version_does_not_restart(self):
+        presence.bump_version()
+        before = presence.version()
+        cache.delete(presence.version_key)
+        self.assertGreater(presence.version(), before)
+
+    def test_available_filter_uses_live_availability(self):
+        search_index.clear()
+        specialization = Specialization.objects.create(name='Cardiology')
+        stale_on, stale_off = (
+            Doctor.objects.create(user=User.objects.create_user(name), name=name.title(), email=f'{name}@example.com', office_number='1', specialization=specialization, years_of_experience=1, available=available)
+            for name, available in (('alice', True), ('bob', False))
+        )
+        # Alice went off duty and Bob came on; the column has not caught up.
+        presence.heartbeat(stale_on.pk, available=False)
+        presence.heartbeat(stale_off.pk)
+        self.client.force_login(stale_on.user)
+
+        def listed(url, params, doctor=lambda row: row['doctor']):
+            response = self.client.get(url, params)
+            rows = response.json()['results'] if url == reverse('get_all_doctors') else response.json()
+            return [(doctor(row)['id'], doctor(row)['available']) for row in rows]
+
+        for available, expected in (('true', [(stale_off.pk, True)]), ('false', [(stale_on.pk, False)])):
+            self.assertEqual(listed(reverse('get_all_doctors'), {'available': available}, doctor=lambda row: row), expected)
+            self.assertEqual(listed(reverse('search_doctors'), {'q': 'cardiology', 'available': available}), expected)
+        self.assertEqual(listed(reverse('get_next_available_doctors'), {}), [(stale_off.pk, True)])
+        self.assertEqual(listed(reverse('get_next_available_doctors'), {'available': 'false'}), [(stale_on.pk, False)])
+
+    def test_search_and_next_available_read_live_availability_once(self):
+        search_index.clear()
+        specialization = Specialization.objects.create(name='Cardiology')
+        doctors = [
+            Doctor.objects.create(user=User.objects.create_user(f'doc{i}'), name=f'Doc {i}', email=f'doc{i}@example.com', office_number='1', specialization=specialization, years_of_experience=1, image='doctors/doctor_1.png')
+            for i in range(3)
+        ]
+        self.client.force_login(doctors[0].user)
+        for url, params in ((reverse('search_doctors'), {'q': 'cardiology'}), (reverse('get_next_available_doctors'), {})):
+            with self.subTest(url=url), \
+                    mock.patch.object(presence, 'is_available', wraps=presence.is_available) as is_available, \
+                    mock.patch.object(presence, 'live_values', wraps=presence.live_values) as live_values:
+                found = [row['doctor'] for row in self.client.get(url, params).json()]
+                self.assertEqual(sorted(doctor['id'] for doctor in found), [doctor.pk for doctor in doctors])
+                # One read to rank or filter the candidates, one for the page.
+                self.assertEqual((is_available.call_count, live_values.call_count), (0, 2))
+                # Serialized with the request, as the other doctor views.
+                self.assertTrue(all(doctor['image'].startswith('http://testserver/') for doctor in found))
+
+    def test_deploy_check_requires_a_shared_cache(self):
+        from .checks import check_shared_caches
+        with override_settings(DEBUG=False):
+            self.assertEqual([error.id for error in check_shared_caches(None)], ['baseapp.E001'])
+        with override_settings(DEBUG=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost'}}):
+            self.assertEqual(check_shared_caches(None), [])
+        with override_settings(DEBUG=True):
+            self.assertEqual(check_shared_caches(None), [])
+
+
+class TaskQueueTests(TestCase):
+    def test_tasks_dedup_retry_with_backoff_and_send_mail(self):
+        user = User.objects.create_user('pat', email='pat@example.com')
+        task = tasks.enqueue(tasks.send_welcome_email, {'user_id': user.pk}, dedup_key=f'welcome-email:{user.pk}')
+        self.assertEqual(tasks.enqueue(tasks.send_welcome_email, {'user_id': user.pk}, dedup_key=f'welcome-email:{user.pk}'), task)
+        self.assertEqual(mail.outbox, [])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('SMTP down')), self.assertLogs('baseapp.tasks', 'WARNING'):
+            self.assertEqual(tasks.Worker(burst=True).run(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ('queued', 1))
+        self.assertIn('SMTP down', task.last_error)
+        self.assertGreater(task.run_at, timezone.now())
+        self.assertEqual(tasks.Worker(burst=True).run(), 0)
+        Task.objects.filter(pk=task.pk).update(run_at=timezone.now())
+        self.assertEqual(tasks.Worker(burst=True).run(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ('succeeded', 2))
+        self.assertEqual([m.to for m in mail.outbox], [['pat@example.com']])
+        self.assertNotEqual(tasks.enqueue(tasks.send_welcome_email, {'user_id': user.pk}, dedup_key=f'welcome-email:{user.pk}'), task)
+
+
+# TestCase transactions are invisible to mirror connections, hence a
+# TransactionTestCase; the replicas mirror the default database only.
+REPLICAS = settings.DATABASE_REPLICAS or getattr(settings, 'TEST_DATABASE_REPLICAS', [])
+
+
+@skipUnless(REPLICAS, 'Needs DATABASE_REPLICAS or TEST_DATABASE_REPLICAS, e.g. SQLite aliases with TEST MIRROR set to default.')
+@override_settings(DATABASE_REPLICAS=REPLICAS, DATABASE_SHARDS=['default'])
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_read_only_views_use_a_replica_until_the_client_writes(self):
+        doctor, patient = User.objects.create_user('doc'), User.objects.create_user('pat')
+        conversation = Conversation.objects.create(doctor=doctor, patient=patient)
+        Message.objects.create(conversation=conversation, sender=doctor, content='Hello')
+        messages = reverse('get_conversation_messages', kwargs={'conversation_id': conversation.pk})
+        read = reverse('mark_conversation_read', kwargs={'conversation_id': conversation.pk})
+        self.client.force_login(patient)
+
+        def replica_queries(method, url):
+            with ExitStack() as stack:
+                captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in settings.DATABASE_REPLICAS]
+                self.assertEqual(getattr(self.client, method)(url).status_code, 200)
+            return sum(len(queries) for queries in captured)
+
+        self.assertGreater(replica_queries('get', messages), 0)
+        self.assertEqual(replica_queries('post', read), 0)
+        self.assertIn(routers.PIN_COOKIE, self.client.cookies)
+        self.assertEqual(replica_queries('get', messages), 0)
+        # Token clients carry no cookie; the user is pinned as well.
+        del self.client.cookies[routers.PIN_COOKIE]
+        self.assertEqual(replica_queries('get', messages), 0)
+        cache.clear()
+        self.assertGreater(replica_queries('get', messages), 0)
+
+
+# Shard aliases must be real databases, e.g. several SQLite ones, as in
+# H_API.test_settings.
+@skipUnless(len(settings.DATABASE_SHARDS) > 1, 'Needs several DATABASE_SHARDS.')
+class ShardingTests(TestCase):
+    def setUp(self):
+        self.specialization = Specialization.objects.create(name='Cardiology')
+        self.patient = self.make_patient('pat')
+
+    def make_patient(self, username):
+        return Patient.objects.create(user=User.objects.create_user(username), name=username, date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+
+    def make_doctors(self, count):
+        return [
+            Doctor.objects.create(user=User.objects.create_user(f'doc{i}'), name=f'Doctor {i}', email=f'doc{i}@example.com', office_number=str(i), specialization=self.specialization, years_of_experience=1)
+            for i in range(count)
+        ]
+
+    def assertOnOwnShard(self, model):
+        for alias in sharding.shard_aliases():
+            for row in model.objects.using(alias).all():
+                self.assertEqual(sharding.shard_of(row), alias, row)
+
+    def test_writes_routed_to_a_shard_are_recorded(self):
+        # ShardRouter answers for sharded models, so ReplicaRouter is not asked.
+        conversation = Conversation(doctor=User.objects.create_user('doc'), patient=self.patient.user)
+        state = routers.RoutingState()
+        token = routers._state.set(state)
+        try:
+            alias = sharding.ShardRouter().db_for_write(Conversation, instance=conversation)
+        finally:
+            routers._state.reset(token)
+        self.assertIn(alias, settings.DATABASE_SHARDS)
+        self.assertTrue(state.wrote)
+
+    def test_rows_follow_their_key_and_listings_gather_every_shard(self):
+        doctors = self.make_doctors(6)
+        for alias in sharding.shard_aliases():
+            self.assertEqual(Doctor.objects.using(alias).count(), 6)
+        shards = {sharding.shard_for('doctor', doctor.pk) for doctor in doctors}
+        self.assertGreater(len(shards), 1)
+        self.client.force_login(self.patient.user)
+        date = timezone.localdate() + datetime.timedelta(days=1)
+        booked = []
+        for i, doctor in enumerate(doctors):
+            response = self.client.post(reverse('book_appointment'), {'doctor': doctor.pk, 'patient': self.patient.pk, 'date': date, 'time': f'{9 + i}:00'})
+            self.assertEqual(response.status_code, 201, response.content)
+            booked.append(response.json()['id'])
+        self.assertEqual(len(set(booked)), len(booked))
+        self.assertOnOwnShard(Appointment)
+        # The patient's slot is claimed on the default database.
+        other = next(d for d in doctors if sharding.shard_for('doctor', d.pk) != sharding.shard_for('doctor', doctors[0].pk))
+        response = self.client.post(reverse('book_appointment'), {'doctor': other.pk, 'patient': self.patient.pk, 'date': date, 'time': '9:00'})
+        self.assertEqual(response.status_code, 400)
+        url = reverse('get_all_appointments_ordered')
+        self.assertEqual([a['id'] for a in self.client.get(url).json()], booked)
+        self.assertEqual([a['id'] for a in self.client.get(url, {'doctor': other.pk}).json()], [booked[doctors.index(other)]])
+        response = self.client.put(reverse('mark_appointment_cancelled', kwargs={'appointment_id': booked[-1]}))
+        self.assertEqual(response.json()['status'], 'cancelled')
+        self.assertEqual(self.client.get(reverse('get_appointment_details', kwargs={'appointment_id': booked[-1]})).json()['status'], 'cancelled')
+
+        conversations = [Conversation.objects.create(doctor=doctor.user, patient=self.patient.user) for doctor in doctors]
+        for conversation in conversations:
+            Message.objects.create(conversation=conversation, sender=conversation.doctor, content=f'Hello {conversation.pk}')
+        self.assertOnOwnShard(Conversation)
+        self.assertOnOwnShard(Message)
+        inbox = self.client.get(reverse('get_inbox')).json()['results']
+        self.assertEqual(sorted(r['id'] for r in inbox), sorted(c.pk for c in conversations))
+        self.assertEqual({r['unread'] for r in inbox}, {1})
+        messages = self.client.get(reverse('get_conversation_messages', kwargs={'conversation_id': conversations[-1].pk})).json()['results']
+        self.assertEqual([m['content'] for m in messages], [f'Hello {conversations[-1].pk}'])
+
+    def test_a_patient_slot_is_held_across_shards(self):
+        doctors = self.make_doctors(6)
+        first = doctors[0]
+        other = next(d for d in doctors if sharding.shard_for('doctor', d.pk) != sharding.shard_for('doctor', first.pk))
+        slot = {'date': datetime.date(2030, 1, 1), 'time': datetime.time(9)}
+        booked = insert_appointment(first, self.patient, **slot)
+        # As if a concurrent booking passed validate_appointment first.
+        with self.assertRaisesMessage(ValidationError, 'conflicts'):
+            insert_appointment(other, self.patient, **slot)
+        self.assertFalse(sharding.on_shard(Appointment.objects.filter(doctor=other), doctor=other.pk).exists())
+        self.assertEqual(list(PatientSlotClaim.objects.values_list('appointment_id', flat=True)), [booked.pk])
+        self.assertEqual(transition_appointments([(booked.pk, 'cancelled', None)])[booked.pk][0], 'updated')
+        self.assertFalse(PatientSlotClaim.objects.exists())
+        rebooked = insert_appointment(other, self.patient, **slot)
+        rebooked.time = datetime.time(10)
+        rebooked.save()
+        self.assertEqual(list(PatientSlotClaim.objects.values_list('appointment_id', 'time')), [(rebooked.pk, datetime.time(10))])
+        rebooked.delete()
+        self.assertFalse(PatientSlotClaim.objects.exists())
+
+    def test_a_failing_shard_fails_only_its_transitions(self):
+        doctors = self.make_doctors(6)
+        first = doctors[0]
+        other = next(d for d in doctors if sharding.shard_for('doctor', d.pk) != sharding.shard_for('doctor', first.pk))
+        slot = {'date': datetime.date(2030, 1, 1), 'time': datetime.time(9)}
+        kept = insert_appointment(first, self.patient, **slot)
+        moved = insert_appointment(other, self.make_patient('pat2'), **slot)
+        broken = sharding.shard_for('doctor', first.pk)
+        update_status_on = booking._update_status_on
+
+        def fail_on_broken(db, *args):
+            if db == broken:
+                raise OperationalError('shard is down')
+            return update_status_on(db, *args)
+
+        with mock.patch('baseapp.booking._update_status_on', fail_on_broken), self.assertLogs('baseapp.booking', 'ERROR'):
+            results = transition_appointments([(kept.pk, 'cancelled', None), (moved.pk, 'cancelled', None)])
+            self.assertEqual({pk: result for pk, (result, _) in results.items()}, {kept.pk: 'failed', moved.pk: 'updated'})
+            self.client.force_login(self.patient.user)
+            response = self.client.put(reverse('mark_appointment_cancelled', kwargs={'appointment_id': kept.pk}))
+            self.assertEqual(response.status_code, 503)
+        statuses = {a.pk: a.status for shard in sharding.scatter(Appointment.objects.all()) for a in shard}
+        self.assertEqual(statuses, {kept.pk: 'pending', moved.pk: 'cancelled'})
+        # The applied half is followed through: its claim is released.
+        self.assertEqual(list(PatientSlotClaim.objects.values_list('appointment_id', flat=True)), [kept.pk])
+
+    def test_rebalance_moves_rows_onto_a_new_shard(self):
+        with override_settings(DATABASE_SHARDS=['default', 'shard1']):
+            doctors = self.make_doctors(8)
+            patients = [self.patient] + [self.make_patient(f'pat{i}') for i in range(7)]
+            for i, (doctor, patient) in enumerate(zip(doctors, patients)):
+                Appointment.objects.create(doctor=doctor, patient=patient, date=datetime.date(2030, 1, 1), time=datetime.time(9 + i), status='pending')
+                MedicalRecord.objects.create(doctor=doctor, patient=patient, description='Visit')
+                conversation = Conversation.objects.create(doctor=doctor.user, patient=patient.user)
+                Message.objects.create(conversation=conversation, sender=patient.user, content='Hello')
+        self.assertEqual(Doctor.objects.using('shard2').count(), 0)
+        out = io.StringIO()
+        call_command('rebalance_shards', stdout=out)
+        self.assertIn('Moved', out.getvalue())
+        self.assertEqual(Doctor.objects.using('shard2').count(), 8)
+        for model in (Appointment, MedicalRecord, Conversation, Message):
+            self.assertEqual(sum(model.objects.using(alias).count() for alias in sharding.shard_aliases()), 8)
+            self.assertGreater(model.objects.using('shard2').count(), 0, model)
+            self.assertOnOwnShard(model)
+        self.assertEqual({c.doctor_unread for alias in sharding.shard_aliases() for c in Conversation.objects.using(alias)}, {1})
+        out = io.StringIO()
+        call_command('rebalance_shards', stdout=out)
+        self.assertEqual({line.split()[1] for line in out.getvalue().splitlines()}, {'0'})
+
+
+@skipUnless(len(settings.DATABASE_SHARDS) > 1, 'Needs several DATABASE_SHARDS.')
+class ShardReferenceCommitTests(TransactionTestCase):
+    # Copies follow commits of the default database, so these must commit.
+
+    def setUp(self):
+        self.specialization = Specialization.objects.create(name='Cardiology')
+        self.patient = Patient.objects.create(user=User.objects.create_user('pat'), name='Pat', date_of_birth=datetime.date(1990, 1, 1), gender='F', phone_number='1234567890', age=30, blood_group='O+')
+
+    def make_doctor(self, username):
+        return Doctor.objects.create(user=User.objects.create_user(username), name=username, email=f'{username}@example.com', office_number='1', specialization=self.specialization, years_of_experience=1)
+
+    def copies(self, model, pk):
+        return [alias for alias in sharding.other_shards() if model.objects.using(alias).filter(pk=pk).exists()]
+
+    def test_rolled_back_writes_never_reach_the_other_shards(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            doctor = self.make_doctor('doc')
+            raise RuntimeError
+        self.assertEqual(self.copies(Doctor, doctor.pk), [])
+        self.assertEqual(self.copies(User, doctor.user_id), [])
+        # Off the default database, so that only a copy's cascade could reach it.
+        doctor = next(d for d in (self.make_doctor(f'doc{i}') for i in range(20)) if sharding.shard_for('doctor', d.pk) != DEFAULT_DB_ALIAS)
+        appointment = Appointment.objects.create(doctor=doctor, patient=self.patient, date=datetime.date(2030, 1, 1), time=datetime.time(9), status='pending')
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            doctor.user.delete()
+            raise RuntimeError
+        self.assertEqual(self.copies(Doctor, doctor.pk), sharding.other_shards())
+        self.assertTrue(sharding.on_shard(Appointment.objects.filter(pk=appointment.pk), doctor=doctor.pk).exists())
+
+    def test_deleted_rows_leave_copies_that_sharded_rows_still_use(self):
+        doctor = next(d for d in (self.make_doctor(f'doc{i}') for i in range(20)) if sharding.shard_for('doctor', d.pk) != DEFAULT_DB_ALIAS)
+        shard = sharding.shard_for('doctor', doctor.pk)
+        appointment = Appointment.objects.create(doctor=doctor, patient=self.patient, date=datetime.date(2030, 1, 1), time=datetime.time(9), status='pending')
+        pk = doctor.pk
+        with self.assertLogs('baseapp.sharding', 'WARNING'):
+            doctor.delete()
+        self.assertFalse(Doctor.objects.filter(pk=pk).exists())
+        self.assertEqual(self.copies(Doctor, pk), [shard])
+        self.assertTrue(Appointment.objects.using(shard).filter(pk=appointment.pk).exists())
+
+    def test_logins_do_not_write_to_the_shards(self):
+        user = self.patient.user
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in sharding.other_shards()]
+            user.last_login = timezone.now()
+            user.save(update_fields=['last_login'])
+        self.assertEqual([len(context) for context in captured], [0] * len(captured))
+        user.first_name = 'Pat'
+        user.save()
+        self.assertEqual({User.objects.using(alias).get(pk=user.pk).first_name for alias in sharding.other_shards()}, {'Pat'})
+
+
+class BenchmarkTests(TestCase):
+    def test_every_route_has_a_scenario(self):
+        self.assertEqual(set(benchmarks.route_names()) - set(benchmarks.SCENARIOS), set())
+
+    def test_run_reports_every_route(self):
+        results = benchmarks.run(scale=0.01, iterations=1, warmup=0)
+        self.assertEqual(set(results), set(benchmarks.route_names()))
+        # The ETag aggregate, then the page and its qualifications.
+        self.assertEqual(results['get_all_doctors']['queries'], 3)
+        self.assertTrue(all(benchmarks.SCENARIOS[name].expects(result['status']) for name, result in results.items()))
+        # Run as they are: the registration serializers refuse the nested
+        # account their views read, and MessageSerializer cannot save.
+        self.assertEqual([results[name]['status'] for name in ('register_doctor', 'register_user', 'create_message')], [400, 400, 500])
+
+    def test_error_responses_fail_the_run(self):
+        missing = benchmarks.Scenario('get', lambda ctx, i: (ctx.patient.user, {'appointment_id': 10 ** 9}, {}))
+        with mock.patch.dict(benchmarks.SCENARIOS, {'get_appointment_details': missing}), self.assertRaisesMessage(benchmarks.ScenarioError, 'returned 404'):
+            benchmarks.run(scale=0.01, iterations=1, warmup=0, routes=['get_appointment_details'])
+
+    def test_regressions(self):
+        baseline = {'get_all_doctors': {'queries': 2, 'p95_ms': 10.0}}
+        self.assertEqual(benchmarks.regressions({'get_all_doctors': {'queries': 2, 'p95_ms': 12.0}}, baseline), [])
+        self.assertEqual(len(benchmarks.regressions({'get_all_doctors': {'queries': 3, 'p95_ms': 20.0}}, baseline)), 2)
@@ -4,14 +4,32 @@ from . import views
 urlpatterns = [
     path('register/doctor/', views.register_doctor, name='register_doctor'),
     path('register/user/', views.register_user, name='register_user'),
+    path('imports/<str:kind>/', views.import_profiles, name='import_profiles'),
     path('login/doctor/', views.login_doctor, name='login_doctor'),
     path('login/user/', views.login_user, name='login_user'),
+    path('logout/', views.logout_user, name='logout_user'),
+    path('token/refresh/', views.refresh_token, name='refresh_token'),
     path('doctors/', views.get_all_doctors, name='get_all_doctors'),
+    path('doctors/search/', views.search_doctors, name='search_doctors'),
+    path('doctors/next-available/', views.get_next_available_doctors, name='get_next_available_doctors'),
+    path('doctors/presence/', views.doctor_heartbeat, name='doctor_heartbeat'),
+    path('doctors/cache/stats/', views.get_doctor_cache_stats, name='get_doctor_cache_stats'),
+    path('doctors/images/<str:digest>/<str:variant>/', views.get_doctor_image_variant, name='get_doctor_image_variant'),
     path('doctors/<int:doctor_id>/', views.get_doctor_details, name='get_doctor_details'),
+    path('doctors/<int:doctor_id>/schedule/', views.get_doctor_schedule, name='get_doctor_schedule'),
     path('appointments/ordered/', views.get_all_appointments_ordered, name='get_all_appointments_ordered'),
+    path('appointments/book/', views.book_appointment, name='book_appointment'),
+    path('appointments/transitions/', views.bulk_transition_appointments, name='bulk_transition_appointments'),
     path('appointments/<int:appointment_id>/complete/', views.mark_appointment_completed, name='mark_appointment_completed'),
     path('appointments/<int:appointment_id>/cancel/', views.mark_appointment_cancelled, name='mark_appointment_cancelled'),
     path('appointments/<int:appointment_id>/', views.get_appointment_details, name='get_appointment_details'),
+    path('patients/<int:patient_id>/records/', views.get_patient_medical_records, name='get_patient_medical_records'),
     path('messages/', views.get_all_messages, name='get_all_messages'),
     path('messages/create/', views.create_message, name='create_message'),
+    path('conversations/inbox/', views.get_inbox, name='get_inbox'),
+    path('conversations/<int:conversation_id>/read/', views.mark_conversation_read, name='mark_conversation_read'),
+    path('conversations/<int:conversation_id>/messages/', views.get_conversation_messages, name='get_conversation_messages'),
+    path('sync/<str:collection>/', views.sync_changes, name='sync_changes'),
+    path('metrics/', views.export_metrics, name='export_metrics'),
+    path('conversations/<int:conversation_id>/events/', views.stream_conversation_events, name='stream_conversation_events'),
 ]
\ No newline at end of file
@@ -1,11 +1,33 @@
-from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+import asyncio
+from asgiref.sync import sync_to_async
+from rest_framework import serializers, status
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import BasePermission, IsAdminUser, IsAuthenticated
+from rest_framework.settings import api_settings
 from rest_framework.response import Response
 from django.contrib.auth.models import User
-from .models import Doctor, Patient, Appointment, MedicalRecord, Qualification, Specialization, Conversation, Message
-from .serializers import QualificationSerializer, SpecializationSerializer, DoctorSerializer, PatientSerializer, AppointmentSerializer, MedicalRecordSerializer, ConversationSerializer, MessageSerializer
-from rest_framework.exceptions import NotFound
+from .models import Doctor, Patient, Appointment, MedicalRecord, Qualification, Specialization, Conversation, Message, ImportJob
+from .serializers import QualificationSerializer, SpecializationSerializer, DoctorSerializer, HeartbeatSerializer, PatientSerializer, AppointmentSerializer, AppointmentBookingSerializer, BulkTransitionSerializer, ImportJobSerializer, MedicalRecordSerializer, ConversationSerializer, InboxSerializer, MessageSerializer, ReadReceiptSerializer
+from .booking import transition_appointments
+from .importer import Importer, detect_format, read_rows, text_stream
+from .pagination import DoctorCursorPagination, InboxPagination, KeysetPagination, MedicalRecordPagination, keyset_after
+from .fulltext import search_medical_records
+from .cache import doctor_cache
+from .presence import presence
+from .slots import slot_index
+from .search import search_index
+from .fast_serializers import fast_appointments, fast_medical_records, fast_messages
+from .broker import get_broker
+from . import archive, changes, images, inbox, metrics, schedules, sharding, tasks
+from .conditional import conditional, etag
+from .routers import read_replica
+from .authentication import MetricsTokenAuthentication, authenticate_request, decode_token, issue_tokens, jwt_enabled, revocations
+from django.db.models import Count, Max, Q
+from django.conf import settings
+from django.utils import timezone
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.exceptions import AuthenticationFailed, NotFound
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import authenticate, login,logout
 from rest_framework.authtoken.models import Token
@@ -32,6 +54,7 @@ def register_doctor(request):
                 last_name=serializer.validated_data['user']['last_name'],
             )
             doctor = serializer.save(user=user)
+            tasks.enqueue(tasks.send_welcome_email, {'user_id': user.pk}, dedup_key=f'welcome-email:{user.pk}')
             return Response(DoctorSerializer(doctor).data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -50,10 +73,34 @@ def register_user(request):
                 last_name=serializer.validated_data['user']['last_name'],
             )
             patient = serializer.save(user=user)
+            tasks.enqueue(tasks.send_welcome_email, {'user_id': user.pk}, dedup_key=f'welcome-email:{user.pk}')
             return Response(PatientSerializer(patient).data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def import_profiles(request, kind):
+    if request.method == 'POST':
+        if kind not in dict(ImportJob.KIND_CHOICES):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        # Either an uploaded CSV/JSONL file or a JSON body of {"rows": [...]}.
+        upload = request.FILES.get('file')
+        if upload is not None:
+            rows = read_rows(text_stream(upload), request.data.get('format') or detect_format(upload.name))
+        elif isinstance(request.data.get('rows'), list):
+            rows = request.data['rows']
+        else:
+            return Response({'detail': 'Send a file or a list of rows.'}, status=status.HTTP_400_BAD_REQUEST)
+        if request.data.get('job'):
+            job = get_object_or_404(ImportJob.objects.exclude(status='completed'), pk=request.data['job'], kind=kind)
+            job.status = 'running'
+            job.save(update_fields=['status', 'updated_at'])
+        else:
+            job = ImportJob.objects.create(kind=kind, source=upload.name if upload is not None else 'request')
+        Importer(job).run(rows)
+        return Response(ImportJobSerializer(job).data, status=status.HTTP_201_CREATED)
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def login_doctor(request):
@@ -63,6 +110,8 @@ def login_doctor(request):
         user = authenticate(request, username=username, password=password)
         if user is not None:
             if user.is_active:
+                if jwt_enabled():
+                    return Response(issue_tokens(user))
                 login(request, user)
                 token, _ = Token.objects.get_or_create(user=user)
                 return Response({'token': token.key})
@@ -80,6 +129,8 @@ def login_user(request):
         user = authenticate(request, username=username, password=password)
         if user is not None:
             if user.is_active:
+                if jwt_enabled():
+                    return Response(issue_tokens(user))
                 login(request, user)
                 token, _ = Token.objects.get_or_create(user=user)
                 return Response({'token': token.key})
@@ -92,10 +143,29 @@ def login_user(request):
 @permission_classes([IsAuthenticated])
 def logout_user(request):
     if request.method == 'POST':
+        if isinstance(request.auth, dict):
+            revocations.revoke(request.auth)
+            refresh = request.data.get('refresh')
+            if refresh:
+                revocations.revoke(decode_token(refresh, 'refresh'))
+            return Response(status=status.HTTP_200_OK)
+        Token.objects.filter(user=request.user).delete()
         logout(request)
-        request.user.auth_token.delete()
         return Response(status=status.HTTP_200_OK)
 
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def refresh_token(request):
+    if request.method == 'POST':
+        claims = decode_token(request.data.get('refresh', ''), 'refresh')
+        user = User.objects.filter(pk=claims['sub'], is_active=True).first()
+        if user is None:
+            return Response({'detail': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
+        # Refresh tokens are single use, also under concurrent refreshes.
+        if not revocations.revoke_once(claims):
+            return Response({'detail': 'Token has been revoked.'}, status=status.HTTP_401_UNAUTHORIZED)
+        return Response(issue_tokens(user))
+
 # class PasswordResetEmailView(TemplateResponseMixin, CreateView):
 #     template_name = 'registration/password_reset_form.html'
 #     form_class = PasswordResetForm
@@ -124,70 +194,352 @@ def logout_user(request):
 #     if request.method == 'POST':
 #         return PasswordResetEmailView.as_view()(request)
 
+def filter_doctors(doctors, params):
+    specialization = params.get('specialization')
+    if specialization:
+        if specialization.isdigit():
+            doctors = doctors.filter(specialization_id=specialization)
+        else:
+            doctors = doctors.filter(specialization__name__iexact=specialization)
+    available = params.get('available')
+    if available is not None:
+        # On live availability, as the doctors are serialized with it.
+        doctors = presence.matching(doctors, serializers.BooleanField().to_internal_value(available))
+    return doctors
+
+def filter_appointments(appointments, params):
+    if 'date_from' in params:
+        appointments = appointments.filter(date__gte=serializers.DateField().to_internal_value(params['date_from']))
+    if 'date_to' in params:
+        appointments = appointments.filter(date__lte=serializers.DateField().to_internal_value(params['date_to']))
+    if 'doctor' in params:
+        appointments = appointments.filter(doctor_id=serializers.IntegerField().to_internal_value(params['doctor']))
+    return appointments
+
+def appointment_shards(appointments, params):
+    # Appointments are sharded by doctor: filtering on one reads one shard.
+    if 'doctor' in params:
+        return sharding.scatter(appointments, doctor=serializers.IntegerField().to_internal_value(params['doctor']))
+    return sharding.scatter(appointments)
+
+def use_fast_serializers(request):
+    # Per-request override of the FAST_SERIALIZERS setting, for A/B runs.
+    default = getattr(settings, 'FAST_SERIALIZERS', False)
+    return serializers.BooleanField().to_internal_value(request.query_params.get('fast', default))
+
+def doctors_validators(request):
+    # The catalogue version also moves when specializations, qualifications
+    # or qualification links change, which leave updated_at alone.
+    # Availability is live (see baseapp.presence) and has its own version.
+    # No Last-Modified: none of those, nor a deletion, moves Max(updated_at),
+    # and a client without If-None-Match would be answered from it alone.
+    found = filter_doctors(Doctor.objects.all(), request.query_params).aggregate(last=Max('updated_at'), count=Count('id'))
+    return (doctor_cache.version(), presence.version(), found['last'], found['count']), None
+
+def doctor_validators(request, doctor_id):
+    last = Doctor.objects.filter(pk=doctor_id).values_list('updated_at', flat=True).first()
+    if last is None:
+        return None
+    # Availability and catalogue renames leave updated_at alone.
+    return (doctor_cache.version(), presence.is_available(doctor_id, None), last), None
+
+def appointment_validators(request, appointment_id):
+    if archive.include_archived(request):
+        return None
+    row = sharding.first(sharding.scatter(Appointment.objects.filter(pk=appointment_id).values_list('updated_at', 'doctor__updated_at', 'patient__updated_at')))
+    if row is None:
+        return None
+    # A catalogue rename changes the nested doctor without a timestamp.
+    return (doctor_cache.version(), row), None
+
+def messages_validators(request):
+    if archive.include_archived(request):
+        return None
+    # Saving or deleting a message bumps its conversation's updated_at, but
+    # deleting a conversation does not move the maximum: ETag only.
+    shards = [shard.aggregate(last=Max('updated_at'), count=Count('id')) for shard in sharding.scatter(Conversation.objects.all())]
+    last = max((found['last'] for found in shards if found['last'] is not None), default=None)
+    count = sum(found['count'] for found in shards)
+    return (last, count), None
+
+def conversation_validators(request, conversation_id):
+    if archive.include_archived(request):
+        return None
+    conversations = sharding.on_shard(Conversation.objects.filter(Q(doctor=request.user) | Q(patient=request.user), pk=conversation_id), conversation=conversation_id)
+    last = conversations.values_list('updated_at', flat=True).first()
+    if last is None:
+        return None
+    return (last,), last
+
 @api_view(['GET'])
 # @permission_classes([IsAuthenticated])
+@read_replica
+@conditional(doctors_validators)
 def get_all_doctors(request):
     if request.method == 'GET':
-        doctors = Doctor.objects.all()
-        serializer = DoctorSerializer(doctors, many=True)
-        return Response(serializer.data)
+        doctors = filter_doctors(Doctor.objects.with_related(), request.query_params)
+        paginator = DoctorCursorPagination()
+        page = paginator.paginate_queryset(doctors, request)
+        serializer = DoctorSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_replica
+@conditional(doctor_validators)
 def get_doctor_details(request, doctor_id):
     if request.method == 'GET':
         try:
-            doctor = Doctor.objects.get(pk=doctor_id)
+            doctor = Doctor.objects.with_related().get(pk=doctor_id)
         except Doctor.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
         serializer = DoctorSerializer(doctor)
         return Response(serializer.data)
     
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_next_available_doctors(request):
+    if request.method == 'GET':
+        params = request.query_params.copy()
+        available = serializers.BooleanField().to_internal_value(params.pop('available', ['true'])[-1])
+        # Every candidate is read anyway: check live availability on the rows.
+        stored = dict(filter_doctors(Doctor.objects.all(), params).values_list('id', 'available'))
+        doctor_ids = [doctor_id for doctor_id, live in presence.live_values(stored).items() if live == available]
+        now = timezone.localtime()
+        start = serializers.DateField().to_internal_value(params['from']) if 'from' in params else now.date()
+        days = serializers.IntegerField(min_value=1, max_value=60).to_internal_value(params.get('days', 14))
+        limit = serializers.IntegerField(min_value=1, max_value=50).to_internal_value(params.get('limit', 5))
+        found = slot_index.next_available(doctor_ids, max(start, now.date()), days, now=now, limit=limit)
+        doctors = Doctor.objects.with_related().in_bulk([doctor_id for doctor_id, _, _ in found])
+        # One serializer for every slot, so live availability is read once.
+        serialized = DoctorSerializer([doctors[doctor_id] for doctor_id, _, _ in found], many=True, context={'request': request}).data
+        return Response([
+            {'doctor': doctor, 'date': date, 'time': slot_time}
+            for doctor, (_, date, slot_time) in zip(serialized, found)
+        ])
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def search_doctors(request):
+    if request.method == 'GET':
+        limit = serializers.IntegerField(min_value=1, max_value=50).to_internal_value(request.query_params.get('limit', 10))
+        available = request.query_params.get('available')
+        if available is not None:
+            available = serializers.BooleanField().to_internal_value(available)
+        found = search_index.search(request.query_params.get('q', ''), limit=limit, available=available, live=presence.live_values)
+        doctors = Doctor.objects.with_related().in_bulk([doctor_id for doctor_id, _ in found])
+        found = [(doctor_id, score) for doctor_id, score in found if doctor_id in doctors]
+        # One serializer for every hit, so live availability is read once.
+        serialized = DoctorSerializer([doctors[doctor_id] for doctor_id, _ in found], many=True, context={'request': request}).data
+        return Response([{'doctor': doctor, 'score': round(score, 3)} for doctor, (_, score) in zip(serialized, found)])
+
+class IsStaffOrMetricsScraper(BasePermission):
+    def has_permission(self, request, view):
+        return request.auth == 'metrics' or request.user.is_staff
+
+# Every worker process keeps its own counters, so each scrape reports the
+# requests, cache lookups and tasks of the one process that answered it.
+@api_view(['GET'])
+@authentication_classes([MetricsTokenAuthentication, *api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+@permission_classes([IsStaffOrMetricsScraper])
+def export_metrics(request):
+    cache_stats = doctor_cache.stats()
+    lines = ['# HELP baseapp_doctor_cache_lookups_total Doctor cache lookups by outcome.', '# TYPE baseapp_doctor_cache_lookups_total counter']
+    for outcome in ('local_hits', 'shared_hits', 'misses'):
+        lines.append(f'baseapp_doctor_cache_lookups_total{{outcome="{outcome}"}} {cache_stats[outcome]}')
+    lines.extend(tasks.metric_lines())
+    return HttpResponse(metrics.registry.render(lines), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def doctor_heartbeat(request):
+    if request.method == 'POST':
+        doctor_id = presence.doctor_for(request.user)
+        if doctor_id is None:
+            return Response({'detail': 'Only doctors report presence.'}, status=status.HTTP_403_FORBIDDEN)
+        serializer = HeartbeatSerializer(data=request.data)
+        if serializer.is_valid():
+            available = serializer.validated_data['available']
+            if presence.heartbeat(doctor_id, available):
+                changes.doctors_changed([doctor_id])
+            return Response({'doctor': doctor_id, 'available': available, 'expires_in': presence.ttl() if available else None})
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_doctor_schedule(request, doctor_id):
+    if request.method == 'GET':
+        params = request.query_params
+        date = serializers.DateField().to_internal_value(params['date']) if 'date' in params else timezone.localdate()
+        # Patient details: only the doctor and staff see a day view. Checked
+        # first, so that nobody else can have days built.
+        if not request.user.is_staff and not Doctor.objects.filter(pk=doctor_id, user_id=request.user.pk).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        # One key lookup; the row is kept current by the appointment signals.
+        schedule = schedules.lookup(doctor_id, date)
+        if schedule is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        # A day built without being stored has no version to go by.
+        headers = {'ETag': f'"{etag(doctor_id, date, schedule["version"], schedule["updated_at"] or schedule["appointments"])}"'}
+        if headers['ETag'] in request.headers.get('If-None-Match', ''):
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response({
+            'doctor': doctor_id,
+            'date': date,
+            'version': schedule['version'],
+            'appointments': schedule['appointments'],
+        }, headers=headers)
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_doctor_image_variant(request, digest, variant):
+    if request.method == 'GET':
+        if variant not in images.variant_sizes():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        # The URL names the source content, so the bytes behind it never change.
+        headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'ETag': f'"{digest}-{variant}"'}
+        if headers['ETag'] in request.headers.get('If-None-Match', ''):
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        storage = images.variant_storage()
+        name = images.variant_name(digest, variant)
+        if not storage.exists(name):
+            doctor = Doctor.objects.filter(image_hash=digest).only('image', 'image_hash').first()
+            if doctor is None or not doctor.image:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            name = images.ensure_variant(doctor, variant)
+        return FileResponse(storage.open(name), content_type=images.variant_content_type(), headers=headers)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_doctor_cache_stats(request):
+    if request.method == 'GET':
+        return Response(doctor_cache.stats())
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_all_appointments_ordered(request):
     if request.method == 'GET':
-        appointments = Appointment.objects.filter(status__in=['pending', 'confirmed']).order_by('date', 'time')
-        serializer = AppointmentSerializer(appointments, many=True)
+        sources = [
+            shard
+            for model in archive.models_for(Appointment, archive.include_archived(request))
+            for shard in appointment_shards(filter_appointments(model.objects.filter(status__in=['pending', 'confirmed']).select_related(
+                'doctor__specialization', 'patient',
+            ).prefetch_related('doctor__qualifications'), request.query_params), request.query_params)
+        ]
+        fast = use_fast_serializers(request)
+        if serializers.BooleanField().to_internal_value(request.query_params.get('stream', False)):
+            return StreamingHttpResponse(stream_appointments(sources, fast), content_type='application/x-ndjson')
+        ordering = ('date', 'time', 'id')
+        sources = [appointments.order_by(*ordering) for appointments in sources]
+        if fast:
+            return Response(fast_appointments.serialize_rows(list(archive.merge([fast_appointments.values(qs) for qs in sources], ordering))))
+        serializer = AppointmentSerializer(list(archive.merge(sources, ordering)), many=True)
         return Response(serializer.data)
+
+def stream_appointments(sources, fast=False):
+    encoder = JSONEncoder()
+    ordering = ('date', 'time', 'id')
+    if fast:
+        chunks = (fast_appointments.serialize_rows(chunk) for chunk in archive.merge_chunks([fast_appointments.values(qs) for qs in sources], ordering))
+    else:
+        chunks = (AppointmentSerializer(chunk, many=True).data for chunk in archive.merge_chunks(sources, ordering))
+    for chunk in chunks:
+        for data in chunk:
+            yield encoder.encode(data) + '\n'
     
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def book_appointment(request):
+    if request.method == 'POST':
+        serializer = AppointmentBookingSerializer(data=request.data)
+        if serializer.is_valid():
+            appointment = serializer.save()
+            tasks.enqueue(tasks.send_appointment_confirmation, {'appointment_id': appointment.pk}, dedup_key=f'appointment-confirmation:{appointment.pk}')
+            return Response(AppointmentSerializer(appointment).data, status=status.HTTP_201_CREATED)
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+def transition_appointment(request, appointment_id, target):
+    version = request.data.get('version')
+    if version is not None:
+        version = serializers.IntegerField(min_value=1).to_internal_value(version)
+    result, appointment = transition_appointments([(appointment_id, target, version)])[appointment_id]
+    if result == 'not_found':
+        return Response(status=status.HTTP_404_NOT_FOUND)
+    if result == 'failed':
+        return Response({'detail': result}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    if result != 'updated':
+        return Response(
+            {'detail': result, 'status': appointment.status, 'version': appointment.version},
+            status=status.HTTP_409_CONFLICT,
+        )
+    appointment = sharding.using(Appointment.objects.select_related('doctor__specialization', 'patient'), appointment._state.db).prefetch_related('doctor__qualifications').get(pk=appointment_id)
+    serializer = AppointmentSerializer(appointment)
+    return Response(serializer.data)
+
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
 def mark_appointment_completed(request, appointment_id):
     if request.method == 'PUT':
-        appointment = get_object_or_404(Appointment, pk=appointment_id)
-        appointment.status = 'completed'
-        appointment.save()
-        serializer = AppointmentSerializer(appointment)
-        return Response(serializer.data)
+        return transition_appointment(request, appointment_id, 'completed')
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
 def mark_appointment_cancelled(request, appointment_id):
     if request.method == 'PUT':
-        appointment = get_object_or_404(Appointment, pk=appointment_id)
-        appointment.status = 'cancelled'
-        appointment.save()
-        serializer = AppointmentSerializer(appointment)
-        return Response(serializer.data)
+        return transition_appointment(request, appointment_id, 'cancelled')
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def bulk_transition_appointments(request):
+    if request.method == 'POST':
+        serializer = BulkTransitionSerializer(data=request.data)
+        if serializer.is_valid():
+            requested = serializer.validated_data
+            results = transition_appointments(requested)
+            return Response({'results': [
+                {
+                    'id': pk,
+                    'result': results[pk][0],
+                    'status': results[pk][1].status if results[pk][1] else None,
+                    'version': results[pk][1].version if results[pk][1] else None,
+                }
+                for pk, _, _ in requested
+            ]})
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_replica
+@conditional(appointment_validators)
 def get_appointment_details(request, appointment_id):
     if request.method == 'GET':
-        try:
-            appointment = Appointment.objects.get(pk=appointment_id)
-        except Appointment.DoesNotExist:
+        appointment = None
+        for model in archive.models_for(Appointment, archive.include_archived(request)):
+            appointment = sharding.first(sharding.scatter(model.objects.filter(pk=appointment_id)))
+            if appointment is not None:
+                break
+        if appointment is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
         serializer = AppointmentSerializer(appointment)
         return Response(serializer.data)
     
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
+@read_replica
+@conditional(messages_validators)
 def get_all_messages(request):
     if request.method == 'GET':
-        messages = Message.objects.order_by('-time')
-        serializer = MessageSerializer(messages, many=True)
+        sources = [
+            shard
+            for model in archive.models_for(Message, archive.include_archived(request))
+            for shard in sharding.scatter(model.objects.select_related('conversation', 'sender').order_by('-timestamp', '-id'))
+        ]
+        if use_fast_serializers(request):
+            return Response(fast_messages.serialize_rows(list(archive.merge([fast_messages.values(qs) for qs in sources], ('timestamp', 'id'), reverse=True))))
+        serializer = MessageSerializer(list(archive.merge(sources, ('timestamp', 'id'), reverse=True)), many=True)
         return Response(serializer.data)
     elif request.method == 'POST':
         serializer = MessageSerializer(data=request.data)
@@ -197,6 +549,140 @@ def get_all_messages(request):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_patient_medical_records(request, patient_id):
+    if request.method == 'GET':
+        patient = get_object_or_404(Patient, pk=patient_id)
+        # Clinicians and staff may read any history, patients only their own.
+        if patient.user_id != request.user.pk and not request.user.is_staff and not Doctor.objects.filter(user_id=request.user.pk).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        sources = [
+            search_medical_records(sharding.on_shard(model.objects.filter(patient=patient), patient=patient.pk), request.query_params.get('q'))
+            for model in archive.models_for(MedicalRecord, archive.include_archived(request))
+        ]
+        paginator = MedicalRecordPagination()
+        if use_fast_serializers(request):
+            page = paginator.paginate_queryset([fast_medical_records.values(records) for records in sources], request)
+            return paginator.get_paginated_response(fast_medical_records.serialize_rows(page))
+        page = paginator.paginate_queryset([
+            records.select_related('patient', 'doctor__specialization').prefetch_related('doctor__qualifications')
+            for records in sources
+        ], request)
+        serializer = MedicalRecordSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@read_replica
+@conditional(conversation_validators)
+def get_conversation_messages(request, conversation_id):
+    if request.method == 'GET':
+        conversations = sharding.on_shard(Conversation.objects.filter(Q(doctor=request.user) | Q(patient=request.user)), conversation=conversation_id)
+        conversation = get_object_or_404(conversations, pk=conversation_id)
+        sources = [
+            sharding.on_shard(model.objects.filter(conversation=conversation), conversation=conversation.pk).select_related('conversation', 'sender')
+            for model in archive.models_for(Message, archive.include_archived(request))
+        ]
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(sources, request)
+        serializer = MessageSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_inbox(request):
+    if request.method == 'GET':
+        # Reads only the denormalized conversation rows, never Message; one
+        # query per shard.
+        conversations = Conversation.objects.filter(Q(doctor=request.user) | Q(patient=request.user), last_message_at__isnull=False)
+        paginator = InboxPagination()
+        page = paginator.paginate_queryset(sharding.scatter(conversations), request)
+        serializer = InboxSerializer(page, many=True, context={'user': request.user})
+        return paginator.get_paginated_response(serializer.data)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def mark_conversation_read(request, conversation_id):
+    if request.method == 'POST':
+        conversations = sharding.on_shard(Conversation.objects.filter(Q(doctor=request.user) | Q(patient=request.user)), conversation=conversation_id)
+        conversation = get_object_or_404(conversations, pk=conversation_id)
+        serializer = ReadReceiptSerializer(data=request.data)
+        if serializer.is_valid():
+            inbox.mark_read(conversation, inbox.side_of(conversation, request.user), serializer.validated_data.get('message'))
+            changes.record('conversations', [conversation.pk], conversation._state.db)
+            return Response(InboxSerializer(conversation, context={'user': request.user}).data)
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def sync_changes(request, collection):
+    if request.method == 'GET':
+        if collection not in changes.COLLECTIONS:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        limit = serializers.IntegerField(min_value=1, max_value=getattr(settings, 'CHANGE_FEED_MAX_LIMIT', 1000)).run_validation(
+            request.query_params.get('limit', getattr(settings, 'CHANGE_FEED_LIMIT', 500))
+        )
+        try:
+            return Response(changes.sync(collection, request.user, request.query_params.get('cursor'), limit))
+        except ValueError:
+            raise NotFound('Invalid cursor')
+
+async def stream_conversation_events(request, conversation_id):
+    # Plain async Django view: DRF views are sync, and under ASGI an idle
+    # subscriber here costs an open socket and a queue, not a thread.
+    # Token and JWT clients as well as sessions, like the DRF views.
+    try:
+        user = await sync_to_async(authenticate_request)(request)
+    except AuthenticationFailed as exc:
+        return JsonResponse({'detail': str(exc.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if not user.is_authenticated:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+    conversations = sharding.on_shard(Conversation.objects.filter(Q(doctor=user) | Q(patient=user), pk=conversation_id), conversation=conversation_id)
+    if not await conversations.aexists():
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    last_id = request.headers.get('Last-Event-ID', request.GET.get('after', ''))
+    last_id = int(last_id) if last_id.isdigit() else None
+    response = StreamingHttpResponse(conversation_events(conversation_id, last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def conversation_events(conversation_id, last_id):
+    broker = get_broker()
+    # Subscribe before replaying so nothing sent in between is lost.
+    subscription = broker.subscribe(f'conversation:{conversation_id}')
+    encoder = JSONEncoder()
+    heartbeat = getattr(settings, 'MESSAGE_EVENTS_HEARTBEAT', 15)
+    try:
+        yield 'retry: 3000\n\n'
+        # Messages are sent in (timestamp, id) order; the event id names the
+        # last one the client has, whose position the replay resumes from.
+        # Without that message (say it was deleted) there is no position to
+        # resume from, and only new messages are sent.
+        messages = sharding.on_shard(Message.objects.filter(conversation_id=conversation_id), conversation=conversation_id)
+        last = None
+        if last_id is not None:
+            last = await messages.filter(pk=last_id).values_list('timestamp', 'id').afirst()
+        if last is not None:
+            missed = messages.filter(keyset_after(('timestamp', 'id'), last)).select_related('conversation', 'sender').order_by('timestamp', 'id')
+            async for message in missed[:getattr(settings, 'MESSAGE_EVENTS_REPLAY_LIMIT', 200)]:
+                last = (message.timestamp, message.pk)
+                yield f'id: {message.pk}\nevent: message\ndata: {encoder.encode(MessageSerializer(message).data)}\n\n'
+        while not subscription.overflowed:
+            try:
+                key, data = await subscription.get(timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            if last is not None and key <= last:
+                continue
+            last = key
+            yield f'id: {key[1]}\nevent: message\ndata: {data}\n\n'
+    finally:
+        subscription.close()
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def create_message(request):
@@ -6,7 +6,10 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'H_API.settings')
+    # The test suite runs on SQLite, with shards and replicas of its own,
+    # and the benchmark on a single SQLite database.
+    own_settings = {'test': 'H_API.test_settings', 'benchmark': 'H_API.benchmark_settings'}
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', own_settings.get(sys.argv[1] if len(sys.argv) > 1 else None, 'H_API.settings'))
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc: